@@ -7,49 +7,156 @@ __email__ = "bob@libreserver.org"
 __status__ = "Production"
 __module_group__ = "Commandline Interface"
 
-import os
+from gnuplotRenderer import render_plot
+from gnuplotRenderer import gnuplot_escape
+from stationData import get_row
+from stationData import get_year_rows
 
 
-def _stations_anomaly(year: int, stations_data: {}, stations_locations: {},
-                      baseline: [], station_ids: set,
-                      min_latitude: float, max_latitude: float,
-                      month_number: int) -> float:
+def stations_anomaly(year: int, stations_data: {}, stations_locations: {},
+                     baseline: [], station_ids: set,
+                     min_latitude: float, max_latitude: float,
+                     month_number: int) -> float:
     """Returns anomaly for the given stations for the given year
     """
     anomaly = 0.0
     hits = 0
 
+    values = stations_data['values']
     for sid in station_ids:
-        if sid not in stations_data:
-            continue
-        if year not in stations_data[sid]:
+        row = get_row(stations_data, sid, year)
+        if row is None:
             continue
         if stations_locations[sid]['latitude'] < min_latitude or \
            stations_locations[sid]['latitude'] > max_latitude:
             continue
-        month_data = stations_data[sid][year]['month']
+        pos = row * 12
         if month_number > -1:
             month_index = month_number
             if baseline[month_index]:
-                if month_data[month_index]['av'] > -80 and \
-                   month_data[month_index]['av'] < 80:
-                    anomaly += \
-                        month_data[month_index]['av'] - baseline[month_index]
+                value = values[pos + month_index]
+                if value > -80 and value < 80:
+                    anomaly += value - baseline[month_index]
                     hits += 1
         else:
             for month_index in range(12):
                 if not baseline[month_index]:
                     continue
-                if month_data[month_index]['av'] > -80 and \
-                   month_data[month_index]['av'] < 80:
-                    anomaly += \
-                        month_data[month_index]['av'] - baseline[month_index]
+                value = values[pos + month_index]
+                if value > -80 and value < 80:
+                    anomaly += value - baseline[month_index]
                     hits += 1
     if hits > 0:
         return anomaly / float(hits)
     return None
 
 
+def get_station_anomalies(stations_data: {}, sid: str, baseline: [],
+                          start_year: int, end_year: int):
+    """Yields the year and monthly anomalies for a station relative to
+    the given baseline, for each year of data in the given range.
+    Months without a valid value or baseline are None
+    """
+    values = stations_data['values']
+    years = stations_data['years']
+    for row in get_year_rows(stations_data, sid, start_year, end_year + 1):
+        pos = row * 12
+        anomalies = [None] * 12
+        for month_index in range(12):
+            if not baseline[month_index]:
+                continue
+            value = values[pos + month_index]
+            if value > -80 and value < 80:
+                anomalies[month_index] = value - baseline[month_index]
+        yield years[row], anomalies
+
+
+def new_anomaly_totals() -> {}:
+    """Returns empty annual and monthly anomaly totals
+    """
+    return {
+        'annual': {},
+        'annual_hits': {},
+        'monthly': {},
+        'monthly_hits': {}
+    }
+
+
+def add_station_anomalies(anomaly_totals: {}, stations_data: {}, sid: str,
+                          baseline: [],
+                          start_year: int, end_year: int) -> None:
+    """Adds the monthly anomalies of a station to the annual and
+    monthly anomaly totals at the same time
+    """
+    annual_totals = anomaly_totals['annual']
+    annual_hits = anomaly_totals['annual_hits']
+    monthly_totals = anomaly_totals['monthly']
+    monthly_hits = anomaly_totals['monthly_hits']
+    for year, station_anomalies in \
+            get_station_anomalies(stations_data, sid, baseline,
+                                  start_year, end_year):
+        if year not in annual_totals:
+            annual_totals[year] = 0.0
+            annual_hits[year] = 0
+            monthly_totals[year] = [0.0] * 12
+            monthly_hits[year] = [0] * 12
+        totals = monthly_totals[year]
+        hits = monthly_hits[year]
+        for month_index in range(12):
+            month_anomaly = station_anomalies[month_index]
+            if month_anomaly is None:
+                continue
+            annual_totals[year] += month_anomaly
+            annual_hits[year] += 1
+            totals[month_index] += month_anomaly
+            hits[month_index] += 1
+
+
+def get_totals_anomalies(anomaly_totals: {},
+                         start_year: int, end_year: int) -> ({}, {}):
+    """Returns the annual and monthly anomalies from anomaly totals
+    """
+    annual_totals = anomaly_totals['annual']
+    annual_hits = anomaly_totals['annual_hits']
+    monthly_totals = anomaly_totals['monthly']
+    monthly_hits = anomaly_totals['monthly_hits']
+    anomalies = {}
+    anomalies_monthly = {}
+    for year in range(start_year, end_year + 1, 1):
+        anomalies[year] = None
+        if not annual_hits.get(year):
+            continue
+        anomalies[year] = annual_totals[year] / float(annual_hits[year])
+        anomalies_monthly[year] = []
+        for month_index in range(12):
+            if monthly_hits[year][month_index] > 0:
+                anomalies_monthly[year].append(
+                    monthly_totals[year][month_index] /
+                    float(monthly_hits[year][month_index]))
+            else:
+                anomalies_monthly[year].append(None)
+    return anomalies, anomalies_monthly
+
+
+def cell_anomalies(stations_data: {}, stations_locations: {},
+                   baseline: [], station_ids: set,
+                   start_year: int, end_year: int,
+                   min_latitude: float, max_latitude: float) -> ({}, {}):
+    """Returns the annual and monthly anomalies for a grid cell.
+    Each station is visited once
+    """
+    anomaly_totals = new_anomaly_totals()
+    for sid in station_ids:
+        if sid not in stations_data['stations']:
+            continue
+        if stations_locations[sid]['latitude'] < min_latitude or \
+           stations_locations[sid]['latitude'] > max_latitude:
+            continue
+        add_station_anomalies(anomaly_totals, stations_data, sid, baseline,
+                              start_year, end_year)
+    return get_totals_anomalies(anomaly_totals, start_year, end_year)
+
+
 def update_grid_anomalies(grid: [], stations_data: {}, stations_locations: {},
                           start_year: int, end_year: int,
                           min_latitude: float, max_latitude: float) -> int:
@@ -62,23 +169,13 @@ def update_grid_anomalies(grid: [], stations_data: {}, stations_locations: {},
         grid_cell['anomalies_monthly'] = {}
         if not grid_cell['station_ids']:
             continue
-        baseline = grid_cell['baseline']
-        station_ids = grid_cell['station_ids']
-        for year in range(start_year, end_year + 1, 1):
-            grid_cell['anomalies'][year] = \
-                _stations_anomaly(year, stations_data, stations_locations,
-                                  baseline, station_ids,
-                                  min_latitude, max_latitude, -1)
-            if grid_cell['anomalies'][year] is not None:
-                year_ctr += 1
-                grid_cell['anomalies_monthly'][year] = []
-                for month_index in range(12):
-                    mnth_anom = \
-                        _stations_anomaly(year, stations_data, stations_locations,
-                                          baseline, station_ids, min_latitude,
-                                          max_latitude, month_index)
-                    grid_cell['anomalies_monthly'][year].append(mnth_anom)
-            ctr += 1
+        grid_cell['anomalies'], grid_cell['anomalies_monthly'] = \
+            cell_anomalies(stations_data, stations_locations,
+                           grid_cell['baseline'], grid_cell['station_ids'],
+                           start_year, end_year,
+                           min_latitude, max_latitude)
+        year_ctr += len(grid_cell['anomalies_monthly'])
+        ctr += len(grid_cell['anomalies'])
     if year_ctr > 0:
         return int(year_ctr * 100 / float(ctr))
     return 0
@@ -136,11 +233,43 @@ def get_monthly_anomalies(grid: [],
     return result
 
 
+def save_series_csv(filename: str, grid: [],
+                    start_year: int, end_year: int) -> bool:
+    """Saves the annual and monthly anomalies of a grid as CSV
+    """
+    annual = get_global_anomalies(grid, start_year, end_year)
+    monthly = get_monthly_anomalies(grid, start_year, end_year)
+    try:
+        with open(filename, 'w+', encoding='utf-8') as fp_series:
+            fp_series.write('year,annual,jan,feb,mar,apr,may,jun,' +
+                            'jul,aug,sep,oct,nov,dec\n')
+            for year in range(start_year, end_year + 1):
+                if annual[year] is None:
+                    continue
+                values = [annual[year]]
+                if monthly[year]:
+                    values += monthly[year]
+                else:
+                    values += [None] * 12
+                fp_series.write(str(year) + ',' +
+                                ','.join('' if value is None else str(value)
+                                         for value in values) + '\n')
+    except OSError:
+        print('Unable to save ' + filename)
+        return False
+    return True
+
+
 def plot_global_anomalies(grid: [],
                           start_year: int, end_year: int,
                           baseline_start: int, baseline_end: int,
-                          min_latitude: float, max_latitude: float) -> None:
-    """Plot yearly anomalies graph
+                          min_latitude: float, max_latitude: float,
+                          plot_name: str = 'global_anomalies',
+                          renderer: {} = None,
+                          region: str = None) -> None:
+    """Plot yearly anomalies graph.
+    If a renderer is given then the plot is added to its queue.
+    If a region, such as a country, is given then it is used in the title
     """
     anomalies = get_global_anomalies(grid, start_year, end_year)
     if not anomalies:
@@ -161,6 +290,10 @@ def plot_global_anomalies(grid: [],
         "Global Temperature Anomalies " + \
         str(start_year) + ' - ' + str(end_year) + \
         ' for latitude range ' + str(min_latitude) + ' - ' + str(max_latitude)
+    if region:
+        title = \
+            gnuplot_escape(region) + " Temperature Anomalies " + \
+            str(start_year) + ' - ' + str(end_year)
     subtitle = "Source https://www.ncei.noaa.gov/pub/data/ghcn/v4"
     x_label = 'Year'
     y_label = 'Average Temperature Anomaly (Celcius) ' + \
@@ -169,19 +302,18 @@ def plot_global_anomalies(grid: [],
     vpos = 0.94
     image_width = 1000
     image_height = 1000
-    plot_name = 'global_anomalies'
     image_format = 'jpg'
     image_format2 = 'jpeg'
     filename = plot_name + '.' + image_format
-    script_filename = plot_name + '.gnuplot'
-    data_filename = plot_name + '.data'
-    with open(data_filename, 'w+', encoding='utf-8') as fp_data:
-        year = start_year
-        for temperature_anomaly in series:
-            fp_data.write(str(year) + "    " + str(temperature_anomaly) + '\n')
-            year += 1
+    # the data is inline within the script
+    data = ''
+    year = start_year
+    for temperature_anomaly in series:
+        data += str(year) + "    " + str(temperature_anomaly) + '\n'
+        year += 1
     script = \
         "reset\n" + \
+        "$data << EOD\n" + data + "EOD\n" + \
         "set title \"" + title + "\"\n" + \
         "set label \"" + subtitle + "\" at screen " + \
         str(indent) + ", screen " + str(vpos) + "\n" + \
@@ -197,17 +329,20 @@ def plot_global_anomalies(grid: [],
         "set terminal " + image_format2 + \
         " size " + str(image_width) + "," + str(image_height) + "\n" + \
         "set output \"" + filename + "\"\n" + \
-        "plot \"" + data_filename + "\" using 1:2 notitle with lines\n"
-    with open(script_filename, 'w+', encoding='utf-8') as fp_scr:
-        fp_scr.write(script)
-    os.system('gnuplot ' + script_filename)
+        "plot $data using 1:2 notitle with lines\n"
+    render_plot(script, renderer)
 
 
 def plot_monthly_anomalies(grid: [],
                            start_year: int, end_year: int,
                            baseline_start: int, baseline_end: int,
-                           min_latitude: float, max_latitude: float) -> None:
-    """Plot monthly anomalies graph
+                           min_latitude: float, max_latitude: float,
+                           plot_name: str = 'monthly_anomalies',
+                           renderer: {} = None,
+                           region: str = None) -> None:
+    """Plot monthly anomalies graph.
+    If a renderer is given then the plot is added to its queue.
+    If a region, such as a country, is given then it is used in the title
     """
     anomalies = get_monthly_anomalies(grid, start_year, end_year)
     series = []
@@ -229,6 +364,10 @@ def plot_monthly_anomalies(grid: [],
         "Monthly Temperature Anomalies " + \
         str(start_year) + ' - ' + str(end_year) + \
         ' for latitude range ' + str(min_latitude) + ' - ' + str(max_latitude)
+    if region:
+        title = \
+            gnuplot_escape(region) + " Monthly Temperature Anomalies " + \
+            str(start_year) + ' - ' + str(end_year)
     subtitle = "Source https://www.ncei.noaa.gov/pub/data/ghcn/v4"
     x_label = 'Month'
     y_label = 'Average Monthly Temperature Anomaly (Celcius) ' + \
@@ -237,23 +376,22 @@ def plot_monthly_anomalies(grid: [],
     vpos = 0.94
     image_width = 1000
     image_height = 1000
-    plot_name = 'monthly_anomalies'
     image_format = 'jpg'
     image_format2 = 'jpeg'
     filename = plot_name + '.' + image_format
-    script_filename = plot_name + '.gnuplot'
-    data_filename = plot_name + '.data'
-    with open(data_filename, 'w+', encoding='utf-8') as fp_data:
-        for month_index in range(12):
-            line = str(month_index + 1)
-            for temperature_anomaly in series:
-                if temperature_anomaly[month_index] is not None:
-                    line += " " + str(temperature_anomaly[month_index])
-                else:
-                    line += " 0"
-            fp_data.write(line + '\n')
+    # the data is inline within the script
+    data = ''
+    for month_index in range(12):
+        line = str(month_index + 1)
+        for temperature_anomaly in series:
+            if temperature_anomaly[month_index] is not None:
+                line += " " + str(temperature_anomaly[month_index])
+            else:
+                line += " 0"
+        data += line + '\n'
     script = \
         "reset\n" + \
+        "$data << EOD\n" + data + "EOD\n" + \
         "set title \"" + title + "\"\n" + \
         "set label \"" + subtitle + "\" at screen " + \
         str(indent) + ", screen " + str(vpos) + "\n" + \
@@ -275,11 +413,9 @@ def plot_monthly_anomalies(grid: [],
     script += "plot "
     for year in range(start_year, end_year+1, 20):
         script += \
-            "\"" + data_filename + "\" using 1:" + str(2+year-start_year) + \
+            "$data using 1:" + str(2+year-start_year) + \
             " title \"" + str(year) + "\" with lines"
         if year < end_year+1:
             script += ', '
     script += '\n'
-    with open(script_filename, 'w+', encoding='utf-8') as fp_scr:
-        fp_scr.write(script)
-    os.system('gnuplot ' + script_filename)
+    render_plot(script, renderer)
@@ -0,0 +1,186 @@
+__filename__ = "anomalyCube.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import math
+from array import array
+from binaryFile import save_binary_file
+from binaryFile import load_binary_file
+
+ANOMALY_CUBE_FORMAT = 'anomaly_cube'
+
+ANOMALY_CUBE_VERSION = 1
+
+_NAN = float('nan')
+
+
+def _nan_if_none(value) -> float:
+    """Returns NaN for a missing value
+    """
+    if value is None:
+        return _NAN
+    return value
+
+
+def _none_if_nan(value: float) -> float:
+    """Returns None for a NaN value
+    """
+    if math.isnan(value):
+        return None
+    return value
+
+
+def save_anomaly_cube(filename: str, grid: [],
+                      start_year: int, end_year: int,
+                      metadata: {} = None) -> bool:
+    """Saves the coordinates, baselines and anomalies of every grid cell
+    within a range of years as a memory mappable anomaly cube of float32
+    arrays, with NaN where there is no value.
+    Settings used to calculate the anomalies, such as the baseline years,
+    may be given as metadata and are saved within the header
+    """
+    no_of_cells = len(grid)
+    no_of_years = end_year + 1 - start_year
+    latitudes = array('f', [grid_cell['latitude'] for grid_cell in grid])
+    longitudes = array('f', [grid_cell['longitude'] for grid_cell in grid])
+    baselines = array('f', [_NAN]) * (no_of_cells * 12)
+    annual = array('f', [_NAN]) * (no_of_cells * no_of_years)
+    monthly = array('f', [_NAN]) * (no_of_cells * no_of_years * 12)
+    for cell_index, grid_cell in enumerate(grid):
+        if grid_cell.get('baseline'):
+            pos = cell_index * 12
+            baselines[pos:pos + 12] = \
+                array('f', [_nan_if_none(value)
+                            for value in grid_cell['baseline']])
+        anomalies = grid_cell.get('anomalies', {})
+        anomalies_monthly = grid_cell.get('anomalies_monthly', {})
+        for year, anomaly in anomalies.items():
+            if anomaly is None or year < start_year or year > end_year:
+                continue
+            pos = cell_index * no_of_years + year - start_year
+            annual[pos] = anomaly
+            if anomalies_monthly.get(year):
+                monthly[pos * 12:pos * 12 + 12] = \
+                    array('f', [_nan_if_none(value)
+                                for value in anomalies_monthly[year]])
+    header = {
+        'format': ANOMALY_CUBE_FORMAT,
+        'version': ANOMALY_CUBE_VERSION,
+        'start_year': start_year,
+        'end_year': end_year,
+        'shapes': {
+            'latitude': [no_of_cells],
+            'longitude': [no_of_cells],
+            'baseline': [no_of_cells, 12],
+            'annual': [no_of_cells, no_of_years],
+            'monthly': [no_of_cells, no_of_years, 12]
+        },
+        'metadata': metadata or {}
+    }
+    return save_binary_file(filename, header, {
+        'latitude': latitudes,
+        'longitude': longitudes,
+        'baseline': baselines,
+        'annual': annual,
+        'monthly': monthly
+    })
+
+
+def open_anomaly_cube(filename: str) -> {}:
+    """Memory maps an anomaly cube, returning its header and arrays,
+    or None if the file is not an anomaly cube
+    """
+    header, arrays = load_binary_file(filename)
+    if not header or header.get('format') != ANOMALY_CUBE_FORMAT:
+        print('Unable to read anomaly cube ' + filename)
+        return None
+    if header.get('version') != ANOMALY_CUBE_VERSION:
+        print('Unsupported anomaly cube version ' + filename)
+        return None
+    return {
+        'header': header,
+        'arrays': arrays
+    }
+
+
+def _cube_years(cube: {}, start_year: int, end_year: int) -> (int, int):
+    """Returns the range of years within the cube, limited to the given
+    years
+    """
+    header = cube['header']
+    if start_year is None:
+        start_year = header['start_year']
+    if end_year is None:
+        end_year = header['end_year']
+    return max(start_year, header['start_year']), \
+        min(end_year, header['end_year'])
+
+
+def read_cube_cells(cube: {}, cell_indexes: [] = None,
+                    start_year: int = None, end_year: int = None) -> []:
+    """Returns grid cells from an anomaly cube, with the same fields as
+    the cells of a grid, for the given cell indexes and range of years.
+    Only the parts of the file containing them are read
+    """
+    header = cube['header']
+    arrays = cube['arrays']
+    no_of_cells, no_of_years = header['shapes']['annual']
+    if cell_indexes is None:
+        cell_indexes = range(no_of_cells)
+    start_year, end_year = _cube_years(cube, start_year, end_year)
+    first = start_year - header['start_year']
+    last = end_year + 1 - header['start_year']
+    cells = []
+    for cell_index in cell_indexes:
+        if cell_index < 0 or cell_index >= no_of_cells:
+            continue
+        grid_cell = {
+            'index': cell_index,
+            'latitude': arrays['latitude'][cell_index],
+            'longitude': arrays['longitude'][cell_index],
+            'baseline': [_none_if_nan(value) for value in
+                         arrays['baseline'][cell_index * 12:
+                                            cell_index * 12 + 12].tolist()],
+            'anomalies': {},
+            'anomalies_monthly': {}
+        }
+        pos = cell_index * no_of_years
+        annual = arrays['annual'][pos + first:pos + last].tolist()
+        monthly = arrays['monthly'][(pos + first) * 12:
+                                    (pos + last) * 12].tolist()
+        for year_index, anomaly in enumerate(annual):
+            year = start_year + year_index
+            if math.isnan(anomaly):
+                grid_cell['anomalies'][year] = None
+                continue
+            grid_cell['anomalies'][year] = anomaly
+            grid_cell['anomalies_monthly'][year] = \
+                [_none_if_nan(value) for value in
+                 monthly[year_index * 12:year_index * 12 + 12]]
+        cells.append(grid_cell)
+    return cells
+
+
+def read_cube_year(cube: {}, year: int) -> ([], []):
+    """Returns the annual anomaly and the monthly anomalies of every grid
+    cell for a year, or None if the year is not within the cube
+    """
+    header = cube['header']
+    arrays = cube['arrays']
+    if year < header['start_year'] or year > header['end_year']:
+        return None
+    no_of_cells, no_of_years = header['shapes']['annual']
+    year_index = year - header['start_year']
+    annual = []
+    monthly = []
+    for cell_index in range(no_of_cells):
+        pos = cell_index * no_of_years + year_index
+        annual.append(_none_if_nan(arrays['annual'][pos]))
+        monthly.append([_none_if_nan(value) for value in
+                        arrays['monthly'][pos * 12:pos * 12 + 12].tolist()])
+    return annual, monthly
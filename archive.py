@@ -0,0 +1,39 @@
+__filename__ = "archive.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import tarfile
+
+ARCHIVE_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar')
+
+# errors which may occur while reading from an archive
+ARCHIVE_ERRORS = (OSError, EOFError, tarfile.TarError)
+
+
+def is_archive(filename: str) -> bool:
+    """Returns true if the given filename is a tar archive,
+    such as ghcnm.tavg.latest.qcf.tar.gz
+    """
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def archive_member_lines(filename: str, suffix: str):
+    """Yields the lines, as bytes, of the first file within the archive
+    whose name ends with the given suffix, such as .dat or .inv.
+    The archive is read as a stream, so nothing is extracted to disk
+    and only one block of the decompressed member is held at a time
+    """
+    with tarfile.open(filename, 'r|*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(suffix):
+                continue
+            fp_member = tar.extractfile(member)
+            for line in fp_member:
+                yield line
+            return
+    print('No ' + suffix + ' file found within ' + filename)
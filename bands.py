@@ -0,0 +1,175 @@
+__filename__ = "bands.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+from baseline import get_station_baseline
+from baseline import mean_baseline
+from anomaly import new_anomaly_totals
+from anomaly import add_station_anomalies
+from anomaly import get_totals_anomalies
+
+
+def parse_bands(bands_str: str) -> []:
+    """Parses a list of latitude bands such as 0:30,30:60,-90:0
+    into a list of (min latitude, max latitude)
+    """
+    bands = []
+    for band_str in bands_str.split(','):
+        band_str = band_str.strip()
+        if not band_str:
+            continue
+        if ':' not in band_str:
+            return None
+        min_str, max_str = band_str.split(':', 1)
+        try:
+            min_latitude = float(min_str)
+            max_latitude = float(max_str)
+        except ValueError:
+            return None
+        if min_latitude >= max_latitude or \
+           min_latitude < -90 or max_latitude > 90:
+            return None
+        if (min_latitude, max_latitude) not in bands:
+            bands.append((min_latitude, max_latitude))
+    return bands
+
+
+def band_name(band: ()) -> str:
+    """Returns a name for a latitude band, suitable for filenames
+    """
+    return ('%g' % band[0]) + '_' + ('%g' % band[1])
+
+
+def get_station_bands(station_locations: {}, bands: []) -> {}:
+    """Returns the bands which each station belongs to.
+    Band limits are inclusive, so a station on a boundary is in both bands
+    """
+    station_bands = {}
+    for sid, item in station_locations.items():
+        in_bands = []
+        for band in bands:
+            if item['latitude'] >= band[0] and item['latitude'] <= band[1]:
+                in_bands.append(band)
+        if in_bands:
+            station_bands[sid] = in_bands
+    return station_bands
+
+
+def get_bands_station_ids(station_locations: {}, bands: []) -> set:
+    """Returns the ids of stations within any of the given bands
+    """
+    return set(get_station_bands(station_locations, bands).keys())
+
+
+def get_band_grids(grid: [], station_bands: {}, bands: []) -> {}:
+    """Returns a grid for each band, containing only the stations
+    within the band
+    """
+    band_grids = {}
+    for band in bands:
+        band_grids[band] = []
+        for grid_cell in grid:
+            band_cell = grid_cell.copy()
+            band_cell['station_ids'] = set()
+            band_grids[band].append(band_cell)
+    for grid_cell in grid:
+        for sid in grid_cell['station_ids']:
+            for band in station_bands.get(sid, []):
+                band_grids[band][grid_cell['index']]['station_ids'].add(sid)
+    return band_grids
+
+
+def _get_band_cells(band_grids: {}) -> {}:
+    """Returns the cells of each band grid keyed by grid cell index,
+    so that band grids may contain only some of the grid cells
+    """
+    band_cells = {}
+    for band, band_grid in band_grids.items():
+        band_cells[band] = {}
+        for band_cell in band_grid:
+            band_cells[band][band_cell['index']] = band_cell
+    return band_cells
+
+
+def update_band_baselines(grid: [], band_grids: {}, station_bands: {},
+                          stations_data: {},
+                          start_year: int, end_year: int,
+                          baseline_index: {} = None) -> {}:
+    """Calculates reference baselines for each grid cell of every band.
+    The baseline of each station is calculated once and then added to
+    each band which the station belongs to.
+    Returns the number of grid baselines updated for each band
+    """
+    band_cells = _get_band_cells(band_grids)
+    ctr = {}
+    for band in band_grids:
+        ctr[band] = 0
+    for grid_cell in grid:
+        band_baselines = {}
+        for sid in grid_cell['station_ids']:
+            if sid not in station_bands:
+                continue
+            station_baseline = \
+                get_station_baseline(sid, stations_data,
+                                     start_year, end_year, baseline_index)
+            for band in station_bands[sid]:
+                if band not in band_baselines:
+                    band_baselines[band] = []
+                band_baselines[band].append(station_baseline)
+        for band, station_baselines in band_baselines.items():
+            band_cells[band][grid_cell['index']]['baseline'] = \
+                mean_baseline(station_baselines)
+            ctr[band] += 1
+    return ctr
+
+
+def update_band_anomalies(grid: [], band_grids: {}, station_bands: {},
+                          stations_data: {},
+                          start_year: int, end_year: int) -> {}:
+    """Calculates anomalies for each grid cell of every band within a
+    range of years, in a single pass over the stations of each cell.
+    Returns the percentage of grid anomalies updated for each band
+    """
+    band_cells = _get_band_cells(band_grids)
+    ctr = {}
+    year_ctr = {}
+    for band, band_grid in band_grids.items():
+        ctr[band] = 0
+        year_ctr[band] = 0
+        for band_cell in band_grid:
+            band_cell['anomalies'] = {}
+            band_cell['anomalies_monthly'] = {}
+    for grid_cell in grid:
+        anomaly_totals = {}
+        for sid in grid_cell['station_ids']:
+            if sid not in station_bands:
+                continue
+            if sid not in stations_data['stations']:
+                continue
+            for band in station_bands[sid]:
+                if band not in anomaly_totals:
+                    anomaly_totals[band] = new_anomaly_totals()
+                band_cell = band_cells[band][grid_cell['index']]
+                add_station_anomalies(anomaly_totals[band], stations_data,
+                                      sid, band_cell['baseline'],
+                                      start_year, end_year)
+        for band in band_grids:
+            band_cell = band_cells[band].get(grid_cell['index'])
+            if not band_cell or not band_cell['station_ids']:
+                continue
+            totals = anomaly_totals.get(band, new_anomaly_totals())
+            band_cell['anomalies'], band_cell['anomalies_monthly'] = \
+                get_totals_anomalies(totals, start_year, end_year)
+            year_ctr[band] += len(band_cell['anomalies_monthly'])
+            ctr[band] += len(band_cell['anomalies'])
+    percent = {}
+    for band in band_grids:
+        percent[band] = 0
+        if year_ctr[band] > 0:
+            percent[band] = int(year_ctr[band] * 100 / float(ctr[band]))
+    return percent
@@ -7,22 +7,31 @@ __email__ = "bob@libreserver.org"
 __status__ = "Production"
 __module_group__ = "Commandline Interface"
 
+from array import array
+from itertools import accumulate
+from stationData import QCFLAG_ERROR
+from stationData import get_row
+from stationData import get_year_rows
+
 
 def _get_baseline_for_year(id: str, stations_data: {}, year: int) -> []:
     """Returns the baseline for a given station id
     """
     baseline = [None] * 12
-    if year not in stations_data[id]:
+    row = get_row(stations_data, id, year)
+    if row is None:
         return baseline
-    month_data = stations_data[id][year]['month']
+    values = stations_data['values']
+    qcflags = stations_data['qcflag']
+    pos = row * 12
     for month_index in range(12):
-        month_data2 = month_data[month_index]
-        if month_data2['qcflag'] == 'M':
+        if qcflags[pos + month_index] == QCFLAG_ERROR:
             # Flagged as error
             continue
-        if month_data2['av'] > -80:
-            if month_data2['av'] < 80:
-                baseline[month_index] = month_data2['av']
+        value = values[pos + month_index]
+        if value > -80:
+            if value < 80:
+                baseline[month_index] = value
     return baseline
 
 
@@ -30,81 +39,241 @@ def _get_baseline(id: str, stations_data: {},
                   start_year: int, end_year: int) -> []:
     """Returns the baseline for a given station id
     """
-    if id not in stations_data:
+    if id not in stations_data['stations']:
         return [None] * 12
 
     if start_year == end_year:
         return _get_baseline_for_year(id, stations_data, start_year)
 
-    baseline = [0.0] * 12
+    # totals are kept in hundredths of a degree, as in the source data,
+    # so that they are exact and agree with the baseline index
+    values = stations_data['values']
+    qcflags = stations_data['qcflag']
+    totals = [0] * 12
     hits = [0] * 12
-    for year in range(start_year, end_year, 1):
-        if year not in stations_data[id]:
-            continue
-        month_data = stations_data[id][year]['month']
+    for row in get_year_rows(stations_data, id, start_year, end_year):
+        pos = row * 12
         for month_index in range(12):
-            month_data2 = month_data[month_index]
-            if month_data2['qcflag'] == 'M':
+            if qcflags[pos + month_index] == QCFLAG_ERROR:
                 # Flagged as error
                 continue
-            if month_data2['av'] > -80:
-                if month_data2['av'] < 80:
-                    baseline[month_index] += month_data2['av']
+            value = values[pos + month_index]
+            if value > -80:
+                if value < 80:
+                    totals[month_index] += round(value * 100)
                     hits[month_index] += 1
 
+    baseline = [None] * 12
     for month_index in range(12):
         if hits[month_index] > 0:
-            baseline[month_index] /= float(hits[month_index])
-        else:
-            baseline[month_index] = None
+            baseline[month_index] = \
+                totals[month_index] / (100.0 * hits[month_index])
     return baseline
 
 
-def _baseline_for_stations(stations_data: {}, station_locations: {},
-                           start_year: int, end_year: int,
-                           station_ids: set,
-                           min_latitude: float, max_latitude: float) -> []:
-    """Returns a baseline for the given range of years
-    and the given station ids
+def get_baseline_index(stations_data: {}) -> {}:
+    """Returns a baseline index for the station data. For each row and
+    month this holds the running total, in hundredths of a degree, and
+    number of valid values from the first row of the station, so that
+    the baseline for any range of years is the difference between two rows
     """
-    if not station_ids:
-        return [None] * 12, False
+    values = stations_data['values']
+    qcflags = stations_data['qcflag']
+    no_of_values = len(values)
+    totals = array('q', bytes(8 * no_of_values))
+    hits = array('H', bytes(2 * no_of_values))
+    for start_row, end_row in stations_data['stations'].values():
+        for month_index in range(12):
+            first = (start_row * 12) + month_index
+            last = end_row * 12
+            valid = [qcflag != QCFLAG_ERROR and value > -80 and value < 80
+                     for value, qcflag in zip(values[first:last:12],
+                                              qcflags[first:last:12])]
+            totals[first:last:12] = \
+                array('q', accumulate([round(value * 100) if is_valid else 0
+                                       for value, is_valid in
+                                       zip(values[first:last:12], valid)]))
+            hits[first:last:12] = array('H', accumulate(valid))
+    return {
+        'totals': totals,
+        'hits': hits
+    }
+
+
+def _get_indexed_baseline(baseline_index: {}, id: str, stations_data: {},
+                          start_year: int, end_year: int) -> []:
+    """Returns the baseline for a given station id using a baseline index
+    """
+    if id not in stations_data['stations']:
+        return [None] * 12
+
+    if start_year == end_year:
+        return _get_baseline_for_year(id, stations_data, start_year)
 
+    rows = get_year_rows(stations_data, id, start_year, end_year)
+    if not rows:
+        return [None] * 12
+    totals = baseline_index['totals']
+    hits = baseline_index['hits']
+    last_pos = (rows.stop - 1) * 12
+    before_pos = None
+    if rows.start > stations_data['stations'][id][0]:
+        before_pos = (rows.start - 1) * 12
+    baseline = [None] * 12
+    for month_index in range(12):
+        total = totals[last_pos + month_index]
+        month_hits = hits[last_pos + month_index]
+        if before_pos is not None:
+            total -= totals[before_pos + month_index]
+            month_hits -= hits[before_pos + month_index]
+        if month_hits > 0:
+            baseline[month_index] = total / (100.0 * month_hits)
+    return baseline
+
+
+def get_station_baseline(id: str, stations_data: {},
+                         start_year: int, end_year: int,
+                         baseline_index: {}) -> []:
+    """Returns the baseline for a given station id, using the
+    baseline index if there is one
+    """
+    if baseline_index:
+        return _get_indexed_baseline(baseline_index, id, stations_data,
+                                     start_year, end_year)
+    return _get_baseline(id, stations_data, start_year, end_year)
+
+
+def mean_baseline(station_baselines) -> []:
+    """Returns the mean of each month over the given station baselines,
+    or None for months without any values
+    """
     baseline = [0.0] * 12
     hits = [0] * 12
-    for sid in station_ids:
-        if station_locations[sid]['latitude'] < min_latitude or \
-           station_locations[sid]['latitude'] > max_latitude:
+    for station_baseline in station_baselines:
+        if not station_baseline:
             continue
-        station_baseline = \
-            _get_baseline(sid, stations_data, start_year, end_year)
         for month_index in range(12):
             if station_baseline[month_index] is not None:
                 baseline[month_index] += station_baseline[month_index]
                 hits[month_index] += 1
-
     for month_index in range(12):
         if hits[month_index] > 0:
             baseline[month_index] /= float(hits[month_index])
         else:
             baseline[month_index] = None
+    return baseline
 
-    return baseline, True
+
+def _baselines_for_stations(stations_data: {}, station_locations: {},
+                            windows: [], station_ids: set,
+                            min_latitude: float, max_latitude: float,
+                            baseline_index: {}) -> []:
+    """Returns baselines for each of the given (start year, end year)
+    windows and the given station ids
+    """
+    station_ids = [sid for sid in station_ids
+                   if min_latitude <= station_locations[sid]['latitude'] <=
+                   max_latitude]
+    return [mean_baseline(get_station_baseline(sid, stations_data,
+                                               window[0], window[1],
+                                               baseline_index)
+                          for sid in station_ids)
+            for window in windows]
+
+
+def baseline_for_stations(stations_data: {}, station_locations: {},
+                          start_year: int, end_year: int,
+                          station_ids: set,
+                          min_latitude: float, max_latitude: float,
+                          baseline_index: {} = None) -> []:
+    """Returns a baseline for the given range of years
+    and the given station ids
+    """
+    if not station_ids:
+        return [None] * 12, False
+
+    baselines = \
+        _baselines_for_stations(stations_data, station_locations,
+                                [(start_year, end_year)], station_ids,
+                                min_latitude, max_latitude, baseline_index)
+    return baselines[0], True
 
 
 def update_grid_baselines(grid: [], stations_data: {}, station_locations: {},
                           start_year: int, end_year: int,
-                          min_latitude: float, max_latitude: float) -> int:
+                          min_latitude: float, max_latitude: float,
+                          baseline_index: {} = None) -> int:
     """Calculates reference baselines for each grid cell
     """
     ctr = 0
     for grid_cell in grid:
         if grid_cell['station_ids']:
             grid_cell['baseline'], has_data = \
-                _baseline_for_stations(stations_data, station_locations,
-                                       start_year, end_year,
-                                       grid_cell['station_ids'],
-                                       min_latitude, max_latitude)
+                baseline_for_stations(stations_data, station_locations,
+                                      start_year, end_year,
+                                      grid_cell['station_ids'],
+                                      min_latitude, max_latitude,
+                                      baseline_index)
             if has_data:
                 ctr += 1
     return ctr
+
+
+def get_stations_baselines(stations_data: {},
+                           start_year: int, end_year: int,
+                           baseline_index: {} = None) -> {}:
+    """Returns the baseline of every station for the given range of years,
+    so that it can be reused by many grids and latitude ranges
+    """
+    station_baselines = {}
+    for sid in stations_data['stations']:
+        station_baselines[sid] = \
+            get_station_baseline(sid, stations_data,
+                                 start_year, end_year, baseline_index)
+    return station_baselines
+
+
+def update_grid_baselines_from_stations(grid: [], station_baselines: {},
+                                        station_locations: {},
+                                        min_latitude: float,
+                                        max_latitude: float) -> int:
+    """Calculates reference baselines for each grid cell from
+    previously calculated station baselines
+    """
+    ctr = 0
+    for grid_cell in grid:
+        if not grid_cell['station_ids']:
+            continue
+        station_ids = [sid for sid in grid_cell['station_ids']
+                       if min_latitude <=
+                       station_locations[sid]['latitude'] <= max_latitude]
+        grid_cell['baseline'] = \
+            mean_baseline(station_baselines.get(sid) for sid in station_ids)
+        ctr += 1
+    return ctr
+
+
+def get_grid_baselines(grid: [], stations_data: {}, station_locations: {},
+                       windows: [],
+                       min_latitude: float, max_latitude: float,
+                       baseline_index: {} = None) -> {}:
+    """Returns the baselines of each grid cell for many
+    (start year, end year) windows in a single pass over the stations.
+    The result is keyed by window, with a list containing the baseline
+    for each grid cell, or None for cells without stations
+    """
+    windows = [tuple(window) for window in windows]
+    result = {}
+    for window in windows:
+        result[window] = [None] * len(grid)
+    for grid_cell in grid:
+        if not grid_cell['station_ids']:
+            continue
+        baselines = \
+            _baselines_for_stations(stations_data, station_locations,
+                                    windows, grid_cell['station_ids'],
+                                    min_latitude, max_latitude,
+                                    baseline_index)
+        for window_index, window in enumerate(windows):
+            result[window][grid_cell['index']] = baselines[window_index]
+    return result
@@ -0,0 +1,245 @@
+__filename__ = "batch.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+from parseData import load_data
+from parseStations import load_stations
+from parseStations import assign_stations_to_grid
+from parseCache import load_data_cached
+from parseCache import load_baseline_index_cached
+from grid import get_grid
+from baseline import get_stations_baselines
+from baseline import update_grid_baselines_from_stations
+from anomaly import update_grid_anomalies
+from anomaly import get_global_anomalies
+from anomaly import plot_global_anomalies
+from anomaly import plot_monthly_anomalies
+
+# settings of each job, as the names of the commandline options
+JOB_SETTINGS = ('startYear', 'endYear', 'baselineStart', 'baselineEnd',
+                'cellsHorizontal', 'cellsVertical',
+                'minLatitude', 'maxLatitude', 'plot')
+
+# loaded data shared with the forked worker processes
+_BATCH = {}
+
+
+def load_job_file(filename: str) -> {}:
+    """Loads a JSON or TOML job file
+    """
+    try:
+        if filename.lower().endswith('.toml'):
+            if tomllib is None:
+                print('TOML job files need Python 3.11 or later')
+                return None
+            with open(filename, 'rb') as fp_jobs:
+                return tomllib.load(fp_jobs)
+        with open(filename, 'r', encoding='utf-8') as fp_jobs:
+            return json.loads(fp_jobs.read())
+    except OSError:
+        print('Unable to open ' + filename)
+    except ValueError:
+        # json and toml decode errors are both value errors
+        print('Invalid job file ' + filename)
+    return None
+
+
+def _job_directory_name(name: str) -> str:
+    """Returns a name which is safe to use as a directory
+    """
+    return ''.join(char if char.isalnum() or char in '-_.' else '_'
+                   for char in name).strip('.')
+
+
+def get_batch_jobs(job_file: {}, defaults: {}) -> []:
+    """Returns the list of jobs within a job file, with any settings
+    which are not given taken from the job file defaults and then from
+    the given defaults. Returns None if any job is invalid
+    """
+    jobs = []
+    file_defaults = job_file.get('defaults', {})
+    names = set()
+    for job_index, job_settings in enumerate(job_file.get('jobs', [])):
+        job = {}
+        for setting in JOB_SETTINGS:
+            job[setting] = \
+                job_settings.get(setting,
+                                 file_defaults.get(setting,
+                                                   defaults.get(setting)))
+        if job['plot'] is None:
+            job['plot'] = True
+        job['name'] = \
+            _job_directory_name(str(job_settings.get('name',
+                                                     'job' + str(job_index))))
+        if not job['name'] or job['name'] in names:
+            print('Job ' + str(job_index) + ' needs a unique name')
+            return None
+        names.add(job['name'])
+        if job['endYear'] <= job['startYear']:
+            print('Job ' + job['name'] + ': end year should be greater ' +
+                  'than ' + str(job['startYear']))
+            return None
+        if job['minLatitude'] >= job['maxLatitude']:
+            job['minLatitude'] = 0
+            job['maxLatitude'] = 90
+        jobs.append(job)
+    return jobs
+
+
+def _grid_key(job: {}) -> ():
+    """Returns the grid used by a job
+    """
+    return (job['cellsHorizontal'], job['cellsVertical'])
+
+
+def _baseline_key(job: {}) -> ():
+    """Returns the baseline window used by a job
+    """
+    return (job['baselineStart'], job['baselineEnd'])
+
+
+def _run_job(job_index: int) -> {}:
+    """Runs a single job using the shared data, returning a summary
+    """
+    start_time = time.perf_counter()
+    job = _BATCH['jobs'][job_index]
+    stations_data = _BATCH['stations_data']
+    grid, station_locations = _BATCH['grids'][_grid_key(job)]
+    ctr = update_grid_baselines_from_stations(
+        grid, _BATCH['station_baselines'][_baseline_key(job)],
+        station_locations, job['minLatitude'], job['maxLatitude'])
+    percent = update_grid_anomalies(grid, stations_data, station_locations,
+                                    job['startYear'], job['endYear'],
+                                    job['minLatitude'], job['maxLatitude'])
+    directory = os.path.join(_BATCH['output'], job['name'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if job['plot']:
+        plot_global_anomalies(grid, job['startYear'], job['endYear'],
+                              job['baselineStart'], job['baselineEnd'],
+                              job['minLatitude'], job['maxLatitude'],
+                              os.path.join(directory, 'global_anomalies'))
+        plot_monthly_anomalies(grid, job['endYear'] - 100, job['endYear'],
+                               job['baselineStart'], job['baselineEnd'],
+                               job['minLatitude'], job['maxLatitude'],
+                               os.path.join(directory, 'monthly_anomalies'))
+    return {
+        'name': job['name'],
+        'directory': directory,
+        'settings': job,
+        'baselines': ctr,
+        'percent': percent,
+        'global_anomalies':
+        get_global_anomalies(grid, job['startYear'], job['endYear']),
+        'time': time.perf_counter() - start_time
+    }
+
+
+def run_batch_jobs(jobs: [], stations: [], stations_data: {},
+                   output_directory: str, workers: int = 1,
+                   baseline_index: {} = None) -> []:
+    """Runs a list of jobs on already loaded stations and data, returning
+    a summary of each job. Jobs run in parallel when there is more than
+    one worker and processes can be forked
+    """
+    _BATCH.clear()
+    _BATCH['jobs'] = jobs
+    _BATCH['stations_data'] = stations_data
+    _BATCH['output'] = output_directory
+    _BATCH['grids'] = {}
+    _BATCH['station_baselines'] = {}
+    for job in jobs:
+        grid_key = _grid_key(job)
+        if grid_key not in _BATCH['grids']:
+            grid = get_grid(grid_key[0], grid_key[1])
+            _BATCH['grids'][grid_key] = \
+                (grid, assign_stations_to_grid(stations, grid))
+        baseline_key = _baseline_key(job)
+        if baseline_key not in _BATCH['station_baselines']:
+            _BATCH['station_baselines'][baseline_key] = \
+                get_stations_baselines(stations_data,
+                                       baseline_key[0], baseline_key[1],
+                                       baseline_index)
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    if workers > 1 and len(jobs) > 1 and \
+       'fork' in multiprocessing.get_all_start_methods():
+        # forked workers share the loaded data without pickling it
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context(
+                                     'fork')) as executor:
+            results = list(executor.map(_run_job, range(len(jobs))))
+    else:
+        results = [_run_job(job_index) for job_index in range(len(jobs))]
+    _BATCH.clear()
+    return results
+
+
+def run_batch(job_filename: str, defaults: {},
+              data_filename: str, stations_filename: str,
+              workers: int = 1, cache: bool = True) -> []:
+    """Runs the jobs within a job file, loading the stations and data once.
+    Returns a summary of each job, or None
+    """
+    job_file = load_job_file(job_filename)
+    if job_file is None:
+        return None
+    jobs = get_batch_jobs(job_file, defaults)
+    if not jobs:
+        print('No jobs within ' + job_filename)
+        return None
+    output_directory = job_file.get('output', 'batch')
+    workers = job_file.get('workers', workers)
+    print(str(len(jobs)) + ' jobs')
+
+    print('Loading station locations')
+    stations = load_stations(stations_filename)
+    if not stations:
+        print('No station locations')
+        return None
+    print('Loading data from ' + data_filename)
+    baseline_index = None
+    if cache:
+        stations_data = load_data_cached(data_filename, workers)
+        if stations_data:
+            baseline_index = \
+                load_baseline_index_cached(data_filename, stations_data)
+    else:
+        # only load the years which will be used
+        start_year = min(min(job['startYear'], job['baselineStart'])
+                         for job in jobs)
+        end_year = max(max(job['endYear'], job['baselineEnd'])
+                       for job in jobs)
+        stations_data = load_data(data_filename, workers,
+                                  start_year, end_year)
+    if not stations_data:
+        print('No data')
+        return None
+
+    results = run_batch_jobs(jobs, stations, stations_data,
+                             output_directory, workers, baseline_index)
+    for result in results:
+        print(result['name'] + ': ' + str(result['baselines']) +
+              ' grid baselines updated, ' + str(result['percent']) +
+              '% grid anomalies updated in ' +
+              ('%.2f' % result['time']) + ' seconds')
+    summary_filename = os.path.join(output_directory, 'batch.json')
+    with open(summary_filename, 'w+', encoding='utf-8') as fp_summary:
+        fp_summary.write(json.dumps(results, indent=2) + '\n')
+    print('Batch summary saved to ' + summary_filename)
+    return results
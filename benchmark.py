@@ -0,0 +1,243 @@
+__filename__ = "benchmark.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+from parseData import load_data
+from parseStations import load_station_locations
+from parseStations import save_station_locations_as_kml
+from parseCountries import load_countries
+from grid import get_grid
+from grid import save_grid_as_kml
+from gridPyramid import parse_resolutions
+from baseline import update_grid_baselines
+from anomaly import update_grid_anomalies
+from anomaly import get_global_anomalies
+from anomaly import get_monthly_anomalies
+
+BENCHMARK_COUNTRIES = {
+    'AU': 'Australia',
+    'BR': 'Brazil',
+    'CA': 'Canada',
+    'FR': 'France',
+    'IN': 'India',
+    'UK': 'United Kingdom',
+    'US': 'United States',
+    'ZA': 'South Africa'
+}
+
+
+def _synthetic_data_line(rand, sid: str, year: int, latitude: float,
+                         gap_ratio: float, flag_ratio: float) -> str:
+    """Returns a line of synthetic monthly data for a station year
+    """
+    line = sid + str(year) + 'TAVG'
+    for month_index in range(12):
+        if rand.random() < gap_ratio:
+            value = -9999
+        else:
+            # seasonal cycle which reverses between hemispheres,
+            # with a warming trend
+            season = 1000 if month_index in (5, 6, 7) else -500
+            if latitude < 0:
+                season = -season
+            value = int(rand.gauss(2500 - abs(latitude) * 40 + season +
+                                   (year - 1900) * 1.5, 300))
+            value = max(-7000, min(7000, value))
+        qcflag = 'M' if rand.random() < flag_ratio else ' '
+        # the flags are read starting one column after the value
+        line += str(value).rjust(5) + '  ' + qcflag
+    return line
+
+
+def generate_dataset(directory: str, no_of_stations: int = 1000,
+                     start_year: int = 1880, end_year: int = 2024,
+                     gap_ratio: float = 0.05, flag_ratio: float = 0.02,
+                     seed: int = 1) -> {}:
+    """Writes a synthetic dataset of data, station and country files
+    into the given directory and returns their filenames.
+    gap_ratio is the proportion of missing monthly values, and whole
+    years are missing at the same ratio.
+    flag_ratio is the proportion of monthly values flagged as errors
+    """
+    rand = random.Random(seed)
+    country_codes = sorted(BENCHMARK_COUNTRIES.keys())
+    filenames = {
+        'data': os.path.join(directory, 'v4.mean'),
+        'stations': os.path.join(directory, 'wmo.txt'),
+        'countries': os.path.join(directory, 'v4.country.codes')
+    }
+    with open(filenames['countries'], 'w+',
+              encoding='utf-8') as fp_countries:
+        for code in country_codes:
+            fp_countries.write(code + ' ' + BENCHMARK_COUNTRIES[code] + '\n')
+    with open(filenames['stations'], 'w+', encoding='utf-8') as fp_inv, \
+         open(filenames['data'], 'w+', encoding='utf-8') as fp_data:
+        for station_index in range(no_of_stations):
+            sid = rand.choice(country_codes) + 'M' + \
+                str(station_index).zfill(7) + '0'
+            latitude = rand.uniform(-90, 90)
+            longitude = rand.uniform(-180, 180)
+            fp_inv.write(sid + ' ' + ('%8.4f' % latitude) + ' ' +
+                         ('%9.4f' % longitude) + ' ' +
+                         ('%6.1f' % rand.uniform(0, 3000)) + ' ' +
+                         'STATION ' + str(station_index) + '\n')
+            first_year = rand.randint(start_year, (start_year + end_year) // 2)
+            last_year = rand.randint(first_year, end_year)
+            for year in range(first_year, last_year + 1):
+                if rand.random() < gap_ratio:
+                    continue
+                fp_data.write(_synthetic_data_line(rand, sid, year, latitude,
+                                                   gap_ratio, flag_ratio) +
+                              '\n')
+    return filenames
+
+
+def _time_stage(timings: {}, stage: str, repeats: int, function, *args):
+    """Calls a function the given number of times, recording the fastest
+    time for the stage in seconds, and returns the last result
+    """
+    result = None
+    for _ in range(max(repeats, 1)):
+        start_time = time.perf_counter()
+        result = function(*args)
+        duration = time.perf_counter() - start_time
+        if stage not in timings or duration < timings[stage]:
+            timings[stage] = duration
+    return result
+
+
+def run_benchmarks(filenames: {}, resolutions: [],
+                   start_year: int = 1900, end_year: int = 2024,
+                   baseline_start: int = 1961, baseline_end: int = 1990,
+                   repeats: int = 1, workers: int = 1) -> {}:
+    """Times each stage of the pipeline for the given dataset and
+    grid resolutions, returning the timings in seconds
+    """
+    timings = {}
+    _time_stage(timings, 'load_countries', repeats,
+                load_countries, filenames['countries'])
+    stations_data = _time_stage(timings, 'load_data', repeats,
+                                load_data, filenames['data'], workers)
+    results = {
+        'stages': timings,
+        'resolutions': {}
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for cells_horizontal, cells_vertical in resolutions:
+            timings = {}
+            _time_stage(timings, 'get_grid', repeats,
+                        get_grid, cells_horizontal, cells_vertical)
+            for _ in range(max(repeats, 1)):
+                # loading assigns the stations to the cells of a new grid
+                grid = get_grid(cells_horizontal, cells_vertical)
+                station_locations = \
+                    _time_stage(timings, 'load_station_locations', 1,
+                                load_station_locations,
+                                filenames['stations'], grid)
+            _time_stage(timings, 'update_grid_baselines', repeats,
+                        update_grid_baselines, grid, stations_data,
+                        station_locations, baseline_start, baseline_end,
+                        -90, 90)
+            _time_stage(timings, 'update_grid_anomalies', repeats,
+                        update_grid_anomalies, grid, stations_data,
+                        station_locations, start_year, end_year, -90, 90)
+            _time_stage(timings, 'get_global_anomalies', repeats,
+                        get_global_anomalies, grid, start_year, end_year)
+            _time_stage(timings, 'get_monthly_anomalies', repeats,
+                        get_monthly_anomalies, grid, start_year, end_year)
+            _time_stage(timings, 'save_station_locations_as_kml', repeats,
+                        save_station_locations_as_kml, station_locations,
+                        os.path.join(temp_dir, 'stations.kml'))
+            _time_stage(timings, 'save_grid_as_kml', repeats,
+                        save_grid_as_kml, grid,
+                        os.path.join(temp_dir, 'grid.kml'))
+            resolution = str(cells_horizontal) + 'x' + str(cells_vertical)
+            results['resolutions'][resolution] = {
+                'cells': len(grid),
+                'stages': timings
+            }
+    return results
+
+
+def main() -> None:
+    """Generates a synthetic dataset and writes the benchmark results
+    as JSON
+    """
+    parser = argparse.ArgumentParser(description='tempgraph2 benchmarks')
+    parser.add_argument('--stations', type=int, default=1000,
+                        help='Number of synthetic stations')
+    parser.add_argument('--start', dest='startYear', type=int,
+                        default=1880,
+                        help='First year of the synthetic data')
+    parser.add_argument('--end', dest='endYear', type=int,
+                        default=2024,
+                        help='Last year of the synthetic data')
+    parser.add_argument('--gaps', type=float, default=0.05,
+                        help='Proportion of missing years and months')
+    parser.add_argument('--flags', type=float, default=0.02,
+                        help='Proportion of months flagged as errors')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed for the synthetic data')
+    parser.add_argument('--resolutions', type=str, default='72x36,36x18',
+                        help='Grid resolutions to benchmark, ' +
+                        'such as 72x36,36x18')
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='Number of times each stage is run, ' +
+                        'keeping the fastest')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to parse the data')
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='Filename for the JSON results, ' +
+                        'otherwise they are shown')
+    args = parser.parse_args()
+
+    resolutions = parse_resolutions(args.resolutions)
+    if not resolutions:
+        print('Invalid grid resolutions ' + args.resolutions)
+        sys.exit()
+
+    dataset = {
+        'stations': args.stations,
+        'start_year': args.startYear,
+        'end_year': args.endYear,
+        'gap_ratio': args.gaps,
+        'flag_ratio': args.flags,
+        'seed': args.seed
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filenames = generate_dataset(temp_dir, args.stations,
+                                     args.startYear, args.endYear,
+                                     args.gaps, args.flags, args.seed)
+        dataset['data_bytes'] = os.path.getsize(filenames['data'])
+        results = run_benchmarks(filenames, resolutions,
+                                 max(args.startYear, 1900), args.endYear,
+                                 repeats=args.repeats, workers=args.workers)
+    results['version'] = __version__
+    results['python'] = platform.python_version()
+    results['dataset'] = dataset
+    results['workers'] = args.workers
+    results['repeats'] = args.repeats
+    results_str = json.dumps(results, indent=2, sort_keys=True)
+    if not args.output:
+        print(results_str)
+        return
+    with open(args.output, 'w+', encoding='utf-8') as fp_results:
+        fp_results.write(results_str + '\n')
+    print('Benchmark results saved to ' + args.output)
+
+
+if __name__ == "__main__":
+    main()
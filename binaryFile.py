@@ -0,0 +1,110 @@
+__filename__ = "binaryFile.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import os
+import sys
+import json
+import mmap
+
+BINARY_FILE_MAGIC = b'TGRAPH2\n'
+
+
+def _align(position: int) -> int:
+    """Returns the next 8 byte boundary
+    """
+    return (position + 7) & ~7
+
+
+def save_binary_file(filename: str, header: {}, arrays: {}) -> bool:
+    """Saves a header and a dict of arrays to a binary file.
+    The arrays may be anything supporting the buffer protocol. They are
+    saved in native byte order after a json header, each starting on an
+    8 byte boundary, so that they can be memory mapped
+    """
+    array_entries = {}
+    for name, arr in arrays.items():
+        view = memoryview(arr)
+        array_entries[name] = {
+            'typecode': view.format,
+            'itemsize': view.itemsize,
+            'length': view.nbytes // view.itemsize
+        }
+    header = header.copy()
+    header['byteorder'] = sys.byteorder
+    header['arrays'] = array_entries
+
+    # offsets depend upon the header length, which depends upon
+    # the offsets, so reserve some space for the offset digits growing
+    reserved = 0
+    while True:
+        position = _align(16 + reserved)
+        for name, arr in arrays.items():
+            array_entries[name]['offset'] = position
+            position = _align(position + memoryview(arr).nbytes)
+        header_bytes = json.dumps(header).encode('utf-8')
+        if len(header_bytes) <= reserved:
+            break
+        reserved = len(header_bytes) + 64
+
+    temp_filename = filename + '.new'
+    try:
+        with open(temp_filename, 'wb') as fp_bin:
+            fp_bin.write(BINARY_FILE_MAGIC)
+            fp_bin.write(len(header_bytes).to_bytes(8, 'little'))
+            fp_bin.write(header_bytes)
+            for name, arr in arrays.items():
+                fp_bin.seek(array_entries[name]['offset'])
+                fp_bin.write(memoryview(arr).cast('B'))
+            fp_bin.truncate(position)
+        os.replace(temp_filename, filename)
+    except OSError:
+        print('Unable to save ' + filename)
+        return False
+    return True
+
+
+def load_binary_file_header(filename: str) -> {}:
+    """Returns the header of a binary file without reading the arrays
+    """
+    try:
+        with open(filename, 'rb') as fp_bin:
+            if fp_bin.read(8) != BINARY_FILE_MAGIC:
+                return None
+            header_length = int.from_bytes(fp_bin.read(8), 'little')
+            header = json.loads(fp_bin.read(header_length).decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+    if header.get('byteorder') != sys.byteorder:
+        return None
+    return header
+
+
+def load_binary_file(filename: str) -> ({}, {}):
+    """Memory maps a binary file, returning its header and
+    a dict of read only arrays
+    """
+    header = load_binary_file_header(filename)
+    if header is None:
+        return None, None
+    try:
+        with open(filename, 'rb') as fp_bin:
+            if os.fstat(fp_bin.fileno()).st_size == 0:
+                return None, None
+            mapped = mmap.mmap(fp_bin.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None, None
+    view = memoryview(mapped)
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        start = entry['offset']
+        end = start + (entry['length'] * entry['itemsize'])
+        if end > len(mapped):
+            return None, None
+        arrays[name] = view[start:end].cast(entry['typecode'])
+    return header, arrays
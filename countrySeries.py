@@ -0,0 +1,106 @@
+__filename__ = "countrySeries.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+from bands import update_band_baselines
+from bands import update_band_anomalies
+
+# number of characters at the start of a station id giving its country
+COUNTRY_CODE_LENGTH = 2
+
+
+def parse_country_codes(codes_str: str, countries: {}) -> []:
+    """Parses a list of country codes such as US,UK,FR, or all,
+    returning None if any code is not within the country table
+    """
+    if codes_str.strip().lower() == 'all':
+        return sorted(countries.keys())
+    codes = []
+    for code in codes_str.split(','):
+        code = code.strip().upper()
+        if not code:
+            continue
+        if code not in countries:
+            return None
+        if code not in codes:
+            codes.append(code)
+    return codes
+
+
+def get_station_countries(station_locations: {}, country_codes: []) -> {}:
+    """Returns the country of each station within the given countries,
+    as a list so that it can be used in the same way as latitude bands
+    """
+    wanted = set(country_codes)
+    station_countries = {}
+    for sid in station_locations:
+        code = sid[:COUNTRY_CODE_LENGTH]
+        if code in wanted:
+            station_countries[sid] = [code]
+    return station_countries
+
+
+def get_country_index(grid: [], station_countries: {}) -> {}:
+    """Returns the station ids and grid cell indexes of each country
+    """
+    country_index = {}
+    for grid_cell in grid:
+        for sid in grid_cell['station_ids']:
+            for code in station_countries.get(sid, []):
+                if code not in country_index:
+                    country_index[code] = {
+                        'station_ids': set(),
+                        'cells': set()
+                    }
+                country_index[code]['station_ids'].add(sid)
+                country_index[code]['cells'].add(grid_cell['index'])
+    return country_index
+
+
+def get_country_grids(grid: [], country_index: {},
+                      station_countries: {}) -> {}:
+    """Returns a grid for each country, containing only the grid cells
+    with stations in the country, and only the stations of the country
+    """
+    country_grids = {}
+    for code, item in country_index.items():
+        country_grids[code] = []
+        for index in sorted(item['cells']):
+            country_cell = grid[index].copy()
+            country_cell['station_ids'] = \
+                set(sid for sid in grid[index]['station_ids']
+                    if code in station_countries.get(sid, []))
+            country_grids[code].append(country_cell)
+    return country_grids
+
+
+def update_country_anomalies(grid: [], country_grids: {},
+                             station_countries: {}, stations_data: {},
+                             start_year: int, end_year: int,
+                             baseline_start: int, baseline_end: int,
+                             baseline_index: {} = None) -> {}:
+    """Calculates the baselines and anomalies of the grid cells of every
+    country. Returns the percentage of grid anomalies updated for each
+    country
+    """
+    update_band_baselines(grid, country_grids, station_countries,
+                          stations_data, baseline_start, baseline_end,
+                          baseline_index)
+    return update_band_anomalies(grid, country_grids, station_countries,
+                                 stations_data, start_year, end_year)
+
+
+def country_series_name(code: str, countries: {}) -> str:
+    """Returns a name for the series of a country, from its name within
+    the country table, suitable for filenames
+    """
+    name = ''.join(char if char.isalnum() else '_'
+                   for char in countries.get(code, code).lower())
+    while '__' in name:
+        name = name.replace('__', '_')
+    return code + '_' + name.strip('_')
@@ -0,0 +1,137 @@
+__filename__ = "elements.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+from baseline import get_station_baseline
+from baseline import mean_baseline
+from anomaly import new_anomaly_totals
+from anomaly import add_station_anomalies
+from anomaly import get_totals_anomalies
+
+# length of the element field of a data line
+ELEMENT_LENGTH = 4
+
+
+def parse_elements(elements_str: str) -> []:
+    """Parses a list of elements such as TAVG,TMAX,TMIN
+    """
+    elements = []
+    for element in elements_str.split(','):
+        element = element.strip().upper()
+        if not element:
+            continue
+        if len(element) != ELEMENT_LENGTH or not element.isalnum():
+            return None
+        if element not in elements:
+            elements.append(element)
+    if not elements:
+        return None
+    return elements
+
+
+def get_element_grids(grid: [], elements_data: {}) -> {}:
+    """Returns a grid for each element with data, with the same
+    stations assigned to each grid cell
+    """
+    element_grids = {}
+    for element in elements_data:
+        element_grids[element] = []
+        for grid_cell in grid:
+            element_cell = grid_cell.copy()
+            element_cell['station_ids'] = grid_cell['station_ids']
+            element_grids[element].append(element_cell)
+    return element_grids
+
+
+def _cell_station_ids(grid_cell: {}, station_locations: {},
+                      min_latitude: float, max_latitude: float) -> []:
+    """Returns the stations of a grid cell within the latitude range
+    """
+    station_ids = []
+    for sid in grid_cell['station_ids']:
+        latitude = station_locations[sid]['latitude']
+        if latitude < min_latitude or latitude > max_latitude:
+            continue
+        station_ids.append(sid)
+    return station_ids
+
+
+def update_element_baselines(grid: [], element_grids: {},
+                             elements_data: {}, station_locations: {},
+                             start_year: int, end_year: int,
+                             min_latitude: float, max_latitude: float,
+                             baseline_indexes: {} = None) -> {}:
+    """Calculates reference baselines for each grid cell of every element.
+    baseline_indexes may contain a baseline index for each element.
+    Returns the number of grid baselines updated for each element
+    """
+    if baseline_indexes is None:
+        baseline_indexes = {}
+    ctr = {}
+    for element in element_grids:
+        ctr[element] = 0
+    for grid_cell in grid:
+        if not grid_cell['station_ids']:
+            continue
+        station_ids = _cell_station_ids(grid_cell, station_locations,
+                                        min_latitude, max_latitude)
+        for element, element_grid in element_grids.items():
+            stations_data = elements_data[element]
+            station_baselines = \
+                [get_station_baseline(sid, stations_data,
+                                      start_year, end_year,
+                                      baseline_indexes.get(element))
+                 for sid in station_ids if sid in stations_data['stations']]
+            element_grid[grid_cell['index']]['baseline'] = \
+                mean_baseline(station_baselines)
+            ctr[element] += 1
+    return ctr
+
+
+def update_element_anomalies(grid: [], element_grids: {},
+                             elements_data: {}, station_locations: {},
+                             start_year: int, end_year: int,
+                             min_latitude: float, max_latitude: float) -> {}:
+    """Calculates anomalies for each grid cell of every element within a
+    range of years, in a single pass over the stations of each cell.
+    Returns the percentage of grid anomalies updated for each element
+    """
+    ctr = {}
+    year_ctr = {}
+    for element, element_grid in element_grids.items():
+        ctr[element] = 0
+        year_ctr[element] = 0
+        for element_cell in element_grid:
+            element_cell['anomalies'] = {}
+            element_cell['anomalies_monthly'] = {}
+    for grid_cell in grid:
+        if not grid_cell['station_ids']:
+            continue
+        station_ids = _cell_station_ids(grid_cell, station_locations,
+                                        min_latitude, max_latitude)
+        for element, element_grid in element_grids.items():
+            stations_data = elements_data[element]
+            element_cell = element_grid[grid_cell['index']]
+            anomaly_totals = new_anomaly_totals()
+            for sid in station_ids:
+                if sid not in stations_data['stations']:
+                    continue
+                add_station_anomalies(anomaly_totals, stations_data, sid,
+                                      element_cell['baseline'],
+                                      start_year, end_year)
+            element_cell['anomalies'], element_cell['anomalies_monthly'] = \
+                get_totals_anomalies(anomaly_totals, start_year, end_year)
+            year_ctr[element] += len(element_cell['anomalies_monthly'])
+            ctr[element] += len(element_cell['anomalies'])
+    percent = {}
+    for element in element_grids:
+        percent[element] = 0
+        if year_ctr[element] > 0:
+            percent[element] = int(year_ctr[element] * 100 /
+                                   float(ctr[element]))
+    return percent
@@ -0,0 +1,150 @@
+__filename__ = "gnuplotRenderer.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import queue
+import threading
+import subprocess
+
+GNUPLOT_COMMAND = 'gnuplot'
+
+# printed by gnuplot after each script has been rendered
+PLOT_DONE_MARKER = 'tempgraph2 plot done'
+
+
+def _start_gnuplot(command: str):
+    """Starts a gnuplot process which reads scripts from a pipe,
+    or returns None if gnuplot is not available
+    """
+    try:
+        return subprocess.Popen([command], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                text=True, bufsize=1)
+    except OSError:
+        return None
+
+
+def _stop_gnuplot(process) -> None:
+    """Stops a gnuplot process
+    """
+    try:
+        process.stdin.write('exit\n')
+        process.stdin.close()
+    except OSError:
+        pass
+    process.wait()
+
+
+def _render_with_process(process, script: str) -> bool:
+    """Renders a script with a running gnuplot process and waits until
+    the output has been written
+    """
+    try:
+        process.stdin.write(script + '\n' +
+                            'set output\n' +
+                            'set print "-"\n' +
+                            'print "' + PLOT_DONE_MARKER + '"\n')
+        process.stdin.flush()
+        while True:
+            line = process.stdout.readline()
+            if not line:
+                # gnuplot has exited
+                return False
+            if line.strip() == PLOT_DONE_MARKER:
+                return True
+    except OSError:
+        return False
+
+
+def _renderer_worker(renderer: {}) -> None:
+    """Renders scripts from the queue until told to stop
+    """
+    process = None
+    while True:
+        script = renderer['queue'].get()
+        if script is None:
+            renderer['queue'].task_done()
+            break
+        if process is None:
+            process = _start_gnuplot(renderer['command'])
+        if process is None:
+            with renderer['lock']:
+                renderer['failed'] += 1
+                if not renderer['warned']:
+                    print('Unable to run ' + renderer['command'])
+                    renderer['warned'] = True
+        elif _render_with_process(process, script):
+            with renderer['lock']:
+                renderer['rendered'] += 1
+        else:
+            with renderer['lock']:
+                renderer['failed'] += 1
+            # start a new gnuplot process for the next script
+            _stop_gnuplot(process)
+            process = None
+        renderer['queue'].task_done()
+    if process is not None:
+        _stop_gnuplot(process)
+
+
+def new_renderer(workers: int = 1, command: str = GNUPLOT_COMMAND) -> {}:
+    """Returns a renderer with the given number of gnuplot processes
+    """
+    renderer = {
+        'command': command,
+        'queue': queue.Queue(),
+        'lock': threading.Lock(),
+        'rendered': 0,
+        'failed': 0,
+        'warned': False,
+        'threads': []
+    }
+    for _ in range(max(workers, 1)):
+        thread = threading.Thread(target=_renderer_worker,
+                                  args=(renderer,), daemon=True)
+        thread.start()
+        renderer['threads'].append(thread)
+    return renderer
+
+
+def queue_plot(renderer: {}, script: str) -> None:
+    """Adds a gnuplot script to the queue of plots to be rendered
+    """
+    renderer['queue'].put(script)
+
+
+def finish_renderer(renderer: {}) -> int:
+    """Waits until all queued plots have been rendered and stops
+    the gnuplot processes. Returns the number of plots rendered
+    """
+    for _ in renderer['threads']:
+        renderer['queue'].put(None)
+    for thread in renderer['threads']:
+        thread.join()
+    renderer['threads'] = []
+    return renderer['rendered']
+
+
+def gnuplot_escape(text: str) -> str:
+    """Escapes text to be placed within a double quoted gnuplot string
+    """
+    return text.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def render_plot(script: str, renderer: {} = None) -> None:
+    """Renders a gnuplot script, either by adding it to the queue of
+    a renderer or, if there is no renderer, by running gnuplot once
+    """
+    if renderer is not None:
+        queue_plot(renderer, script)
+        return
+    try:
+        subprocess.run([GNUPLOT_COMMAND], input=script, text=True,
+                       check=False)
+    except OSError:
+        print('Unable to run ' + GNUPLOT_COMMAND)
@@ -8,6 +8,13 @@ __status__ = "Production"
 __module_group__ = "Commandline Interface"
 
 import math
+from functools import lru_cache
+from kml import open_kml
+from kml import write_kml_placemark
+from kml import close_kml
+
+MONTH_NAMES = ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+               'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
 
 
 def _3d_to_lat_long(x_co: float, y_co: float, z_co: float) -> (float, float):
@@ -18,8 +25,8 @@ def _3d_to_lat_long(x_co: float, y_co: float, z_co: float) -> (float, float):
     return latitude, longitude
 
 
-def _lat_long_to_3d(longitude: float,
-                    latitude: float) -> (float, float, float):
+def lat_long_to_3d(longitude: float,
+                   latitude: float) -> (float, float, float):
     """Convert latitude and longitude into a 3D point
     """
     lng = longitude * math.pi / 180.0
@@ -30,12 +37,179 @@ def _lat_long_to_3d(longitude: float,
     return x_co, y_co, z_co
 
 
-def get_closest_grid_index(longitude: float, latitude: float, grid: []) -> int:
-    """Returns the closest grid cell index
+def get_spatial_index(points: [], bucket_size: float) -> {}:
+    """Returns a spatial index for a list of 3D points on the unit sphere.
+    Points are hashed into cubic buckets of the given size
+    """
+    buckets = {}
+    for idx, point in enumerate(points):
+        key = (math.floor(point[0] / bucket_size),
+               math.floor(point[1] / bucket_size),
+               math.floor(point[2] / bucket_size))
+        if key not in buckets:
+            buckets[key] = []
+        buckets[key].append(idx)
+    return {
+        'points': points,
+        'bucket_size': bucket_size,
+        'buckets': buckets,
+        # beyond this many rings of buckets the whole sphere is covered
+        'max_ring': int(2 / bucket_size) + 2
+    }
+
+
+def get_grid_spatial_index(grid: []) -> {}:
+    """Returns a spatial index for the points of the grid, with buckets
+    about the size of the spacing between grid points
+    """
+    points = [(grid_cell['x'], grid_cell['y'], grid_cell['z'])
+              for grid_cell in grid]
+    bucket_size = math.sqrt(4 * math.pi / max(len(grid), 1))
+    return get_spatial_index(points, min(bucket_size, 1.0))
+
+
+@lru_cache(maxsize=None)
+def bucket_shell_offsets(ring: int) -> ():
+    """Returns the bucket offsets at the given ring distance
+    """
+    offsets = []
+    for offset_x in range(-ring, ring + 1):
+        for offset_y in range(-ring, ring + 1):
+            for offset_z in range(-ring, ring + 1):
+                if max(abs(offset_x), abs(offset_y), abs(offset_z)) == ring:
+                    offsets.append((offset_x, offset_y, offset_z))
+    return tuple(offsets)
+
+
+def get_closest_point_index(spatial_index: {},
+                            x_co: float, y_co: float, z_co: float) -> int:
+    """Returns the index of the closest point within a spatial index.
+    Rings of buckets are searched outwards from the bucket containing
+    the given coordinate, until no unsearched point could be closer.
+    Ties go to the lowest index
+    """
+    points = spatial_index['points']
+    buckets = spatial_index['buckets']
+    bucket_size = spatial_index['bucket_size']
+    key = (math.floor(x_co / bucket_size),
+           math.floor(y_co / bucket_size),
+           math.floor(z_co / bucket_size))
+    closest_index = None
+    min_dist_sqr = 0
+    for ring in range(spatial_index['max_ring'] + 1):
+        for offset_x, offset_y, offset_z in bucket_shell_offsets(ring):
+            bucket = buckets.get((key[0] + offset_x, key[1] + offset_y,
+                                  key[2] + offset_z))
+            if not bucket:
+                continue
+            for idx in bucket:
+                point = points[idx]
+                dx1 = x_co - point[0]
+                dist = dx1 * dx1
+                dy1 = y_co - point[1]
+                dist += dy1 * dy1
+                dz1 = z_co - point[2]
+                dist += dz1 * dz1
+                if closest_index is None or dist < min_dist_sqr or \
+                   (dist == min_dist_sqr and idx < closest_index):
+                    closest_index = idx
+                    min_dist_sqr = dist
+        # unsearched points are at least this far away
+        search_radius = ring * bucket_size
+        if closest_index is not None and \
+           min_dist_sqr < search_radius * search_radius:
+            break
+    return closest_index
+
+
+def get_nearest_point_indexes(spatial_index: {},
+                              x_co: float, y_co: float, z_co: float,
+                              no_of_points: int, exclude: int = None) -> []:
+    """Returns the indexes of the given number of closest points within
+    a spatial index, closest first, optionally excluding one point.
+    Rings of buckets are searched outwards until no unsearched point
+    could be closer than the furthest one found. Ties go to the lowest
+    index
+    """
+    if no_of_points <= 0:
+        return []
+    points = spatial_index['points']
+    buckets = spatial_index['buckets']
+    bucket_size = spatial_index['bucket_size']
+    key = (math.floor(x_co / bucket_size),
+           math.floor(y_co / bucket_size),
+           math.floor(z_co / bucket_size))
+    nearest = []
+    for ring in range(spatial_index['max_ring'] + 1):
+        for offset_x, offset_y, offset_z in bucket_shell_offsets(ring):
+            bucket = buckets.get((key[0] + offset_x, key[1] + offset_y,
+                                  key[2] + offset_z))
+            if not bucket:
+                continue
+            for idx in bucket:
+                if idx == exclude:
+                    continue
+                point = points[idx]
+                dx1 = x_co - point[0]
+                dy1 = y_co - point[1]
+                dz1 = z_co - point[2]
+                nearest.append((dx1 * dx1 + dy1 * dy1 + dz1 * dz1, idx))
+        if len(nearest) >= no_of_points:
+            nearest.sort()
+            del nearest[no_of_points:]
+            # unsearched points are at least this far away
+            search_radius = ring * bucket_size
+            if nearest[-1][0] < search_radius * search_radius:
+                break
+    nearest.sort()
+    return [idx for _, idx in nearest[:no_of_points]]
+
+
+def get_points_within_distance(spatial_index: {},
+                               x_co: float, y_co: float, z_co: float,
+                               max_dist: float) -> []:
+    """Returns the indexes of the points within a spatial index which are
+    within the given straight line distance, in ascending order
+    """
+    points = spatial_index['points']
+    buckets = spatial_index['buckets']
+    bucket_size = spatial_index['bucket_size']
+    key = (math.floor(x_co / bucket_size),
+           math.floor(y_co / bucket_size),
+           math.floor(z_co / bucket_size))
+    max_dist_sqr = max_dist * max_dist
+    within = []
+    no_of_rings = min(math.ceil(max_dist / bucket_size),
+                      spatial_index['max_ring'])
+    for ring in range(no_of_rings + 1):
+        for offset_x, offset_y, offset_z in bucket_shell_offsets(ring):
+            bucket = buckets.get((key[0] + offset_x, key[1] + offset_y,
+                                  key[2] + offset_z))
+            if not bucket:
+                continue
+            for idx in bucket:
+                point = points[idx]
+                dx1 = x_co - point[0]
+                dy1 = y_co - point[1]
+                dz1 = z_co - point[2]
+                if dx1 * dx1 + dy1 * dy1 + dz1 * dz1 <= max_dist_sqr:
+                    within.append(idx)
+    within.sort()
+    return within
+
+
+def get_closest_grid_index(longitude: float, latitude: float, grid: [],
+                           spatial_index: {} = None) -> int:
+    """Returns the closest grid cell index.
+    If a spatial index for the grid is given then it is used
+    rather than checking every grid cell
     """
     cell_index = 0
 
-    x_co, y_co, z_co = _lat_long_to_3d(longitude, latitude)
+    x_co, y_co, z_co = lat_long_to_3d(longitude, latitude)
+
+    if spatial_index:
+        return get_closest_point_index(spatial_index, x_co, y_co, z_co)
 
     dx1 = x_co - grid[0]['x']
     dy1 = y_co - grid[0]['y']
@@ -89,26 +263,47 @@ def get_grid(cells_horizontal: int, cells_vertical: int) -> []:
     return grid_cells
 
 
-def save_grid_as_kml(grid: [], filename: str) -> None:
-    """Save the grid points in KML format for visualization
+def save_grid_as_kml(grid: [], filename: str,
+                     with_anomalies: bool = False) -> None:
+    """Save the grid points in KML format for visualization.
+    If the filename ends with .kmz then it is saved as a zipped KML file.
+    If with_anomalies is true then the baseline of each cell is added as
+    extended data, and the anomalies of each year are added as
+    placemarks with a time span, so that they can be animated
     """
-    kml_str = \
-        "<?xml version=\"1.0\" encoding='UTF-8'?>\n" + \
-        "<kml xmlns=\"http://www.opengis.net/kml/2.2\">\n" + \
-        "<Document>\n"
+    kml = open_kml(filename)
+    if not kml:
+        return
     for grid_cell in grid:
-        kml_str += \
-            "  <Placemark>\n" + \
-            "    <name>" + str(grid_cell['index']) + "</name>\n" + \
-            "    <description>" + str(grid_cell['latitude']) + \
-            ' ' + str(grid_cell['longitude']) + '</description>\n' + \
-            "    <Point>\n" + \
-            "      <coordinates>" + str(grid_cell['longitude']) + "," + \
-            str(grid_cell['latitude']) + ",0</coordinates>\n" + \
-            "    </Point>\n" + \
-            "  </Placemark>\n"
-    kml_str += \
-        "</Document>\n" + \
-        "</kml>\n"
-    with open(filename, 'w+', encoding='utf-8') as fp_kml:
-        fp_kml.write(kml_str)
+        extended_data = None
+        if with_anomalies and grid_cell.get('baseline'):
+            extended_data = {}
+            for month_index, value in enumerate(grid_cell['baseline']):
+                if value is not None:
+                    extended_data['baseline_' + MONTH_NAMES[month_index]] = \
+                        value
+        write_kml_placemark(kml, grid_cell['index'],
+                            str(grid_cell['latitude']) + ' ' +
+                            str(grid_cell['longitude']),
+                            grid_cell['longitude'], grid_cell['latitude'],
+                            0, extended_data)
+        if not with_anomalies:
+            continue
+        anomalies = grid_cell.get('anomalies', {})
+        for year in sorted(anomalies.keys()):
+            if anomalies[year] is None:
+                continue
+            extended_data = {'anomaly': anomalies[year]}
+            monthly = grid_cell['anomalies_monthly'].get(year)
+            if monthly:
+                for month_index, value in enumerate(monthly):
+                    if value is not None:
+                        extended_data['anomaly_' +
+                                      MONTH_NAMES[month_index]] = value
+            write_kml_placemark(kml,
+                                str(grid_cell['index']) + ' ' + str(year),
+                                'Anomaly ' + ('%.2f' % anomalies[year]),
+                                grid_cell['longitude'],
+                                grid_cell['latitude'],
+                                0, extended_data, (year, year))
+    close_kml(kml)
@@ -0,0 +1,211 @@
+__filename__ = "gridPyramid.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import math
+from grid import get_grid
+from grid import get_grid_spatial_index
+from grid import get_closest_point_index
+from grid import lat_long_to_3d
+from grid import bucket_shell_offsets
+from baseline import get_stations_baselines
+from baseline import update_grid_baselines_from_stations
+from anomaly import update_grid_anomalies
+
+# finer cells within this many bucket widths of a coarser cell
+# are candidates when searching at the finer level
+CANDIDATE_RINGS = 1
+
+
+def parse_resolutions(resolutions_str: str) -> []:
+    """Parses grid resolutions such as 72x36,36x18
+    """
+    resolutions = []
+    for resolution_str in resolutions_str.split(','):
+        resolution_str = resolution_str.strip().lower()
+        if 'x' not in resolution_str:
+            return None
+        horizontal_str, vertical_str = resolution_str.split('x', 1)
+        if not horizontal_str.isdigit() or not vertical_str.isdigit():
+            return None
+        resolutions.append((int(horizontal_str), int(vertical_str)))
+    return resolutions
+
+
+def resolution_name(resolution: ()) -> str:
+    """Returns a name for a grid resolution, such as 72x36
+    """
+    return str(resolution[0]) + 'x' + str(resolution[1])
+
+
+def _bucket_key(spatial_index: {}, point: ()) -> ():
+    """Returns the bucket of a spatial index containing a point
+    """
+    bucket_size = spatial_index['bucket_size']
+    return (math.floor(point[0] / bucket_size),
+            math.floor(point[1] / bucket_size),
+            math.floor(point[2] / bucket_size))
+
+
+def _get_candidate_cells(coarse: {}, fine: {}) -> ():
+    """For each cell of a coarser level returns the cells of a finer
+    level which are within the search distance, sorted by distance
+    """
+    coarse_index = coarse['spatial_index']
+    coarse_points = coarse_index['points']
+    search_dist = CANDIDATE_RINGS * coarse_index['bucket_size']
+    candidates = [[] for _ in coarse_points]
+    # coarser cells within the rings of buckets around each bucket
+    nearby_cells = {}
+    for point_index, point in enumerate(fine['spatial_index']['points']):
+        key = _bucket_key(coarse_index, point)
+        if key not in nearby_cells:
+            cells = []
+            for ring in range(CANDIDATE_RINGS + 1):
+                for offset in bucket_shell_offsets(ring):
+                    cells += coarse_index['buckets'].get(
+                        (key[0] + offset[0], key[1] + offset[1],
+                         key[2] + offset[2]), [])
+            nearby_cells[key] = cells
+        for coarse_cell in nearby_cells[key]:
+            dist = math.dist(point, coarse_points[coarse_cell])
+            if dist < search_dist:
+                candidates[coarse_cell].append((dist, point_index) + point)
+    return [tuple(sorted(cells)) for cells in candidates], search_dist
+
+
+def get_grid_pyramid(resolutions: []) -> {}:
+    """Returns grids at several resolutions, ordered from the coarsest
+    to the finest
+    """
+    levels = []
+    for resolution in sorted(set(resolutions),
+                             key=lambda res: (res[0] * res[1], res)):
+        grid = get_grid(resolution[0], resolution[1])
+        level = {
+            'resolution': resolution,
+            'grid': grid,
+            'spatial_index': get_grid_spatial_index(grid),
+            'station_locations': {}
+        }
+        if levels:
+            level['candidates'], level['search_dist'] = \
+                _get_candidate_cells(levels[-1], level)
+        levels.append(level)
+    return {
+        'levels': levels
+    }
+
+
+def get_pyramid_level(pyramid: {}, resolution: ()) -> {}:
+    """Returns the level of a pyramid with the given resolution, or None
+    """
+    for level in pyramid['levels']:
+        if level['resolution'] == tuple(resolution):
+            return level
+    return None
+
+
+def _closest_candidate(candidates: (), station_dist: float,
+                       x_co: float, y_co: float,
+                       z_co: float) -> (int, float):
+    """Returns the index of the closest candidate cell and its distance.
+    Candidates are sorted by their distance from the coarser cell, which
+    is at station_dist from the station, so the search stops once no
+    remaining candidate could be closer. Ties go to the lowest index
+    """
+    closest_index = None
+    min_dist_sqr = 0
+    min_dist = 0
+    for cell_dist, idx, cell_x, cell_y, cell_z in candidates:
+        if closest_index is not None and \
+           cell_dist - station_dist > min_dist:
+            break
+        dx1 = x_co - cell_x
+        dy1 = y_co - cell_y
+        dz1 = z_co - cell_z
+        dist = dx1 * dx1 + dy1 * dy1 + dz1 * dz1
+        if closest_index is None or dist < min_dist_sqr or \
+           (dist == min_dist_sqr and idx < closest_index):
+            closest_index = idx
+            min_dist_sqr = dist
+            min_dist = math.sqrt(dist)
+    return closest_index, min_dist
+
+
+def assign_stations_to_pyramid(stations: [], pyramid: {}) -> int:
+    """Assigns each station to its closest grid cell at every level of
+    the pyramid. Returns the number of times that a finer level could
+    not be narrowed down from the coarser level
+    """
+    levels = pyramid['levels']
+    fallbacks = 0
+    for item in stations:
+        sid = item['id']
+        x_co, y_co, z_co = lat_long_to_3d(item['longitude'],
+                                          item['latitude'])
+        grid_index = None
+        for level_index, level in enumerate(levels):
+            if grid_index is None:
+                grid_index = \
+                    get_closest_point_index(level['spatial_index'],
+                                            x_co, y_co, z_co)
+            else:
+                coarse_point = \
+                    levels[level_index - 1]['spatial_index']['points'][
+                        grid_index]
+                station_dist = math.dist((x_co, y_co, z_co), coarse_point)
+                grid_index, dist = \
+                    _closest_candidate(level['candidates'][grid_index],
+                                       station_dist, x_co, y_co, z_co)
+                # finer cells which are not candidates are at least
+                # this far from the station
+                if grid_index is None or \
+                   dist >= level['search_dist'] - station_dist:
+                    fallbacks += 1
+                    grid_index = \
+                        get_closest_point_index(level['spatial_index'],
+                                                x_co, y_co, z_co)
+            level['grid'][grid_index]['station_ids'].add(sid)
+            level['station_locations'][sid] = {
+                'grid_index': grid_index,
+                'latitude': item['latitude'],
+                'longitude': item['longitude'],
+                'altitude': item['altitude'],
+                'name': item['name']
+            }
+    return fallbacks
+
+
+def update_pyramid_anomalies(pyramid: {}, stations_data: {},
+                             start_year: int, end_year: int,
+                             baseline_start: int, baseline_end: int,
+                             min_latitude: float, max_latitude: float,
+                             baseline_index: {} = None,
+                             resolutions: [] = None) -> {}:
+    """Calculates the baselines and anomalies at the given resolutions of
+    the pyramid, or at every level. Station baselines are calculated once
+    and shared between levels. Returns the number of grid baselines and
+    the percentage of grid anomalies updated for each resolution
+    """
+    station_baselines = get_stations_baselines(stations_data,
+                                               baseline_start, baseline_end,
+                                               baseline_index)
+    results = {}
+    for level in pyramid['levels']:
+        if resolutions is not None and level['resolution'] not in resolutions:
+            continue
+        ctr = update_grid_baselines_from_stations(
+            level['grid'], station_baselines, level['station_locations'],
+            min_latitude, max_latitude)
+        percent = update_grid_anomalies(level['grid'], stations_data,
+                                        level['station_locations'],
+                                        start_year, end_year,
+                                        min_latitude, max_latitude)
+        results[level['resolution']] = (ctr, percent)
+    return results
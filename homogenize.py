@@ -0,0 +1,278 @@
+__filename__ = "homogenize.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import math
+import warnings
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from statistics import median
+from numpyBackend import np
+from numpyBackend import get_station_arrays
+from numpyBackend import get_pair_rows
+from grid import lat_long_to_3d
+from grid import get_spatial_index
+from grid import get_nearest_point_indexes
+from stationData import get_year_rows
+
+# number of neighbours which each station is compared with
+HOMOGENIZE_NEIGHBOURS = 10
+
+# breakpoints are significant when the test statistic is greater
+# than this, which is roughly the 95% level for a century of years
+SNHT_THRESHOLD = 10.0
+
+# fewest years of a difference series on each side of a breakpoint
+MIN_SEGMENT_YEARS = 5
+
+# fewest years of overlap between a station and a neighbour
+MIN_OVERLAP_YEARS = 20
+
+# breakpoints in different difference series within this many years
+# of each other are taken to be the same breakpoint
+BREAKPOINT_WINDOW = 2
+
+# fewest difference series in which a breakpoint should be found
+MIN_SUPPORT = 2
+
+# number of stations within each chunk of difference series
+HOMOGENIZE_CHUNK = 256
+
+# anomaly matrix and neighbours shared with the forked worker processes
+_HOMOGENIZE = {}
+
+
+def get_station_neighbours(station_locations: {}, station_ids: [],
+                           no_of_neighbours: int) -> {}:
+    """Returns the given number of nearest neighbours of each station,
+    closest first, from among the given station ids
+    """
+    points = [lat_long_to_3d(station_locations[sid]['longitude'],
+                             station_locations[sid]['latitude'])
+              for sid in station_ids]
+    # buckets which contain about the number of neighbours
+    bucket_size = math.sqrt(4 * math.pi * max(no_of_neighbours, 1) /
+                            max(len(points), 1))
+    spatial_index = get_spatial_index(points, min(bucket_size, 1.0))
+    neighbours = {}
+    for idx, sid in enumerate(station_ids):
+        point = points[idx]
+        neighbours[sid] = \
+            [station_ids[neighbour_index]
+             for neighbour_index in
+             get_nearest_point_indexes(spatial_index, point[0], point[1],
+                                       point[2], no_of_neighbours, idx)]
+    return neighbours
+
+
+def _get_anomaly_matrix(stations_data: {}, station_ids: [],
+                        start_year: int, end_year: int):
+    """Returns a (stations x years x 12) matrix of the monthly anomalies
+    of each station relative to its own monthly means, which is NaN
+    where there is no valid value
+    """
+    station_arrays = get_station_arrays(stations_data)
+    stations = np.array([station_arrays['station_indexes'][sid]
+                         for sid in station_ids], dtype=np.int64)
+    pair_of_row, rows, years = \
+        get_pair_rows(stations, station_arrays, start_year, end_year)
+    valid = ~(np.ma.getmaskarray(station_arrays['values'][rows]) |
+              station_arrays['flagged'][rows])
+    matrix = np.full((len(station_ids), end_year + 1 - start_year, 12),
+                     np.nan, dtype=np.float32)
+    matrix[pair_of_row, years - start_year] = \
+        np.where(valid, station_arrays['values'].data[rows], np.nan)
+    with warnings.catch_warnings():
+        # months with no values
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        matrix -= np.nanmean(matrix, axis=1, keepdims=True)
+    return matrix
+
+
+def _find_breakpoints(series, min_segment: int) -> ():
+    """Returns the test statistic, the index of the first year after the
+    breakpoint, the size of the step and the number of years, for the
+    most likely breakpoint within each row of a (series x years) array,
+    which may contain NaN for missing years
+    """
+    valid = ~np.isnan(series)
+    count = valid.sum(axis=1)
+    values = np.where(valid, series, 0.0)
+    mean = values.sum(axis=1) / np.maximum(count, 1)
+    deviations = np.where(valid, series - mean[:, None], 0.0)
+    std = np.sqrt((deviations ** 2).sum(axis=1) /
+                  np.maximum(count - 1, 1))
+    std = np.where(std > 0, std, 1.0)
+    z_sums = np.cumsum(deviations / std[:, None], axis=1)
+    value_sums = np.cumsum(values, axis=1)
+    before = np.cumsum(valid, axis=1)
+    after = count[:, None] - before
+    # a split after each year, with enough years on either side
+    possible = valid & (before >= min_segment) & (after >= min_segment)
+    z_total = z_sums[:, -1:]
+    statistic = np.where(possible,
+                         z_sums ** 2 / np.maximum(before, 1) +
+                         (z_total - z_sums) ** 2 / np.maximum(after, 1),
+                         0.0)
+    split = np.argmax(statistic, axis=1)
+    series_index = np.arange(len(series))
+    before = before[series_index, split]
+    after = after[series_index, split]
+    value_before = value_sums[series_index, split]
+    step = (value_sums[:, -1] - value_before) / np.maximum(after, 1) - \
+        value_before / np.maximum(before, 1)
+    return statistic[series_index, split], split + 1, step, count
+
+
+def _chunk_breakpoints(chunk_index: int) -> ():
+    """Returns the most likely breakpoint within the difference series
+    between each station of a chunk and each of its neighbours
+    """
+    anomalies = _HOMOGENIZE['anomalies']
+    neighbours = _HOMOGENIZE['neighbours']
+    stations = np.arange(chunk_index * HOMOGENIZE_CHUNK,
+                         min((chunk_index + 1) * HOMOGENIZE_CHUNK,
+                             len(anomalies)))
+    chunk_neighbours = neighbours[stations]
+    differences = anomalies[stations][:, None] - \
+        anomalies[np.maximum(chunk_neighbours, 0)]
+    with warnings.catch_warnings():
+        # years with no months in common
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        annual = np.nanmean(differences, axis=3, dtype=np.float64)
+    annual[chunk_neighbours < 0] = np.nan
+    return _find_breakpoints(annual.reshape(-1, annual.shape[2]),
+                             MIN_SEGMENT_YEARS)
+
+
+def _attribute_breakpoint(statistics, break_years, steps, counts,
+                          threshold: float) -> ():
+    """Returns the year, step size and support of a breakpoint within a
+    station's series, from the breakpoints of the difference series with
+    its neighbours, or None if no breakpoint is found with enough of them
+    """
+    tested = counts >= MIN_OVERLAP_YEARS
+    significant = tested & (statistics > threshold)
+    no_of_tested = int(tested.sum())
+    if int(significant.sum()) < MIN_SUPPORT:
+        return None
+    years = break_years[significant].tolist()
+    sizes = steps[significant].tolist()
+    best_support = []
+    for year in years:
+        support = [idx for idx, other_year in enumerate(years)
+                   if abs(other_year - year) <= BREAKPOINT_WINDOW]
+        if len(support) > len(best_support):
+            best_support = support
+    if len(best_support) < MIN_SUPPORT or \
+       len(best_support) * 2 < no_of_tested:
+        return None
+    return (int(median(years[idx] for idx in best_support)),
+            median(sizes[idx] for idx in best_support),
+            len(best_support), no_of_tested)
+
+
+def _adjust_station(values: array, stations_data: {}, sid: str,
+                    break_year: int, step: float) -> None:
+    """Shifts the valid values of a station before a breakpoint year
+    """
+    for row in get_year_rows(stations_data, sid, 0, break_year):
+        pos = row * 12
+        for month_index in range(12):
+            value = values[pos + month_index]
+            if value > -80 and value < 80:
+                values[pos + month_index] = round(value + step, 2)
+
+
+def homogenize(stations_data: {}, station_locations: {},
+               start_year: int, end_year: int,
+               no_of_neighbours: int = HOMOGENIZE_NEIGHBOURS,
+               threshold: float = SNHT_THRESHOLD,
+               workers: int = 1) -> ({}, []):
+    """Returns a copy of the station data with the values before any
+    breakpoints adjusted, together with the list of breakpoints found
+    within the range of years
+    """
+    station_ids = [sid for sid in stations_data['stations']
+                   if sid in station_locations]
+    neighbours = get_station_neighbours(station_locations, station_ids,
+                                        no_of_neighbours)
+    station_indexes = {sid: idx for idx, sid in enumerate(station_ids)}
+    neighbour_matrix = np.full((len(station_ids), no_of_neighbours), -1,
+                               dtype=np.int64)
+    for idx, sid in enumerate(station_ids):
+        for neighbour_number, neighbour in enumerate(neighbours[sid]):
+            neighbour_matrix[idx, neighbour_number] = \
+                station_indexes[neighbour]
+
+    _HOMOGENIZE.clear()
+    _HOMOGENIZE['anomalies'] = \
+        _get_anomaly_matrix(stations_data, station_ids, start_year, end_year)
+    _HOMOGENIZE['neighbours'] = neighbour_matrix
+    no_of_chunks = (len(station_ids) + HOMOGENIZE_CHUNK - 1) // \
+        HOMOGENIZE_CHUNK
+    if workers > 1 and no_of_chunks > 1 and \
+       'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context(
+                                     'fork')) as executor:
+            chunks = list(executor.map(_chunk_breakpoints,
+                                       range(no_of_chunks)))
+    else:
+        chunks = [_chunk_breakpoints(chunk_index)
+                  for chunk_index in range(no_of_chunks)]
+    _HOMOGENIZE.clear()
+
+    homogenized_data = stations_data.copy()
+    homogenized_data['values'] = array('d', stations_data['values'])
+    breakpoints = []
+    for chunk_index, chunk in enumerate(chunks):
+        statistics, splits, steps, counts = \
+            [item.reshape(-1, no_of_neighbours) for item in chunk]
+        for chunk_station in range(len(statistics)):
+            sid = station_ids[chunk_index * HOMOGENIZE_CHUNK + chunk_station]
+            breakpoint = \
+                _attribute_breakpoint(statistics[chunk_station],
+                                      start_year + splits[chunk_station],
+                                      steps[chunk_station],
+                                      counts[chunk_station], threshold)
+            if breakpoint is None:
+                continue
+            break_year, step, support, pairs = breakpoint
+            _adjust_station(homogenized_data['values'], stations_data, sid,
+                            break_year, step)
+            breakpoints.append({
+                'station': sid,
+                'year': break_year,
+                'step': step,
+                'support': support,
+                'neighbours': pairs
+            })
+    return homogenized_data, breakpoints
+
+
+def save_breakpoints(filename: str, breakpoints: [],
+                     station_locations: {}) -> bool:
+    """Saves the breakpoints found by homogenization as CSV
+    """
+    try:
+        with open(filename, 'w+', encoding='utf-8') as fp_csv:
+            fp_csv.write('station,name,year,step,support,neighbours\n')
+            for item in breakpoints:
+                name = station_locations[item['station']]['name']
+                fp_csv.write(item['station'] + ',"' +
+                             name.replace('"', "'") + '",' +
+                             str(item['year']) + ',' +
+                             ('%.2f' % item['step']) + ',' +
+                             str(item['support']) + ',' +
+                             str(item['neighbours']) + '\n')
+    except OSError:
+        print('Unable to save ' + filename)
+        return False
+    return True
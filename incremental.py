@@ -0,0 +1,271 @@
+__filename__ = "incremental.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import math
+import zlib
+from array import array
+from binaryFile import save_binary_file
+from binaryFile import load_binary_file
+from baseline import update_grid_baselines
+from baseline import baseline_for_stations
+from anomaly import update_grid_anomalies
+from anomaly import cell_anomalies
+
+INCREMENTAL_STATE_VERSION = 1
+
+
+def get_row_fingerprints(stations_data: {}) -> array:
+    """Returns a fingerprint for each station year row, covering the
+    monthly values and quality control flags
+    """
+    values = memoryview(stations_data['values']).cast('B')
+    qcflags = stations_data['qcflag']
+    fingerprints = array('I')
+    for row in range(len(stations_data['years'])):
+        fingerprint = zlib.crc32(values[row * 96:(row + 1) * 96])
+        fingerprints.append(zlib.crc32(qcflags[row * 12:(row + 1) * 12],
+                                       fingerprint))
+    return fingerprints
+
+
+def _get_cell_stations(grid: [], station_locations: {},
+                       min_latitude: float, max_latitude: float) -> []:
+    """Returns the sorted ids of the stations within each grid cell
+    which are within the latitude range
+    """
+    cell_stations = []
+    for grid_cell in grid:
+        station_ids = []
+        for sid in grid_cell['station_ids']:
+            latitude = station_locations[sid]['latitude']
+            if latitude >= min_latitude and latitude <= max_latitude:
+                station_ids.append(sid)
+        cell_stations.append(sorted(station_ids))
+    return cell_stations
+
+
+def _changed_station_years(state: {}, stations_data: {},
+                           fingerprints: array) -> {}:
+    """Returns the years which have changed for each station
+    """
+    old_stations = state['stations']
+    old_years = state['years']
+    old_fingerprints = state['fingerprints']
+    new_years = stations_data['years']
+    changed = {}
+    for sid in set(old_stations.keys()) | set(stations_data['stations']):
+        old_span = old_stations.get(sid, (0, 0))
+        new_span = stations_data['stations'].get(sid, (0, 0))
+        if old_years[old_span[0]:old_span[1]] == \
+           new_years[new_span[0]:new_span[1]] and \
+           old_fingerprints[old_span[0]:old_span[1]] == \
+           fingerprints[new_span[0]:new_span[1]]:
+            continue
+        old_rows = {}
+        for row in range(old_span[0], old_span[1]):
+            old_rows[old_years[row]] = old_fingerprints[row]
+        new_rows = {}
+        for row in range(new_span[0], new_span[1]):
+            new_rows[new_years[row]] = fingerprints[row]
+        changed[sid] = set()
+        for year in set(old_rows.keys()) | set(new_rows.keys()):
+            if old_rows.get(year) != new_rows.get(year):
+                changed[sid].add(year)
+    return changed
+
+
+def _in_baseline(year: int, baseline_start: int, baseline_end: int) -> bool:
+    """Returns true if the given year is used by the baseline
+    """
+    if baseline_start == baseline_end:
+        return year == baseline_start
+    return year >= baseline_start and year < baseline_end
+
+
+def _restore_grid_cell(grid_cell: {}, state: {}, params: {}) -> None:
+    """Restores the baseline and anomalies of a grid cell from saved state
+    """
+    grid_cell['anomalies'] = {}
+    grid_cell['anomalies_monthly'] = {}
+    if not grid_cell['station_ids']:
+        return
+    start_year = params['start_year']
+    no_of_years = params['end_year'] + 1 - start_year
+    index = grid_cell['index']
+    baselines = state['baselines']
+    grid_cell['baseline'] = []
+    for month_index in range(12):
+        value = baselines[index * 12 + month_index]
+        if math.isnan(value):
+            grid_cell['baseline'].append(None)
+        else:
+            grid_cell['baseline'].append(value)
+    anomalies = state['anomalies']
+    anomalies_monthly = state['anomalies_monthly']
+    for year_index in range(no_of_years):
+        year = start_year + year_index
+        pos = (index * no_of_years) + year_index
+        if math.isnan(anomalies[pos]):
+            grid_cell['anomalies'][year] = None
+            continue
+        grid_cell['anomalies'][year] = anomalies[pos]
+        grid_cell['anomalies_monthly'][year] = []
+        for month_index in range(12):
+            value = anomalies_monthly[pos * 12 + month_index]
+            if math.isnan(value):
+                grid_cell['anomalies_monthly'][year].append(None)
+            else:
+                grid_cell['anomalies_monthly'][year].append(value)
+
+
+def save_incremental_state(filename: str, grid: [], stations_data: {},
+                           station_locations: {}, fingerprints: array,
+                           params: {}) -> bool:
+    """Saves the baseline and anomalies of each grid cell together with
+    the fingerprints of the station data
+    """
+    start_year = params['start_year']
+    no_of_years = params['end_year'] + 1 - start_year
+    baselines = array('d', [math.nan]) * (len(grid) * 12)
+    anomalies = array('d', [math.nan]) * (len(grid) * no_of_years)
+    anomalies_monthly = array('d', [math.nan]) * (len(anomalies) * 12)
+    for grid_cell in grid:
+        index = grid_cell['index']
+        if not grid_cell['station_ids']:
+            continue
+        for month_index, value in enumerate(grid_cell['baseline']):
+            if value is not None:
+                baselines[index * 12 + month_index] = value
+        for year, value in grid_cell['anomalies'].items():
+            if value is None:
+                continue
+            pos = (index * no_of_years) + year - start_year
+            anomalies[pos] = value
+            for month_index, month_value in \
+                    enumerate(grid_cell['anomalies_monthly'][year]):
+                if month_value is not None:
+                    anomalies_monthly[pos * 12 + month_index] = month_value
+    header = {
+        'version': INCREMENTAL_STATE_VERSION,
+        'params': params,
+        'stations': stations_data['stations'],
+        'cell_stations':
+        _get_cell_stations(grid, station_locations,
+                           params['min_latitude'], params['max_latitude'])
+    }
+    arrays = {
+        'years': stations_data['years'],
+        'fingerprints': fingerprints,
+        'baselines': baselines,
+        'anomalies': anomalies,
+        'anomalies_monthly': anomalies_monthly
+    }
+    return save_binary_file(filename, header, arrays)
+
+
+def load_incremental_state(filename: str) -> {}:
+    """Loads saved incremental state, or returns None
+    """
+    header, arrays = load_binary_file(filename)
+    if not header or arrays is None:
+        return None
+    if header.get('version') != INCREMENTAL_STATE_VERSION:
+        return None
+    state = arrays
+    state['params'] = header['params']
+    state['cell_stations'] = header['cell_stations']
+    state['stations'] = {sid: tuple(span)
+                         for sid, span in header['stations'].items()}
+    return state
+
+
+def update_grid_incremental(grid: [], stations_data: {},
+                            station_locations: {},
+                            start_year: int, end_year: int,
+                            baseline_start: int, baseline_end: int,
+                            min_latitude: float, max_latitude: float,
+                            state_filename: str,
+                            baseline_index: {} = None) -> int:
+    """Calculates the baselines and anomalies for each grid cell, only
+    recalculating the cells and years which have changed since the state
+    was saved. The state is then updated.
+    Returns the number of grid cells which were recalculated
+    """
+    params = {
+        'no_of_cells': len(grid),
+        'start_year': start_year,
+        'end_year': end_year,
+        'baseline_start': baseline_start,
+        'baseline_end': baseline_end,
+        'min_latitude': min_latitude,
+        'max_latitude': max_latitude
+    }
+    fingerprints = get_row_fingerprints(stations_data)
+    state = load_incremental_state(state_filename)
+    if not state or state['params'] != params:
+        update_grid_baselines(grid, stations_data, station_locations,
+                              baseline_start, baseline_end,
+                              min_latitude, max_latitude, baseline_index)
+        update_grid_anomalies(grid, stations_data, station_locations,
+                              start_year, end_year,
+                              min_latitude, max_latitude)
+        save_incremental_state(state_filename, grid, stations_data,
+                               station_locations, fingerprints, params)
+        return len(grid)
+
+    changed = _changed_station_years(state, stations_data, fingerprints)
+    cell_stations = _get_cell_stations(grid, station_locations,
+                                       min_latitude, max_latitude)
+    ctr = 0
+    for grid_cell in grid:
+        _restore_grid_cell(grid_cell, state, params)
+        if not grid_cell['station_ids']:
+            continue
+        index = grid_cell['index']
+        changed_years = set()
+        for sid in cell_stations[index]:
+            changed_years |= changed.get(sid, set())
+        same_stations = \
+            cell_stations[index] == state['cell_stations'][index]
+        if same_stations and not changed_years:
+            continue
+        if not same_stations or \
+           any(_in_baseline(year, baseline_start, baseline_end)
+               for year in changed_years):
+            # recalculate the whole cell
+            grid_cell['baseline'], _ = \
+                baseline_for_stations(stations_data, station_locations,
+                                      baseline_start, baseline_end,
+                                      grid_cell['station_ids'],
+                                      min_latitude, max_latitude,
+                                      baseline_index)
+            first_year = start_year
+            last_year = end_year
+        else:
+            # recalculate only the range of changed years
+            first_year = max(min(changed_years), start_year)
+            last_year = min(max(changed_years), end_year)
+            if first_year > last_year:
+                continue
+        ctr += 1
+        anomalies, anomalies_monthly = \
+            cell_anomalies(stations_data, station_locations,
+                           grid_cell['baseline'], grid_cell['station_ids'],
+                           first_year, last_year,
+                           min_latitude, max_latitude)
+        for year in range(first_year, last_year + 1):
+            grid_cell['anomalies'][year] = anomalies[year]
+            if year in anomalies_monthly:
+                grid_cell['anomalies_monthly'][year] = \
+                    anomalies_monthly[year]
+            elif year in grid_cell['anomalies_monthly']:
+                del grid_cell['anomalies_monthly'][year]
+    save_incremental_state(state_filename, grid, stations_data,
+                           station_locations, fingerprints, params)
+    return ctr
@@ -0,0 +1,261 @@
+__filename__ = "infill.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import math
+from array import array
+from grid import lat_long_to_3d
+from grid import get_spatial_index
+from grid import get_points_within_distance
+from anomaly import get_station_anomalies
+from numpyBackend import np
+from numpyBackend import get_station_arrays
+from numpyBackend import get_pair_rows
+
+# radius within which stations contribute to an infilled cell
+INFILL_RADIUS_KM = 1200
+
+EARTH_RADIUS_KM = 6371.0
+
+INFILL_WEIGHTINGS = ('inverse', 'exponential')
+
+# inverse distance weights use at least this distance, so that
+# a station at the centre of a cell does not have an infinite weight
+INFILL_MIN_DISTANCE_KM = 10
+
+# exponential weights decay by this many e-foldings over the radius
+INFILL_DECAY_LENGTHS = 3
+
+# annual anomaly followed by the monthly anomalies
+_VALUES_PER_STATION = 13
+
+
+def _distance_weight(distance_km: float, radius_km: float,
+                     weighting: str) -> float:
+    """Returns the weight of a station at the given distance from a cell
+    """
+    if weighting == 'exponential':
+        return math.exp(-INFILL_DECAY_LENGTHS * distance_km / radius_km)
+    return 1.0 / max(distance_km, INFILL_MIN_DISTANCE_KM)
+
+
+def get_infill_weights(grid: [], station_locations: {}, station_ids: [],
+                       radius_km: float, weighting: str,
+                       min_latitude: float, max_latitude: float,
+                       min_stations: int = 1) -> {}:
+    """Returns the sparse matrix of station weights for the grid cells
+    within the latitude range which have fewer than the given number of
+    stations, from the stations within the radius of each cell.
+    The matrix is stored as compressed rows, one for each infilled cell
+    """
+    station_ids = \
+        sorted(sid for sid in station_ids
+               if sid in station_locations and
+               min_latitude <= station_locations[sid]['latitude'] <=
+               max_latitude)
+    points = [lat_long_to_3d(station_locations[sid]['longitude'],
+                             station_locations[sid]['latitude'])
+              for sid in station_ids]
+    # straight line distance through the sphere equivalent to the radius
+    max_dist = 2 * math.sin(min(radius_km / EARTH_RADIUS_KM, math.pi) / 2)
+    spatial_index = get_spatial_index(points, max(max_dist, 0.01))
+    cell_stations = [0] * len(grid)
+    for sid in station_ids:
+        cell_stations[station_locations[sid]['grid_index']] += 1
+    weights = {
+        'cells': array('l'),
+        'row_starts': array('l', [0]),
+        'columns': array('l'),
+        'weights': array('d'),
+        'station_ids': station_ids,
+        'radius': radius_km,
+        'weighting': weighting
+    }
+    for grid_cell in grid:
+        if cell_stations[grid_cell['index']] >= min_stations:
+            continue
+        if grid_cell['latitude'] < min_latitude or \
+           grid_cell['latitude'] > max_latitude:
+            continue
+        columns = \
+            get_points_within_distance(spatial_index, grid_cell['x'],
+                                       grid_cell['y'], grid_cell['z'],
+                                       max_dist)
+        if not columns:
+            continue
+        for column in columns:
+            chord = math.dist((grid_cell['x'], grid_cell['y'],
+                               grid_cell['z']), points[column])
+            distance_km = \
+                2 * math.asin(min(chord / 2, 1.0)) * EARTH_RADIUS_KM
+            weights['columns'].append(column)
+            weights['weights'].append(_distance_weight(distance_km,
+                                                       radius_km,
+                                                       weighting))
+        weights['cells'].append(grid_cell['index'])
+        weights['row_starts'].append(len(weights['columns']))
+    return weights
+
+
+def _station_anomalies_vector(stations_data: {}, station_ids: [],
+                              station_baselines: {}, year: int) -> []:
+    """Returns the annual and monthly anomalies of each station for a
+    year, or None for stations without data in that year
+    """
+    vector = [None] * len(station_ids)
+    for column, sid in enumerate(station_ids):
+        baseline = station_baselines.get(sid)
+        if not baseline:
+            continue
+        for _, anomalies in get_station_anomalies(stations_data, sid,
+                                                  baseline, year, year):
+            valid = [value for value in anomalies if value is not None]
+            if not valid:
+                continue
+            vector[column] = [sum(valid) / len(valid)] + anomalies
+    return vector
+
+
+def _weighted_means(weights: {}, vector: []) -> []:
+    """Returns the weighted mean of the station anomalies for each row
+    of the weights, normalized over the stations with data
+    """
+    row_starts = weights['row_starts']
+    columns = weights['columns']
+    entry_weights = weights['weights']
+    means = []
+    for row in range(len(weights['cells'])):
+        totals = [0.0] * _VALUES_PER_STATION
+        hits = [0.0] * _VALUES_PER_STATION
+        for entry in range(row_starts[row], row_starts[row + 1]):
+            station_anomalies = vector[columns[entry]]
+            if station_anomalies is None:
+                continue
+            weight = entry_weights[entry]
+            for value_index, value in enumerate(station_anomalies):
+                if value is None:
+                    continue
+                totals[value_index] += weight * value
+                hits[value_index] += weight
+        means.append([totals[value_index] / hits[value_index]
+                      if hits[value_index] > 0 else None
+                      for value_index in range(_VALUES_PER_STATION)])
+    return means
+
+
+def _station_anomalies_numpy(stations_data: {}, station_ids: [],
+                             station_baselines: {},
+                             start_year: int, end_year: int) -> ():
+    """Returns the station of each row of data within the range of years,
+    its year, and its annual and monthly anomalies, which are NaN where
+    there is no value
+    """
+    station_arrays = get_station_arrays(stations_data)
+    stations = np.array([station_arrays['station_indexes'][sid]
+                         for sid in station_ids], dtype=np.int64)
+    baselines = np.full((len(station_ids), 12), np.nan)
+    for column, sid in enumerate(station_ids):
+        baseline = station_baselines.get(sid)
+        if not baseline:
+            continue
+        # months with a baseline of zero are skipped, as for the stations
+        baselines[column] = [value if value else np.nan
+                             for value in baseline]
+    pair_of_row, rows, years = \
+        get_pair_rows(stations, station_arrays, start_year, end_year)
+    values = station_arrays['values'][rows]
+    anomalies = np.where(np.ma.getmaskarray(values), np.nan,
+                         values.data - baselines[pair_of_row])
+    valid = ~np.isnan(anomalies)
+    hits = valid.sum(axis=1)
+    annual = np.where(valid, anomalies, 0.0).sum(axis=1) / \
+        np.maximum(hits, 1)
+    annual[hits == 0] = np.nan
+    return pair_of_row, years, np.column_stack((annual, anomalies))
+
+
+def _infill_means_numpy(weights: {}, stations_data: {},
+                        station_baselines: {},
+                        start_year: int, end_year: int):
+    """Yields each year with the rows of the weights which have an annual
+    anomaly, together with their annual and monthly weighted means.
+    Each year is calculated as a sparse matrix vector product
+    """
+    station_ids = weights['station_ids']
+    pair_of_row, years, anomalies = \
+        _station_anomalies_numpy(stations_data, station_ids,
+                                 station_baselines, start_year, end_year)
+    order = np.argsort(years, kind='stable')
+    year_starts = np.searchsorted(years[order],
+                                  np.arange(start_year, end_year + 2))
+    columns = np.array(weights['columns'], dtype=np.int64)
+    entry_weights = np.frombuffer(weights['weights'], dtype=np.float64)
+    row_starts = np.array(weights['row_starts'][:-1], dtype=np.int64)
+    vector = np.empty((len(station_ids), _VALUES_PER_STATION))
+    for year in range(start_year, end_year + 1):
+        year_rows = order[year_starts[year - start_year]:
+                          year_starts[year + 1 - start_year]]
+        if len(year_rows) == 0:
+            continue
+        vector.fill(np.nan)
+        vector[pair_of_row[year_rows]] = anomalies[year_rows]
+        entries = vector[columns]
+        valid = ~np.isnan(entries)
+        totals = np.add.reduceat(
+            np.where(valid, entries, 0.0) * entry_weights[:, None],
+            row_starts, axis=0)
+        hits = np.add.reduceat(valid * entry_weights[:, None],
+                               row_starts, axis=0)
+        rows = np.flatnonzero(hits[:, 0] > 0)
+        means = totals[rows] / np.where(hits[rows] > 0, hits[rows], 1)
+        # ndarray.tolist is faster with None already within an
+        # object array than replacing NaN afterwards
+        monthly = means[:, 1:].astype(object)
+        monthly[hits[rows, 1:] == 0] = None
+        yield year, zip(rows.tolist(), means[:, 0].tolist(),
+                        monthly.tolist())
+
+
+def infill_grid_anomalies(grid: [], weights: {}, stations_data: {},
+                          station_baselines: {},
+                          start_year: int, end_year: int,
+                          backend: str = 'python') -> int:
+    """Replaces the anomalies of the grid cells within the infill weights
+    with the weighted means of the station anomalies within the range of
+    years. Returns the number of cells infilled for at least one year
+    """
+    for cell_index in weights['cells']:
+        grid_cell = grid[cell_index]
+        grid_cell['anomalies'] = {}
+        grid_cell['anomalies_monthly'] = {}
+        for year in range(start_year, end_year + 1):
+            grid_cell['anomalies'][year] = None
+    if not weights['cells']:
+        return 0
+    if backend == 'numpy':
+        year_means = \
+            _infill_means_numpy(weights, stations_data, station_baselines,
+                                start_year, end_year)
+    else:
+        year_means = \
+            ((year, [(row, cell_means[0], cell_means[1:])
+                     for row, cell_means in
+                     enumerate(_weighted_means(
+                         weights, _station_anomalies_vector(
+                             stations_data, weights['station_ids'],
+                             station_baselines, year)))
+                     if cell_means[0] is not None])
+             for year in range(start_year, end_year + 1))
+    cells = weights['cells']
+    for year, means in year_means:
+        for row, annual, monthly in means:
+            grid_cell = grid[cells[row]]
+            grid_cell['anomalies'][year] = annual
+            grid_cell['anomalies_monthly'][year] = monthly
+    return sum(1 for cell_index in cells
+               if grid[cell_index]['anomalies_monthly'])
@@ -0,0 +1,89 @@
+__filename__ = "kml.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import io
+import zipfile
+from xml.sax.saxutils import escape
+
+KML_HEADER = \
+    "<?xml version=\"1.0\" encoding='UTF-8'?>\n" + \
+    "<kml xmlns=\"http://www.opengis.net/kml/2.2\">\n" + \
+    "<Document>\n"
+
+KML_FOOTER = \
+    "</Document>\n" + \
+    "</kml>\n"
+
+
+def open_kml(filename: str) -> {}:
+    """Opens a KML or KMZ file for writing and writes the document header
+    """
+    kmz = None
+    try:
+        if filename.lower().endswith('.kmz'):
+            kmz = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+            fp_kml = io.TextIOWrapper(kmz.open('doc.kml', 'w'),
+                                      encoding='utf-8')
+        else:
+            fp_kml = open(filename, 'w+', encoding='utf-8')
+    except OSError:
+        print('Unable to save ' + filename)
+        return None
+    fp_kml.write(KML_HEADER)
+    return {
+        'file': fp_kml,
+        'kmz': kmz
+    }
+
+
+def write_kml_placemark(kml: {}, name: str, description: str,
+                        longitude: float, latitude: float,
+                        altitude: float = 0,
+                        extended_data: {} = None,
+                        time_span: () = None) -> None:
+    """Writes a point placemark, with optional extended data given as
+    a dict of names and values, and an optional (begin, end) time span
+    """
+    placemark = [
+        "  <Placemark>\n",
+        "    <name>", escape(str(name)), "</name>\n",
+        "    <description>", escape(str(description)), "</description>\n"
+    ]
+    if time_span:
+        placemark += [
+            "    <TimeSpan>\n",
+            "      <begin>", str(time_span[0]), "</begin>\n",
+            "      <end>", str(time_span[1]), "</end>\n",
+            "    </TimeSpan>\n"
+        ]
+    if extended_data:
+        placemark.append("    <ExtendedData>\n")
+        for data_name, value in extended_data.items():
+            placemark += [
+                "      <Data name=\"", escape(str(data_name)), "\">",
+                "<value>", escape(str(value)), "</value></Data>\n"
+            ]
+        placemark.append("    </ExtendedData>\n")
+    placemark += [
+        "    <Point>\n",
+        "      <coordinates>", str(longitude), ",", str(latitude), ",",
+        str(altitude), "</coordinates>\n",
+        "    </Point>\n",
+        "  </Placemark>\n"
+    ]
+    kml['file'].write(''.join(placemark))
+
+
+def close_kml(kml: {}) -> None:
+    """Writes the document footer and closes the file
+    """
+    kml['file'].write(KML_FOOTER)
+    kml['file'].close()
+    if kml['kmz']:
+        kml['kmz'].close()
@@ -0,0 +1,283 @@
+__filename__ = "numpyBackend.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from stationData import QCFLAG_ERROR
+
+BACKENDS = ('python', 'numpy')
+
+
+def numpy_available() -> bool:
+    """Returns true if the numpy backend can be used
+    """
+    return np is not None
+
+
+def get_station_arrays(stations_data: {}) -> {}:
+    """Returns numpy arrays for the station data store.
+    Months flagged as errors are held separately from the mask of the
+    values, because they are only excluded from baselines
+    """
+    values = np.frombuffer(stations_data['values'],
+                           dtype=np.float64).reshape(-1, 12)
+    qcflags = np.frombuffer(stations_data['qcflag'],
+                            dtype=np.uint8).reshape(-1, 12)
+    spans = np.array(list(stations_data['stations'].values()),
+                     dtype=np.int64).reshape(-1, 2)
+    row_station = np.full(len(values), -1, dtype=np.int64)
+    for station_index, span in enumerate(spans):
+        row_station[span[0]:span[1]] = station_index
+    return {
+        'station_indexes': {sid: station_index
+                            for station_index, sid in
+                            enumerate(stations_data['stations'])},
+        'spans': spans,
+        'row_station': row_station,
+        'years': np.frombuffer(stations_data['years'],
+                               dtype=np.uint16).astype(np.int64),
+        'values': np.ma.masked_array(values,
+                                     mask=~((values > -80) & (values < 80))),
+        # values in hundredths of a degree, as summed by the baselines
+        'hundredths': np.rint(values * 100).astype(np.int64),
+        'flagged': qcflags == QCFLAG_ERROR
+    }
+
+
+def get_cell_station_pairs(grid: [], station_locations: {},
+                           station_arrays: {},
+                           min_latitude: float, max_latitude: float) -> ():
+    """Returns the grid cell index and station index of every station
+    with data which is within a grid cell and the latitude range
+    """
+    station_indexes = station_arrays['station_indexes']
+    cells = []
+    stations = []
+    for grid_cell in grid:
+        # sorted so that the order does not depend on the hash seed
+        for sid in sorted(grid_cell['station_ids']):
+            if sid not in station_indexes:
+                continue
+            latitude = station_locations[sid]['latitude']
+            if latitude < min_latitude or latitude > max_latitude:
+                continue
+            cells.append(grid_cell['index'])
+            stations.append(station_indexes[sid])
+    return np.array(cells, dtype=np.int64), np.array(stations, dtype=np.int64)
+
+
+def get_pair_rows(stations, station_arrays: {},
+                  start_year: int, end_year: int) -> ():
+    """Returns the rows of each of the given stations within a range
+    of years, together with the index of the station within the given
+    array of stations and the year of each row
+    """
+    spans = station_arrays['spans'][stations]
+    lengths = spans[:, 1] - spans[:, 0]
+    pair_of_row = np.repeat(np.arange(len(stations)), lengths)
+    rows = np.arange(lengths.sum()) - \
+        np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+        spans[:, 0][pair_of_row]
+    years = station_arrays['years'][rows]
+    in_range = (years >= start_year) & (years <= end_year)
+    return pair_of_row[in_range], rows[in_range], years[in_range]
+
+
+def _masked_mean(totals, hits):
+    """Returns the mean from totals and hits, masked where there
+    are no hits
+    """
+    no_hits = hits == 0
+    return np.ma.masked_array(totals / np.where(no_hits, 1, hits),
+                              mask=no_hits)
+
+
+def get_station_baselines(station_arrays: {},
+                          start_year: int, end_year: int):
+    """Returns a (stations x 12) masked array of station baselines
+    for the years start_year <= year < end_year, or for the single year
+    if they are the same
+    """
+    years = station_arrays['years']
+    if start_year == end_year:
+        in_window = years == start_year
+    else:
+        in_window = (years >= start_year) & (years < end_year)
+    rows = np.nonzero(in_window & (station_arrays['row_station'] >= 0))[0]
+    valid = ~(station_arrays['values'].mask[rows] |
+              station_arrays['flagged'][rows])
+    keys = (station_arrays['row_station'][rows][:, None] * 12 +
+            np.arange(12)).ravel()
+    size = len(station_arrays['spans']) * 12
+    totals = np.bincount(keys,
+                         weights=np.where(valid,
+                                          station_arrays['hundredths'][rows],
+                                          0).ravel(),
+                         minlength=size)
+    hits = np.bincount(keys, weights=valid.ravel(), minlength=size)
+    return _masked_mean(totals.reshape(-1, 12),
+                        100.0 * hits.reshape(-1, 12))
+
+
+def update_grid_baselines_numpy(grid: [], stations_data: {},
+                                station_locations: {},
+                                start_year: int, end_year: int,
+                                min_latitude: float, max_latitude: float,
+                                station_arrays: {} = None) -> int:
+    """Calculates reference baselines for each grid cell, as
+    update_grid_baselines
+    """
+    if station_arrays is None:
+        station_arrays = get_station_arrays(stations_data)
+    station_baselines = \
+        get_station_baselines(station_arrays, start_year, end_year)
+    cells, stations = \
+        get_cell_station_pairs(grid, station_locations, station_arrays,
+                               min_latitude, max_latitude)
+    totals = np.zeros((len(grid), 12))
+    hits = np.zeros((len(grid), 12))
+    np.add.at(totals, cells, station_baselines.filled(0)[stations])
+    np.add.at(hits, cells, ~np.ma.getmaskarray(station_baselines)[stations])
+    cell_baselines = _masked_mean(totals, hits).tolist()
+    ctr = 0
+    for grid_cell in grid:
+        if grid_cell['station_ids']:
+            grid_cell['baseline'] = cell_baselines[grid_cell['index']]
+            ctr += 1
+    return ctr
+
+
+def get_grid_baselines_array(grid: []):
+    """Returns a (cells x 12) masked array of the grid cell baselines.
+    Months without a baseline, or with a baseline of zero, are masked
+    as they are by the reference anomalies
+    """
+    baselines = np.zeros((len(grid), 12))
+    for grid_cell in grid:
+        baseline = grid_cell.get('baseline')
+        if baseline:
+            baselines[grid_cell['index']] = \
+                [value if value else 0.0 for value in baseline]
+    return np.ma.masked_equal(baselines, 0.0)
+
+
+def update_grid_anomalies_numpy(grid: [], stations_data: {},
+                                station_locations: {},
+                                start_year: int, end_year: int,
+                                min_latitude: float, max_latitude: float,
+                                station_arrays: {} = None) -> int:
+    """Calculates anomalies for each grid cell within a range of years,
+    as update_grid_anomalies
+    """
+    if station_arrays is None:
+        station_arrays = get_station_arrays(stations_data)
+    cells, stations = \
+        get_cell_station_pairs(grid, station_locations, station_arrays,
+                               min_latitude, max_latitude)
+    pair_of_row, rows, years = \
+        get_pair_rows(stations, station_arrays, start_year, end_year)
+    row_cells = cells[pair_of_row]
+
+    anomalies = station_arrays['values'][rows] - \
+        get_grid_baselines_array(grid)[row_cells]
+    valid = ~np.ma.getmaskarray(anomalies)
+    anomalies = anomalies.filled(0)
+
+    no_of_years = end_year + 1 - start_year
+    size = len(grid) * no_of_years
+    keys = row_cells * no_of_years + years - start_year
+    annual_totals = np.bincount(keys, weights=anomalies.sum(axis=1),
+                                minlength=size)
+    annual_hits = np.bincount(keys, weights=valid.sum(axis=1),
+                              minlength=size)
+    month_keys = (keys[:, None] * 12 + np.arange(12)).ravel()
+    monthly_totals = np.bincount(month_keys, weights=anomalies.ravel(),
+                                 minlength=size * 12)
+    monthly_hits = np.bincount(month_keys, weights=valid.ravel(),
+                               minlength=size * 12)
+    annual = _masked_mean(annual_totals, annual_hits)
+    annual = annual.reshape(len(grid), no_of_years)
+    monthly = _masked_mean(monthly_totals, monthly_hits)
+    monthly = monthly.reshape(len(grid), no_of_years, 12)
+
+    # only the cell years which have anomalies have monthly anomalies.
+    # MaskedArray.tolist is slow, so masked values are replaced with None
+    # within an object array
+    has_anomaly = ~np.ma.getmaskarray(annual)
+    monthly = monthly[has_anomaly]
+    monthly_objects = monthly.data.astype(object)
+    monthly_objects[np.ma.getmaskarray(monthly)] = None
+    monthly = iter(monthly_objects.tolist())
+    annual = annual.filled(0).tolist()
+    has_anomaly = has_anomaly.tolist()
+
+    ctr = 0
+    year_ctr = 0
+    for grid_cell in grid:
+        grid_cell['anomalies'] = {}
+        grid_cell['anomalies_monthly'] = {}
+        index = grid_cell['index']
+        if not grid_cell['station_ids']:
+            continue
+        for year_index in range(no_of_years):
+            year = start_year + year_index
+            if not has_anomaly[index][year_index]:
+                grid_cell['anomalies'][year] = None
+                continue
+            grid_cell['anomalies'][year] = annual[index][year_index]
+            grid_cell['anomalies_monthly'][year] = next(monthly)
+        year_ctr += len(grid_cell['anomalies_monthly'])
+        ctr += len(grid_cell['anomalies'])
+    if year_ctr > 0:
+        return int(year_ctr * 100 / float(ctr))
+    return 0
+
+
+def get_global_anomalies_numpy(grid: [],
+                               start_year: int, end_year: int) -> {}:
+    """Returns global anomalies in the given year range,
+    as get_global_anomalies
+    """
+    no_of_years = end_year + 1 - start_year
+    annual = np.zeros((len(grid), no_of_years))
+    for grid_cell in grid:
+        for year, anomaly in grid_cell['anomalies'].items():
+            if anomaly and start_year <= year <= end_year:
+                annual[grid_cell['index'], year - start_year] = anomaly
+    annual = np.ma.masked_equal(annual, 0.0)
+    global_anomalies = annual.mean(axis=0).tolist()
+    return {start_year + year_index: global_anomalies[year_index]
+            for year_index in range(no_of_years)}
+
+
+def get_monthly_anomalies_numpy(grid: [],
+                                start_year: int, end_year: int) -> {}:
+    """Returns monthly anomalies in the given year range,
+    as get_monthly_anomalies
+    """
+    no_of_years = end_year + 1 - start_year
+    monthly = np.full((len(grid), no_of_years, 12), np.nan)
+    has_year = np.zeros(no_of_years, dtype=bool)
+    for grid_cell in grid:
+        for year, anomalies in grid_cell['anomalies_monthly'].items():
+            if anomalies and start_year <= year <= end_year:
+                monthly[grid_cell['index'], year - start_year] = \
+                    [np.nan if anomaly is None else anomaly
+                     for anomaly in anomalies]
+                has_year[year - start_year] = True
+    monthly_anomalies = \
+        np.ma.masked_invalid(monthly).mean(axis=0).tolist()
+    result = {}
+    for year_index in range(no_of_years):
+        result[start_year + year_index] = None
+        if has_year[year_index]:
+            result[start_year + year_index] = monthly_anomalies[year_index]
+    return result
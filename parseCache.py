@@ -0,0 +1,239 @@
+__filename__ = "parseCache.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import os
+import hashlib
+from binaryFile import save_binary_file
+from binaryFile import load_binary_file
+from binaryFile import load_binary_file_header
+from parseData import load_data
+from parseData import load_elements_data
+from stationData import new_station_data
+from parseStations import load_stations
+from parseStations import assign_stations_to_grid
+from parseCountries import load_countries
+from baseline import get_baseline_index
+
+CACHE_VERSION = 2
+
+STORE_ARRAYS = ('years', 'element', 'values', 'dmflag', 'qcflag', 'dsflag')
+
+
+def _cache_filename(filename: str, cache_name: str) -> str:
+    """Returns the cache filename for the given source file
+    """
+    if cache_name:
+        return filename + '.' + cache_name + '.cache'
+    return filename + '.cache'
+
+
+def _file_hash(filename: str) -> str:
+    """Returns a hash of the contents of the given file
+    """
+    file_hash = hashlib.sha256()
+    with open(filename, 'rb') as fp_src:
+        while True:
+            chunk = fp_src.read(1024 * 1024)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _source_key(filename: str, with_hash: bool) -> {}:
+    """Returns the key identifying the current version of a source file
+    """
+    try:
+        stat = os.stat(filename)
+        key = {
+            'version': CACHE_VERSION,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns
+        }
+        if with_hash:
+            key['hash'] = _file_hash(filename)
+    except OSError:
+        return None
+    return key
+
+
+def _cache_is_valid(filename: str, header: {}) -> bool:
+    """Returns true if the cache header matches the source file
+    """
+    if not header:
+        return False
+    cached_key = header.get('source')
+    key = _source_key(filename, False)
+    if not cached_key or not key:
+        return False
+    if cached_key.get('version') != key['version'] or \
+       cached_key.get('size') != key['size']:
+        return False
+    if cached_key.get('mtime') == key['mtime']:
+        return True
+    # mtime changed but the contents may not have
+    try:
+        return cached_key.get('hash') == _file_hash(filename)
+    except OSError:
+        return False
+
+
+def _load_cache(filename: str, cache_name: str = None) -> ({}, {}):
+    """Returns the header and arrays for the cache of a source file,
+    or None if there is no valid cache
+    """
+    cache_filename = _cache_filename(filename, cache_name)
+    if not os.path.isfile(cache_filename):
+        return None, None
+    header = load_binary_file_header(cache_filename)
+    if not _cache_is_valid(filename, header):
+        return None, None
+    return load_binary_file(cache_filename)
+
+
+def _save_cache(filename: str, header: {}, arrays: {},
+                cache_name: str = None) -> None:
+    """Saves a cache for the given source file
+    """
+    key = _source_key(filename, True)
+    if not key:
+        return
+    header['source'] = key
+    save_binary_file(_cache_filename(filename, cache_name), header, arrays)
+
+
+def _element_cache_name(element: str, cache_name: str = None) -> str:
+    """Returns the name of the cache for an element, such as tmax
+    """
+    if cache_name:
+        return element.lower() + '.' + cache_name
+    return element.lower()
+
+
+def _load_data_cache(filename: str, cache_name: str = None) -> {}:
+    """Returns the station data store from a cache, or None if there is
+    no valid cache
+    """
+    header, arrays = _load_cache(filename, cache_name)
+    if not header or arrays is None:
+        return None
+    data = {
+        'stations': {sid: tuple(span)
+                     for sid, span in header['stations'].items()},
+        'elements': header['elements']
+    }
+    for field in STORE_ARRAYS:
+        data[field] = arrays[field]
+    return data
+
+
+def _save_data_cache(filename: str, data: {}, cache_name: str = None) -> None:
+    """Saves a station data store to a cache
+    """
+    header = {
+        'stations': data['stations'],
+        'elements': data['elements']
+    }
+    _save_cache(filename, header,
+                {field: data[field] for field in STORE_ARRAYS}, cache_name)
+
+
+def load_data_cached(filename: str, workers: int = 1) -> {}:
+    """Loads data from file into a station data store, using the cache
+    if it is up to date. Cached arrays are memory mapped
+    """
+    data = _load_data_cache(filename)
+    if data:
+        return data
+    data = load_data(filename, workers)
+    if not data:
+        return None
+    _save_data_cache(filename, data)
+    return data
+
+
+def load_elements_data_cached(filename: str, workers: int,
+                              elements: []) -> {}:
+    """Loads a station data store for each of the given elements, keyed
+    by element name, using a separate cache for each element. Elements
+    which are not cached are loaded in a single pass over the file
+    """
+    element_stores = {}
+    for element in elements:
+        data = _load_data_cache(filename, _element_cache_name(element))
+        if data:
+            element_stores[element] = data
+    missing = [element for element in elements
+               if element not in element_stores]
+    loaded = {}
+    if missing:
+        loaded = load_elements_data(filename, workers,
+                                    elements_filter=missing)
+        if loaded is None:
+            return None
+    for element in missing:
+        # elements without data are also cached, so that the file
+        # is not parsed again to look for them
+        data = loaded.get(element, new_station_data())
+        _save_data_cache(filename, data, _element_cache_name(element))
+        element_stores[element] = data
+    return {element: data for element, data in element_stores.items()
+            if data['stations']}
+
+
+def load_stations_cached(filename: str) -> []:
+    """Loads the list of stations from inv file, using the cache
+    if it is up to date
+    """
+    header, _ = _load_cache(filename, 'stations')
+    if header:
+        return header['stations']
+    stations = load_stations(filename)
+    if stations is not None:
+        _save_cache(filename, {'stations': stations}, {}, 'stations')
+    return stations
+
+
+def load_station_locations_cached(filename: str, grid: []) -> {}:
+    """Loads station locations from inv file, using the cache
+    if it is up to date
+    """
+    stations = load_stations_cached(filename)
+    if stations is None:
+        return None
+    return assign_stations_to_grid(stations, grid)
+
+
+def load_countries_cached(filename: str) -> {}:
+    """Loads countries from file, using the cache if it is up to date
+    """
+    header, _ = _load_cache(filename)
+    if header:
+        return header['countries']
+    countries = load_countries(filename)
+    if countries is not None:
+        _save_cache(filename, {'countries': countries}, {})
+    return countries
+
+
+def load_baseline_index_cached(filename: str, stations_data: {},
+                               element: str = None) -> {}:
+    """Returns the baseline index for station data loaded from the
+    given file, using the cache if it is up to date. If an element is
+    given then the index is for the data of that element
+    """
+    cache_name = 'baseline'
+    if element:
+        cache_name = _element_cache_name(element, cache_name)
+    header, arrays = _load_cache(filename, cache_name)
+    if header and arrays is not None:
+        return arrays
+    baseline_index = get_baseline_index(stations_data)
+    _save_cache(filename, {}, baseline_index, cache_name)
+    return baseline_index
@@ -7,55 +7,290 @@ __email__ = "bob@libreserver.org"
 __status__ = "Production"
 __module_group__ = "Commandline Interface"
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+from archive import ARCHIVE_ERRORS
+from archive import is_archive
+from archive import archive_member_lines
+from stationData import new_station_data
+from stationData import get_element_index
+from stationData import index_station_data
 
-def load_data(filename: str) -> ({}, {}):
-    """Loads data from file
+# position of the value for each month within a line
+MONTH_POSITIONS = tuple(range(20, 20 + (12 * 8), 8))
+
+
+def _station_is_wanted(sid: str, station_filter) -> bool:
+    """Returns true if the station passes the filter, which may be
+    a collection of station ids or a function
     """
-    lines = []
-    try:
-        with open(filename, 'r', encoding='utf-8') as fp_load:
-            lines = fp_load.readlines()
-    except OSError:
-        print('Unable to open ' + filename)
-        return None, None
-    years = {}
-    stations = {}
+    if station_filter is None:
+        return True
+    if callable(station_filter):
+        return station_filter(sid)
+    return sid in station_filter
+
+
+def _parse_rows(lines, start_year: int = 1800, end_year: int = 2099,
+                station_filter=None, elements_filter=None) -> ({}, []):
+    """Parses lines of fixed width data into the rows of a station data
+    store, returning the unindexed store and runs of rows for each station.
+    Lines outside of the year range, or which are not for wanted stations
+    or elements, are skipped before the months are parsed
+    """
+    start_year = max(start_year, 1800)
+    end_year = min(end_year, 2099)
+    if elements_filter is not None:
+        elements_filter = \
+            set(element.encode() for element in elements_filter)
+    wanted_stations = {}
+    data = new_station_data()
+    years = data['years']
+    element_indexes = data['element']
+    values = data['values']
+    dmflags = data['dmflag']
+    qcflags = data['qcflag']
+    dsflags = data['dsflag']
+    elements = {}
+    runs = []
+    run_sid = None
+    run_start = 0
+    row = 0
     for line in lines:
         line = line.strip()
-        if not line:
-            continue
         if len(line) < 20:
             continue
         year = int(line[11:15])
-        if year < 1800 or year > 2099:
+        if year < start_year or year > end_year:
             continue
-        sid = line[:10]
+        sid = line[:10].decode()
+        if station_filter is not None:
+            if sid not in wanted_stations:
+                wanted_stations[sid] = \
+                    _station_is_wanted(sid, station_filter)
+            if not wanted_stations[sid]:
+                continue
         element = line[15:19]
-        month = []
-        line_index = 20
-        for _ in range(12):
-            value = float(line[line_index:line_index + 4]) / 100.0
-            dmflag = line[line_index + 5:line_index + 6]
-            qcflag = line[line_index + 6:line_index + 7]
-            dsflag = line[line_index + 7:line_index + 8]
-            month.append({
-                "av": value,
-                "dmflag": dmflag,
-                "qcflag": qcflag,
-                "dsflag": dsflag
-            })
-            line_index += 8
-        if not stations.get(sid):
-            stations[sid] = {}
-        stations[sid][year] = {
-            'element': element,
-            'month': month
-        }
-        if not years.get(year):
-            years[year] = []
-        years[year].append({
-            'id': sid,
-            'element': element,
-            'month': month
-        })
-    return stations, years
+        if elements_filter is not None:
+            if element not in elements_filter:
+                continue
+        if sid != run_sid:
+            if run_sid is not None:
+                runs.append((run_sid, run_start, row))
+            run_sid = sid
+            run_start = row
+        if element not in elements:
+            elements[element] = get_element_index(data, element.decode())
+        years.append(year)
+        element_indexes.append(elements[element])
+        values.extend([float(line[pos:pos + 4]) / 100.0
+                       for pos in MONTH_POSITIONS])
+        dmflags.extend(line[25:121:8].ljust(12))
+        qcflags.extend(line[26:122:8].ljust(12))
+        dsflags.extend(line[27:123:8].ljust(12))
+        row += 1
+    if run_sid is not None:
+        runs.append((run_sid, run_start, row))
+    return data, runs
+
+
+def _split_elements(data: {}, runs: []) -> {}:
+    """Splits unindexed rows containing several elements into unindexed
+    rows and runs for each element, keyed by element name, so that
+    station years of different elements do not replace each other
+    """
+    if len(data['elements']) <= 1:
+        return {element: (data, runs) for element in data['elements']}
+    parts = {}
+    for element in data['elements']:
+        part = new_station_data()
+        part['elements'].append(element)
+        parts[element] = (part, [])
+    element_names = data['elements']
+    for sid, start_row, end_row in runs:
+        for row in range(start_row, end_row):
+            part, part_runs = parts[element_names[data['element'][row]]]
+            part_row = len(part['years'])
+            if part_runs and part_runs[-1][0] == sid and \
+               part_runs[-1][2] == part_row:
+                part_runs[-1] = (sid, part_runs[-1][1], part_row + 1)
+            else:
+                part_runs.append((sid, part_row, part_row + 1))
+            pos = row * 12
+            part['years'].append(data['years'][row])
+            part['element'].append(0)
+            for field in ('values', 'dmflag', 'qcflag', 'dsflag'):
+                part[field].extend(data[field][pos:pos + 12])
+    return parts
+
+
+def _index_elements(data: {}, runs: []) -> {}:
+    """Returns an indexed station data store for each element
+    """
+    return {element: index_station_data(part, part_runs)
+            for element, (part, part_runs) in
+            _split_elements(data, runs).items()}
+
+
+def _first_element(element_stores: {}, elements_filter=None) -> {}:
+    """Returns the store of the first wanted element which has data,
+    or of the first element within the file
+    """
+    wanted = element_stores
+    if isinstance(elements_filter, (list, tuple)):
+        wanted = elements_filter
+    elif elements_filter:
+        # unordered collections, such as sets, are sorted so that the
+        # same element is chosen every time
+        wanted = sorted(elements_filter)
+    for element in wanted:
+        if element in element_stores:
+            return element_stores[element]
+    return None
+
+
+def _parse_element_lines(lines, start_year: int = 1800,
+                         end_year: int = 2099, station_filter=None,
+                         elements_filter=None) -> {}:
+    """Parses lines of fixed width data into a station data store
+    for each element
+    """
+    data, runs = _parse_rows(lines, start_year, end_year,
+                             station_filter, elements_filter)
+    return _index_elements(data, runs)
+
+
+def parse_lines(lines, start_year: int = 1800, end_year: int = 2099,
+                station_filter=None, elements_filter=None) -> {}:
+    """Parses lines of fixed width data into a station data store
+    """
+    return _first_element(_parse_element_lines(lines, start_year, end_year,
+                                               station_filter,
+                                               elements_filter),
+                          elements_filter)
+
+
+def _get_byte_ranges(filename: str, no_of_ranges: int) -> []:
+    """Returns (start, end) byte ranges which divide the file into
+    roughly equal parts, each starting at the beginning of a line
+    """
+    file_size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, 'rb') as fp_load:
+        for range_index in range(1, no_of_ranges):
+            position = max(file_size * range_index // no_of_ranges,
+                           boundaries[-1], 1)
+            # move to the start of the next line
+            fp_load.seek(position - 1)
+            fp_load.readline()
+            boundaries.append(fp_load.tell())
+    boundaries.append(file_size)
+    byte_ranges = []
+    for range_index in range(no_of_ranges):
+        start = boundaries[range_index]
+        end = boundaries[range_index + 1]
+        if end > start:
+            byte_ranges.append((start, end))
+    return byte_ranges
+
+
+def _parse_byte_range(filename: str, start: int, end: int,
+                      filters: ()) -> ({}, []):
+    """Parses the lines within a byte range of a file
+    """
+    with open(filename, 'rb') as fp_load:
+        fp_load.seek(start)
+        chunk = fp_load.read(end - start)
+    return _parse_rows(chunk.split(b'\n'), *filters)
+
+
+def _merge_rows(parts: []) -> ({}, []):
+    """Merges parsed parts of a file, in file order, into a single
+    unindexed store and list of runs
+    """
+    data = new_station_data()
+    runs = []
+    for part, part_runs in parts:
+        row_offset = len(data['years'])
+        element_map = [get_element_index(data, element)
+                       for element in part['elements']]
+        data['years'].extend(part['years'])
+        data['element'].extend([element_map[element_index]
+                                for element_index in part['element']])
+        for field in ('values', 'dmflag', 'qcflag', 'dsflag'):
+            data[field].extend(part[field])
+        for sid, start_row, end_row in part_runs:
+            start_row += row_offset
+            end_row += row_offset
+            if runs and runs[-1][0] == sid and runs[-1][2] == start_row:
+                # the station continues from the previous part
+                runs[-1] = (sid, runs[-1][1], end_row)
+            else:
+                runs.append((sid, start_row, end_row))
+    return data, runs
+
+
+def _load_data_parallel(filename: str, workers: int, filters: ()) -> {}:
+    """Loads data from file using a pool of worker processes,
+    each parsing a range of lines. Returns a store for each element
+    """
+    byte_ranges = _get_byte_ranges(filename, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(_parse_byte_range,
+                                  [filename] * len(byte_ranges),
+                                  [start for start, _ in byte_ranges],
+                                  [end for _, end in byte_ranges],
+                                  [filters] * len(byte_ranges)))
+    data, runs = _merge_rows(parts)
+    return _index_elements(data, runs)
+
+
+def load_elements_data(filename: str, workers: int = 1,
+                       start_year: int = 1800, end_year: int = 2099,
+                       station_filter=None, elements_filter=None) -> {}:
+    """Loads data from file into a station data store for each element,
+    such as TAVG, TMAX and TMIN, keyed by element name, in a single pass
+    over the file. The arguments are the same as for load_data.
+    Elements without any data are not included
+    """
+    filters = (start_year, end_year, station_filter, elements_filter)
+    try:
+        if is_archive(filename):
+            element_stores = \
+                _parse_element_lines(archive_member_lines(filename, '.dat'),
+                                     *filters)
+        elif workers > 1:
+            element_stores = _load_data_parallel(filename, workers, filters)
+        else:
+            with open(filename, 'rb') as fp_load:
+                element_stores = _parse_element_lines(fp_load, *filters)
+    except ARCHIVE_ERRORS:
+        print('Unable to open ' + filename)
+        return None
+    return {element: data for element, data in element_stores.items()
+            if data['stations']}
+
+
+def load_data(filename: str, workers: int = 1,
+              start_year: int = 1800, end_year: int = 2099,
+              station_filter=None, elements_filter=None) -> {}:
+    """Loads data from file into a station data store.
+    The file may also be a tar archive, in which case the .dat member
+    is streamed from it.
+    If more than one worker is given then the file is parsed in parallel.
+    Only years within start_year <= year <= end_year are loaded.
+    station_filter may be a collection of wanted station ids, or a
+    function taking a station id and returning true if it is wanted.
+    When parsing in parallel the function needs to be picklable, such as
+    a module level function.
+    elements_filter may be a collection of wanted element names, such
+    as TAVG. If the file contains several elements then the store is for
+    the first wanted element, in the order of a list or tuple or else
+    alphabetically, or the first element within the file
+    """
+    element_stores = load_elements_data(filename, workers,
+                                        start_year, end_year,
+                                        station_filter, elements_filter)
+    if not element_stores:
+        return None
+    return _first_element(element_stores, elements_filter)
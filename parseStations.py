@@ -7,66 +7,97 @@ __email__ = "bob@libreserver.org"
 __status__ = "Production"
 __module_group__ = "Commandline Interface"
 
+from archive import ARCHIVE_ERRORS
+from archive import is_archive
+from archive import archive_member_lines
 from grid import get_closest_grid_index
+from grid import get_grid_spatial_index
+from kml import open_kml
+from kml import write_kml_placemark
+from kml import close_kml
 
 
-def load_station_locations(filename: str, grid: []) -> {}:
-    """Loads station locations from inv file
+def parse_station_lines(lines: []) -> []:
+    """Parses lines from an inv file into a list of stations,
+    without any grid assignment
     """
-    lines = []
-    try:
-        with open(filename, 'r', encoding='utf-8') as fp_loc:
-            lines = fp_loc.readlines()
-    except OSError:
-        print('Unable to open ' + filename)
-        return None
-    station_locations = {}
+    stations = []
     for line in lines:
         line = line.strip()
         if not line:
             continue
         if len(line) < 38:
             continue
-        sid = line[:10]
-        latitude = float(line[11:19])
-        longitude = float(line[20:29])
-        altitude = float(line[30:37])
-        name = line[38:].lower().title()
-        grid_index = get_closest_grid_index(longitude, latitude, grid)
+        stations.append({
+            'id': line[:10],
+            'latitude': float(line[11:19]),
+            'longitude': float(line[20:29]),
+            'altitude': float(line[30:37]),
+            'name': line[38:].lower().title()
+        })
+    return stations
+
+
+def assign_stations_to_grid(stations: [], grid: []) -> {}:
+    """Assigns each station to its closest grid cell and returns
+    the station locations
+    """
+    station_locations = {}
+    spatial_index = get_grid_spatial_index(grid)
+    for item in stations:
+        sid = item['id']
+        grid_index = \
+            get_closest_grid_index(item['longitude'], item['latitude'],
+                                   grid, spatial_index)
         if sid not in grid[grid_index]['station_ids']:
             grid[grid_index]['station_ids'].add(sid)
         station_locations[sid] = {
             'grid_index': grid_index,
-            'latitude': latitude,
-            'longitude': longitude,
-            'altitude': altitude,
-            'name': name
+            'latitude': item['latitude'],
+            'longitude': item['longitude'],
+            'altitude': item['altitude'],
+            'name': item['name']
         }
     return station_locations
 
 
+def load_stations(filename: str) -> []:
+    """Loads the list of stations from an inv file, or from the .inv
+    member of a tar archive, without any grid assignment
+    """
+    try:
+        if is_archive(filename):
+            return parse_station_lines(
+                line.decode('utf-8')
+                for line in archive_member_lines(filename, '.inv'))
+        with open(filename, 'r', encoding='utf-8') as fp_loc:
+            return parse_station_lines(fp_loc)
+    except ARCHIVE_ERRORS:
+        print('Unable to open ' + filename)
+    return None
+
+
+def load_station_locations(filename: str, grid: []) -> {}:
+    """Loads station locations from inv file
+    """
+    stations = load_stations(filename)
+    if stations is None:
+        return None
+    return assign_stations_to_grid(stations, grid)
+
+
 def save_station_locations_as_kml(station_locations: {},
                                   filename: str) -> None:
-    """Save station locations in KML format for visualization
+    """Save station locations in KML format for visualization.
+    If the filename ends with .kmz then it is saved as a zipped KML file
     """
-    kml_str = \
-        "<?xml version=\"1.0\" encoding='UTF-8'?>\n" + \
-        "<kml xmlns=\"http://www.opengis.net/kml/2.2\">\n" + \
-        "<Document>\n"
+    kml = open_kml(filename)
+    if not kml:
+        return
     for _, item in station_locations.items():
-        kml_str += \
-            "  <Placemark>\n" + \
-            "    <name>" + str(item['name']) + "</name>\n" + \
-            "    <description>" + str(item['latitude']) + \
-            ' ' + str(item['longitude']) + '</description>\n' + \
-            "    <Point>\n" + \
-            "      <coordinates>" + str(item['longitude']) + "," + \
-            str(item['latitude']) + "," + str(item['altitude']) + \
-            "</coordinates>\n" + \
-            "    </Point>\n" + \
-            "  </Placemark>\n"
-    kml_str += \
-        "</Document>\n" + \
-        "</kml>\n"
-    with open(filename, 'w+', encoding='utf-8') as fp_kml:
-        fp_kml.write(kml_str)
+        write_kml_placemark(kml, item['name'],
+                            str(item['latitude']) + ' ' +
+                            str(item['longitude']),
+                            item['longitude'], item['latitude'],
+                            item['altitude'])
+    close_kml(kml)
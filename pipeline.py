@@ -0,0 +1,562 @@
+__filename__ = "pipeline.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+from parseData import load_data
+from stationData import no_of_rows
+from stationData import no_of_stations
+from parseStations import load_stations
+from parseStations import assign_stations_to_grid
+from parseCountries import load_countries
+from parseCache import load_data_cached
+from parseCache import load_stations_cached
+from parseCache import load_countries_cached
+from parseCache import load_baseline_index_cached
+from grid import get_grid
+from baseline import update_grid_baselines
+from baseline import get_stations_baselines
+from anomaly import update_grid_anomalies
+from anomaly import get_global_anomalies
+from anomaly import get_monthly_anomalies
+from incremental import update_grid_incremental
+from numpyBackend import get_station_arrays
+from numpyBackend import update_grid_baselines_numpy
+from numpyBackend import update_grid_anomalies_numpy
+from numpyBackend import get_global_anomalies_numpy
+from numpyBackend import get_monthly_anomalies_numpy
+from homogenize import HOMOGENIZE_NEIGHBOURS
+from homogenize import homogenize
+from infill import INFILL_RADIUS_KM
+from infill import INFILL_WEIGHTINGS
+from infill import get_infill_weights
+from infill import infill_grid_anomalies
+from countrySeries import parse_country_codes
+from countrySeries import get_station_countries
+from bands import parse_bands
+from bands import get_bands_station_ids
+from profiling import start_stage
+from profiling import end_stage
+
+# default settings, as the names of the commandline options
+PIPELINE_DEFAULTS = {
+    'filename': 'data/v4.mean',
+    'countries': 'data/v4.country.codes',
+    'stations': 'data/wmo.txt',
+    'startYear': 1900,
+    'endYear': 2025,
+    'baselineStart': 1961,
+    'baselineEnd': 1990,
+    'cellsHorizontal': 72,
+    'cellsVertical': 36,
+    'minLatitude': 0,
+    'maxLatitude': 90,
+    'bands': None,
+    'byCountry': None,
+    'serve': None,
+    'workers': 1,
+    'backend': 'python',
+    'cache': True,
+    'homogenize': False,
+    'neighbours': HOMOGENIZE_NEIGHBOURS,
+    'infill': False,
+    'infillRadius': INFILL_RADIUS_KM,
+    'infillWeighting': INFILL_WEIGHTINGS[0],
+    'infillMinStations': 1,
+    'incremental': None
+}
+
+# settings used by each stage, and the earlier stages which it uses
+PIPELINE_STAGES = {
+    'countries': (('countries', 'cache'), ()),
+    'stations': (('stations', 'cache'), ()),
+    'grid': (('cellsHorizontal', 'cellsVertical'), ('stations',)),
+    'data': (('filename', 'cache'), ()),
+    'homogenize': (('homogenize',), ('data',)),
+    'baseline_index': (('homogenize',), ('data',)),
+    'station_arrays': (('backend',), ('homogenize',)),
+    'baselines': (('baselineStart', 'baselineEnd',
+                   'minLatitude', 'maxLatitude', 'backend', 'incremental'),
+                  ('grid', 'homogenize', 'baseline_index', 'station_arrays')),
+    # infilling replaces anomalies in place, so the anomalies are
+    # recalculated when the infill settings change
+    'anomalies': (('startYear', 'endYear', 'infill', 'infillRadius',
+                   'infillWeighting', 'infillMinStations'),
+                  ('baselines',)),
+    'infill': ((), ('anomalies',)),
+    'global_anomalies': ((), ('infill',)),
+    'monthly_anomalies': ((), ('infill',))
+}
+
+# settings which decide the years and stations loaded without the cache
+_DATA_FILTER_SETTINGS = ('startYear', 'endYear',
+                         'baselineStart', 'baselineEnd',
+                         'minLatitude', 'maxLatitude', 'bands', 'byCountry')
+
+
+def new_pipeline(settings: {} = None, profile: {} = None) -> {}:
+    """Returns a new pipeline with the given settings, which are the
+    names of the commandline options, and defaults for any others.
+    If a profile is given then each stage is recorded when calculated
+    """
+    pipeline_settings = PIPELINE_DEFAULTS.copy()
+    if settings:
+        pipeline_settings.update(settings)
+    return {
+        'settings': pipeline_settings,
+        'profile': profile,
+        'stages': {},
+        # number of times that each stage has been calculated
+        'runs': {}
+    }
+
+
+def set_pipeline_settings(pipeline: {}, settings: {}) -> None:
+    """Changes settings of a pipeline. Stages which use them are
+    recalculated when they are next accessed
+    """
+    pipeline['settings'].update(settings)
+
+
+def _stage_inputs(settings: {}, name: str) -> ((), ()):
+    """Returns the settings and earlier stages which a stage uses
+    with the given settings
+    """
+    setting_names, dependencies = PIPELINE_STAGES[name]
+    if name == 'data' and not settings['cache'] and not settings['serve']:
+        # only the years and stations which will be used are loaded
+        setting_names += _DATA_FILTER_SETTINGS
+        dependencies += ('stations',)
+        if settings['byCountry']:
+            dependencies += ('countries',)
+    elif name == 'homogenize' and settings['homogenize']:
+        setting_names += ('startYear', 'endYear',
+                          'baselineStart', 'baselineEnd', 'neighbours')
+        dependencies += ('grid',)
+    return setting_names, dependencies
+
+
+def _stage_key(settings: {}, name: str) -> ():
+    """Returns the key of a stage, from the settings which it uses and
+    the keys of the earlier stages which it uses
+    """
+    setting_names, dependencies = _stage_inputs(settings, name)
+    return (tuple(settings[setting] for setting in setting_names),
+            tuple(_stage_key(settings, dependency)
+                  for dependency in dependencies))
+
+
+def _stage_is_used(settings: {}, name: str) -> bool:
+    """Returns true if a stage calculates anything with the given
+    settings, rather than passing on an earlier stage
+    """
+    if name == 'homogenize':
+        return bool(settings['homogenize'])
+    if name == 'baseline_index':
+        return bool(settings['cache']) and not settings['homogenize']
+    if name == 'station_arrays':
+        return settings['backend'] == 'numpy'
+    if name == 'baselines':
+        # incremental updates calculate the baselines with the anomalies
+        return not settings['incremental']
+    if name == 'infill':
+        return bool(settings['infill'])
+    return True
+
+
+def invalidate_stage(pipeline: {}, name: str) -> None:
+    """Drops a memoized stage and any stages calculated from it,
+    so that they are recalculated when next accessed
+    """
+    dropped = [name]
+    while dropped:
+        used = dropped.pop()
+        if used in pipeline['stages']:
+            del pipeline['stages'][used]
+        for other, memo in list(pipeline['stages'].items()):
+            if used in memo['dependencies']:
+                dropped.append(other)
+
+
+def get_stage(pipeline: {}, name: str):
+    """Returns the value of a stage, calculating it and any earlier
+    stages which it uses if they are not memoized for the current
+    settings. Returns None if the stage could not be calculated
+    """
+    if name not in PIPELINE_STAGES:
+        print('Unknown pipeline stage ' + name)
+        return None
+    settings = pipeline['settings']
+    key = _stage_key(settings, name)
+    memo = pipeline['stages'].get(name)
+    if memo and memo['key'] == key:
+        return memo['value']
+    invalidate_stage(pipeline, name)
+    dependencies = _stage_inputs(settings, name)[1]
+    # earlier stages are calculated first, so that each is profiled
+    # on its own
+    for dependency in dependencies:
+        get_stage(pipeline, dependency)
+    if _stage_is_used(settings, name):
+        stage = start_stage(pipeline['profile'], name)
+        value, items = _STAGE_FUNCTIONS[name](pipeline)
+        end_stage(pipeline['profile'], stage, items)
+    else:
+        value, _ = _STAGE_FUNCTIONS[name](pipeline)
+    pipeline['stages'][name] = {
+        'key': key,
+        'value': value,
+        'dependencies': dependencies
+    }
+    pipeline['runs'][name] = pipeline['runs'].get(name, 0) + 1
+    return value
+
+
+def get_stations_data(pipeline: {}) -> {}:
+    """Returns the station data used to calculate the anomalies,
+    which is homogenized if the homogenize setting is true
+    """
+    homogenized = get_stage(pipeline, 'homogenize')
+    if not homogenized:
+        return None
+    return homogenized['data']
+
+
+def get_anomaly_grid(pipeline: {}) -> []:
+    """Returns the grid cells with their baselines and anomalies,
+    including any infilled cells
+    """
+    if get_stage(pipeline, 'infill') is None:
+        return None
+    return get_stage(pipeline, 'grid')['cells']
+
+
+def _countries_stage(pipeline: {}) -> ({}, int):
+    """Loads the countries
+    """
+    settings = pipeline['settings']
+    print('Loading countries')
+    if settings['cache']:
+        countries = load_countries_cached(settings['countries'])
+    else:
+        countries = load_countries(settings['countries'])
+    if not countries:
+        print('No countries')
+        return None, 0
+    print(str(len(countries)) + ' countries loaded')
+    return countries, len(countries)
+
+
+def _stations_stage(pipeline: {}) -> ([], int):
+    """Loads the list of stations
+    """
+    settings = pipeline['settings']
+    print('Loading station locations')
+    if settings['cache']:
+        stations = load_stations_cached(settings['stations'])
+    else:
+        stations = load_stations(settings['stations'])
+    if not stations:
+        print('No station locations')
+        return None, 0
+    return stations, len(stations)
+
+
+def _grid_stage(pipeline: {}) -> ({}, int):
+    """Returns the grid cells with the stations assigned to them,
+    and the station locations
+    """
+    settings = pipeline['settings']
+    stations = get_stage(pipeline, 'stations')
+    if not stations:
+        return None, 0
+    grid_cells = get_grid(settings['cellsHorizontal'],
+                          settings['cellsVertical'])
+    station_locations = assign_stations_to_grid(stations, grid_cells)
+    print(str(len(grid_cells)) + ' grid cells')
+    print(str(len(station_locations)) + ' station locations loaded')
+    return {
+        'cells': grid_cells,
+        'station_locations': station_locations
+    }, len(grid_cells)
+
+
+def _wanted_station_ids(pipeline: {}) -> set:
+    """Returns the ids of the stations used with the current settings
+    """
+    settings = pipeline['settings']
+    station_locations = \
+        {item['id']: item for item in get_stage(pipeline, 'stations')}
+    if settings['byCountry']:
+        country_codes = \
+            parse_country_codes(settings['byCountry'],
+                                get_stage(pipeline, 'countries') or {})
+        if country_codes:
+            return set(get_station_countries(station_locations,
+                                             country_codes))
+    if settings['bands']:
+        latitude_bands = parse_bands(settings['bands'])
+        if latitude_bands:
+            return get_bands_station_ids(station_locations, latitude_bands)
+    return get_bands_station_ids(station_locations,
+                                 [(settings['minLatitude'],
+                                   settings['maxLatitude'])])
+
+
+def _data_stage(pipeline: {}) -> ({}, int):
+    """Loads the station data
+    """
+    settings = pipeline['settings']
+    print('Loading data from ' + settings['filename'])
+    if settings['cache']:
+        stations_data = load_data_cached(settings['filename'],
+                                         settings['workers'])
+    elif settings['serve']:
+        # queries may be for any years or stations
+        stations_data = load_data(settings['filename'], settings['workers'])
+    elif not get_stage(pipeline, 'stations'):
+        return None, 0
+    else:
+        # only load the years and stations which will be used
+        stations_data = \
+            load_data(settings['filename'], settings['workers'],
+                      min(settings['startYear'], settings['baselineStart']),
+                      max(settings['endYear'], settings['baselineEnd']),
+                      _wanted_station_ids(pipeline))
+    if not stations_data:
+        print('No data')
+        return None, 0
+    print(str(no_of_stations(stations_data)) + ' stations data loaded')
+    return stations_data, no_of_rows(stations_data)
+
+
+def _homogenize_stage(pipeline: {}) -> ({}, int):
+    """Returns the station data adjusted for any breakpoints, together
+    with the breakpoints, or the unadjusted data if not homogenizing
+    """
+    settings = pipeline['settings']
+    stations_data = get_stage(pipeline, 'data')
+    if not stations_data:
+        return None, 0
+    if not settings['homogenize']:
+        return {'data': stations_data, 'breakpoints': []}, 0
+    grid = get_stage(pipeline, 'grid')
+    if not grid:
+        return None, 0
+    print('Homogenizing station data')
+    stations_data, breakpoints = \
+        homogenize(stations_data, grid['station_locations'],
+                   min(settings['startYear'], settings['baselineStart']),
+                   max(settings['endYear'], settings['baselineEnd']),
+                   settings['neighbours'], workers=settings['workers'])
+    print(str(len(breakpoints)) + ' breakpoints adjusted')
+    return {
+        'data': stations_data,
+        'breakpoints': breakpoints
+    }, no_of_stations(stations_data)
+
+
+def _baseline_index_stage(pipeline: {}) -> ({}, int):
+    """Loads the cached baseline index. The index is for the unadjusted
+    data, so it is not used when homogenizing
+    """
+    settings = pipeline['settings']
+    if not _stage_is_used(settings, 'baseline_index'):
+        return None, None
+    stations_data = get_stage(pipeline, 'data')
+    if not stations_data:
+        return None, None
+    return load_baseline_index_cached(settings['filename'],
+                                      stations_data), None
+
+
+def _station_arrays_stage(pipeline: {}) -> ({}, int):
+    """Returns the station data as numpy arrays for the numpy backend
+    """
+    if not _stage_is_used(pipeline['settings'], 'station_arrays'):
+        return None, 0
+    stations_data = get_stations_data(pipeline)
+    if not stations_data:
+        return None, 0
+    return get_station_arrays(stations_data), no_of_rows(stations_data)
+
+
+def _baselines_stage(pipeline: {}) -> (int, int):
+    """Calculates the baseline of each grid cell, returning the number
+    of grid baselines updated
+    """
+    settings = pipeline['settings']
+    grid = get_stage(pipeline, 'grid')
+    stations_data = get_stations_data(pipeline)
+    if not grid or not stations_data:
+        return None, 0
+    if settings['incremental']:
+        return 0, 0
+    if settings['backend'] == 'numpy':
+        print('Calculating reference baseline between ' +
+              str(settings['baselineStart']) + ' and ' +
+              str(settings['baselineEnd']) + ' using numpy')
+        ctr = update_grid_baselines_numpy(grid['cells'], stations_data,
+                                          grid['station_locations'],
+                                          settings['baselineStart'],
+                                          settings['baselineEnd'],
+                                          settings['minLatitude'],
+                                          settings['maxLatitude'],
+                                          get_stage(pipeline,
+                                                    'station_arrays'))
+    else:
+        print('Calculating reference baseline between ' +
+              str(settings['baselineStart']) + ' and ' +
+              str(settings['baselineEnd']))
+        ctr = update_grid_baselines(grid['cells'], stations_data,
+                                    grid['station_locations'],
+                                    settings['baselineStart'],
+                                    settings['baselineEnd'],
+                                    settings['minLatitude'],
+                                    settings['maxLatitude'],
+                                    get_stage(pipeline, 'baseline_index'))
+    print(str(ctr) + ' grid baselines updated')
+    return ctr, ctr
+
+
+def _anomalies_stage(pipeline: {}) -> (int, int):
+    """Calculates the anomalies of each grid cell, returning the
+    percentage of grid anomalies updated, or the number of grid cells
+    recalculated by an incremental update
+    """
+    settings = pipeline['settings']
+    if get_stage(pipeline, 'baselines') is None:
+        return None, 0
+    grid = get_stage(pipeline, 'grid')
+    stations_data = get_stations_data(pipeline)
+    if settings['incremental']:
+        print('Incrementally updating grid baselines and anomalies ' +
+              'using ' + settings['incremental'])
+        ctr = update_grid_incremental(grid['cells'], stations_data,
+                                      grid['station_locations'],
+                                      settings['startYear'],
+                                      settings['endYear'],
+                                      settings['baselineStart'],
+                                      settings['baselineEnd'],
+                                      settings['minLatitude'],
+                                      settings['maxLatitude'],
+                                      settings['incremental'],
+                                      get_stage(pipeline, 'baseline_index'))
+        print(str(ctr) + ' grid cells recalculated')
+        return ctr, ctr
+    if settings['backend'] == 'numpy':
+        print('Calculating grid anomalies between ' +
+              str(settings['startYear']) + ' and ' +
+              str(settings['endYear']) + ' using numpy')
+        percent = update_grid_anomalies_numpy(grid['cells'], stations_data,
+                                              grid['station_locations'],
+                                              settings['startYear'],
+                                              settings['endYear'],
+                                              settings['minLatitude'],
+                                              settings['maxLatitude'],
+                                              get_stage(pipeline,
+                                                        'station_arrays'))
+    else:
+        print('Calculating grid anomalies between ' +
+              str(settings['startYear']) + ' and ' +
+              str(settings['endYear']))
+        percent = update_grid_anomalies(grid['cells'], stations_data,
+                                        grid['station_locations'],
+                                        settings['startYear'],
+                                        settings['endYear'],
+                                        settings['minLatitude'],
+                                        settings['maxLatitude'])
+    print(str(percent) + '% grid anomalies updated')
+    return percent, len(grid['cells'])
+
+
+def _infill_stage(pipeline: {}) -> (int, int):
+    """Infills grid cells without stations, returning the number
+    of grid cells infilled
+    """
+    settings = pipeline['settings']
+    if get_stage(pipeline, 'anomalies') is None:
+        return None, 0
+    if not settings['infill']:
+        return 0, 0
+    grid = get_stage(pipeline, 'grid')
+    stations_data = get_stations_data(pipeline)
+    print('Infilling grid cells from stations within ' +
+          str(settings['infillRadius']) + 'km')
+    infill_weights = \
+        get_infill_weights(grid['cells'], grid['station_locations'],
+                           stations_data['stations'],
+                           settings['infillRadius'],
+                           settings['infillWeighting'],
+                           settings['minLatitude'], settings['maxLatitude'],
+                           settings['infillMinStations'])
+    ctr = infill_grid_anomalies(grid['cells'], infill_weights, stations_data,
+                                get_stations_baselines(
+                                    stations_data,
+                                    settings['baselineStart'],
+                                    settings['baselineEnd'],
+                                    get_stage(pipeline, 'baseline_index')),
+                                settings['startYear'], settings['endYear'],
+                                settings['backend'])
+    print(str(ctr) + ' grid cells infilled')
+    return ctr, len(infill_weights['columns'])
+
+
+def _global_anomalies_stage(pipeline: {}) -> ({}, int):
+    """Returns the global anomaly of each year
+    """
+    settings = pipeline['settings']
+    grid_cells = get_anomaly_grid(pipeline)
+    if grid_cells is None:
+        return None, 0
+    print('Calculating global anomalies between ' +
+          str(settings['startYear']) + ' and ' + str(settings['endYear']))
+    if settings['backend'] == 'numpy':
+        global_anomalies = \
+            get_global_anomalies_numpy(grid_cells, settings['startYear'],
+                                       settings['endYear'])
+    else:
+        global_anomalies = \
+            get_global_anomalies(grid_cells, settings['startYear'],
+                                 settings['endYear'])
+    return global_anomalies, len(global_anomalies)
+
+
+def _monthly_anomalies_stage(pipeline: {}) -> ({}, int):
+    """Returns the monthly anomalies of each year
+    """
+    settings = pipeline['settings']
+    grid_cells = get_anomaly_grid(pipeline)
+    if grid_cells is None:
+        return None, 0
+    print('Calculating monthly anomalies between ' +
+          str(settings['startYear']) + ' and ' + str(settings['endYear']))
+    if settings['backend'] == 'numpy':
+        monthly_anomalies = \
+            get_monthly_anomalies_numpy(grid_cells, settings['startYear'],
+                                        settings['endYear'])
+    else:
+        monthly_anomalies = \
+            get_monthly_anomalies(grid_cells, settings['startYear'],
+                                  settings['endYear'])
+    return monthly_anomalies, len(monthly_anomalies)
+
+
+_STAGE_FUNCTIONS = {
+    'countries': _countries_stage,
+    'stations': _stations_stage,
+    'grid': _grid_stage,
+    'data': _data_stage,
+    'homogenize': _homogenize_stage,
+    'baseline_index': _baseline_index_stage,
+    'station_arrays': _station_arrays_stage,
+    'baselines': _baselines_stage,
+    'anomalies': _anomalies_stage,
+    'infill': _infill_stage,
+    'global_anomalies': _global_anomalies_stage,
+    'monthly_anomalies': _monthly_anomalies_stage
+}
@@ -0,0 +1,148 @@
+__filename__ = "profiling.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _get_rss() -> int:
+    """Returns the current resident set size in bytes, or None
+    if it is not available
+    """
+    try:
+        with open('/proc/self/statm', 'r', encoding='utf-8') as fp_statm:
+            resident_pages = int(fp_statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def _get_max_rss() -> int:
+    """Returns the peak resident set size of the process in bytes,
+    or None if it is not available
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # kilobytes on linux, bytes on macos
+        max_rss *= 1024
+    return max_rss
+
+
+def new_profile(trace_memory: bool = True,
+                cprofile_directory: str = None) -> {}:
+    """Returns a new profile. If trace_memory is true then memory
+    allocations are traced, which slows down the run. If a cprofile
+    directory is given then a cProfile dump is saved there for each stage
+    """
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if cprofile_directory and not os.path.isdir(cprofile_directory):
+        os.makedirs(cprofile_directory)
+    return {
+        'trace_memory': trace_memory,
+        'cprofile_directory': cprofile_directory,
+        'wall_time': time.perf_counter(),
+        'cpu_time': time.process_time(),
+        'stages': []
+    }
+
+
+def start_stage(profile: {}, name: str) -> {}:
+    """Starts recording a stage, returning the stage record
+    """
+    stage = {'name': name}
+    if profile is None:
+        return stage
+    if profile['trace_memory'] and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    if profile['cprofile_directory']:
+        stage['_cprofile'] = cProfile.Profile()
+        stage['_cprofile'].enable()
+    stage['_wall_time'] = time.perf_counter()
+    stage['_cpu_time'] = time.process_time()
+    return stage
+
+
+def end_stage(profile: {}, stage: {}, items: int = None) -> None:
+    """Finishes recording a stage, with an optional count of the
+    number of items which the stage processed
+    """
+    if profile is None:
+        return
+    stage['wall_time'] = time.perf_counter() - stage.pop('_wall_time')
+    stage['cpu_time'] = time.process_time() - stage.pop('_cpu_time')
+    if '_cprofile' in stage:
+        stats = stage.pop('_cprofile')
+        stats.disable()
+        stats_filename = \
+            os.path.join(profile['cprofile_directory'],
+                         str(len(profile['stages'])).zfill(2) + '_' +
+                         stage['name'] + '.prof')
+        stats.dump_stats(stats_filename)
+        stage['cprofile'] = stats_filename
+    if profile['trace_memory'] and tracemalloc.is_tracing():
+        stage['memory_current'], stage['memory_peak'] = \
+            tracemalloc.get_traced_memory()
+    stage['rss'] = _get_rss()
+    stage['max_rss'] = _get_max_rss()
+    if items is not None:
+        stage['items'] = items
+    elif 'items' not in stage:
+        stage['items'] = None
+    profile['stages'].append(stage)
+
+
+@contextmanager
+def profile_stage(profile: {}, name: str):
+    """Records a stage for the duration of a with block.
+    The number of items processed can be set with stage['items']
+    """
+    stage = start_stage(profile, name)
+    try:
+        yield stage
+    finally:
+        end_stage(profile, stage)
+
+
+def get_profile_report(profile: {}) -> {}:
+    """Returns a report of the stages recorded so far
+    """
+    return {
+        'wall_time': time.perf_counter() - profile['wall_time'],
+        'cpu_time': time.process_time() - profile['cpu_time'],
+        'max_rss': _get_max_rss(),
+        'trace_memory': profile['trace_memory'],
+        'stages': profile['stages']
+    }
+
+
+def save_profile(profile: {}, filename: str) -> bool:
+    """Saves a profile report as JSON
+    """
+    if profile is None:
+        return False
+    try:
+        with open(filename, 'w+', encoding='utf-8') as fp_profile:
+            fp_profile.write(json.dumps(get_profile_report(profile),
+                                        indent=2) + '\n')
+    except OSError:
+        print('Unable to save profile ' + filename)
+        return False
+    return True
@@ -0,0 +1,372 @@
+__filename__ = "queryServer.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from urllib.parse import parse_qsl
+from baseline import get_stations_baselines
+from baseline import update_grid_baselines_from_stations
+from anomaly import update_grid_anomalies
+from anomaly import get_global_anomalies
+from anomaly import get_monthly_anomalies
+from bands import parse_bands
+from countrySeries import get_station_countries
+from countrySeries import get_country_index
+from countrySeries import get_country_grids
+from countrySeries import update_country_anomalies
+
+QUERY_TYPES = ('global', 'monthly', 'band', 'country', 'cell')
+
+# parameters of each query and their types
+QUERY_PARAMS = {
+    'startYear': int,
+    'endYear': int,
+    'baselineStart': int,
+    'baselineEnd': int,
+    'minLatitude': float,
+    'maxLatitude': float
+}
+
+# range of years which can be queried, the same as is loaded from
+# the data file
+QUERY_YEARS = (1800, 2099)
+
+# number of station baseline windows and calculated grids kept
+GRID_CACHE_SIZE = 8
+
+
+def new_query_state(stations_data: {}, grid: [], station_locations: {},
+                    countries: {}, defaults: {}, baseline_index: {} = None,
+                    cache_size: int = 256) -> {}:
+    """Returns the resident state of a query server, for stations which
+    have already been assigned to the grid.
+    defaults contains the default value of each query parameter
+    """
+    station_countries = \
+        get_station_countries(station_locations, sorted(countries.keys()))
+    country_index = get_country_index(grid, station_countries)
+    return {
+        'stations_data': stations_data,
+        'baseline_index': baseline_index,
+        'countries': countries,
+        'grid': grid,
+        'station_locations': station_locations,
+        'country_index': country_index,
+        'country_grids': get_country_grids(grid, country_index,
+                                           station_countries),
+        'defaults': defaults,
+        'cache_size': cache_size,
+        'results': OrderedDict(),
+        'station_baselines': OrderedDict(),
+        'grids': OrderedDict(),
+        'lock': threading.Lock(),
+        # a single thread, because calculations share the grid
+        'executor': ThreadPoolExecutor(max_workers=1),
+        'hits': 0,
+        'misses': 0
+    }
+
+
+def _cache_get(state: {}, cache_name: str, key: (),
+               count_miss: bool = False):
+    """Returns an item from an LRU cache, or None.
+    Lookups of query results are counted as hits, and as misses if
+    count_miss is true, under the same lock as the cache
+    """
+    with state['lock']:
+        cache = state[cache_name]
+        if key not in cache:
+            if count_miss:
+                state['misses'] += 1
+            return None
+        cache.move_to_end(key)
+        if cache_name == 'results':
+            state['hits'] += 1
+        return cache[key]
+
+
+def _cache_put(state: {}, cache_name: str, key: (), value,
+               max_size: int) -> None:
+    """Adds an item to an LRU cache, removing the least recently used
+    item if the cache is full
+    """
+    with state['lock']:
+        cache = state[cache_name]
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+
+def get_query_params(query_type: str, query: {}, defaults: {}) -> {}:
+    """Returns the parameters of a query, with defaults for any which
+    are not given. Raises ValueError if a parameter is invalid
+    """
+    if query_type not in QUERY_TYPES:
+        raise ValueError('Unknown query ' + query_type)
+    params = {'type': query_type}
+    for name, param_type in QUERY_PARAMS.items():
+        params[name] = param_type(query.get(name, defaults[name]))
+    for name in ('startYear', 'endYear', 'baselineStart', 'baselineEnd'):
+        if not QUERY_YEARS[0] <= params[name] <= QUERY_YEARS[1]:
+            raise ValueError(name + ' should be between ' +
+                             str(QUERY_YEARS[0]) + ' and ' +
+                             str(QUERY_YEARS[1]))
+    for name in ('minLatitude', 'maxLatitude'):
+        # this also excludes nan and inf
+        if not -90 <= params[name] <= 90:
+            raise ValueError(name + ' should be between -90 and 90')
+    if params['endYear'] < params['startYear']:
+        raise ValueError('endYear should not be before startYear')
+    if query_type == 'band':
+        bands = parse_bands(query.get('band', ''))
+        if not bands or len(bands) != 1:
+            raise ValueError('A single band is needed, such as 0:30')
+        params['minLatitude'], params['maxLatitude'] = bands[0]
+    elif query_type == 'country':
+        params['code'] = query.get('code', '').upper()
+        if not params['code']:
+            raise ValueError('A country code is needed')
+    elif query_type == 'cell':
+        params['index'] = int(query.get('index', -1))
+    if params['minLatitude'] >= params['maxLatitude']:
+        raise ValueError('minLatitude should be less than maxLatitude')
+    return params
+
+
+def _get_station_baselines(state: {}, start_year: int, end_year: int) -> {}:
+    """Returns the baselines of every station for a baseline window
+    """
+    key = (start_year, end_year)
+    station_baselines = _cache_get(state, 'station_baselines', key)
+    if station_baselines is None:
+        station_baselines = \
+            get_stations_baselines(state['stations_data'],
+                                   start_year, end_year,
+                                   state['baseline_index'])
+        _cache_put(state, 'station_baselines', key, station_baselines,
+                   GRID_CACHE_SIZE)
+    return station_baselines
+
+
+def _snapshot_grid(grid: []) -> []:
+    """Returns the results held within grid cells. The anomalies are
+    replaced rather than updated by later calculations, so they can be
+    referenced rather than copied
+    """
+    return [{
+        'index': grid_cell['index'],
+        'latitude': grid_cell['latitude'],
+        'longitude': grid_cell['longitude'],
+        'stations': len(grid_cell['station_ids']),
+        'baseline': grid_cell.get('baseline'),
+        'anomalies': grid_cell.get('anomalies', {}),
+        'anomalies_monthly': grid_cell.get('anomalies_monthly', {})
+    } for grid_cell in grid]
+
+
+def _get_grid_results(state: {}, params: {}) -> []:
+    """Returns the baselines and anomalies of every grid cell for the
+    baseline window, years and latitude range of a query
+    """
+    key = (params['baselineStart'], params['baselineEnd'],
+           params['startYear'], params['endYear'],
+           params['minLatitude'], params['maxLatitude'])
+    grid_results = _cache_get(state, 'grids', key)
+    if grid_results is not None:
+        return grid_results
+    grid = state['grid']
+    update_grid_baselines_from_stations(
+        grid, _get_station_baselines(state, params['baselineStart'],
+                                     params['baselineEnd']),
+        state['station_locations'],
+        params['minLatitude'], params['maxLatitude'])
+    update_grid_anomalies(grid, state['stations_data'],
+                          state['station_locations'],
+                          params['startYear'], params['endYear'],
+                          params['minLatitude'], params['maxLatitude'])
+    grid_results = _snapshot_grid(grid)
+    _cache_put(state, 'grids', key, grid_results, GRID_CACHE_SIZE)
+    return grid_results
+
+
+def _get_country_results(state: {}, params: {}) -> []:
+    """Returns the baselines and anomalies of the grid cells of a country
+    """
+    code = params['code']
+    country_grid = state['country_grids'][code]
+    station_countries = {}
+    for sid in state['country_index'][code]['station_ids']:
+        station_countries[sid] = [code]
+    update_country_anomalies(state['grid'], {code: country_grid},
+                             station_countries, state['stations_data'],
+                             params['startYear'], params['endYear'],
+                             params['baselineStart'], params['baselineEnd'],
+                             state['baseline_index'])
+    return _snapshot_grid(country_grid)
+
+
+def _calculate_query(state: {}, params: {}) -> (int, {}):
+    """Calculates the result of a query, returning an HTTP status
+    and the result
+    """
+    start_year = params['startYear']
+    end_year = params['endYear']
+    result = {'query': params}
+    if params['type'] == 'country':
+        code = params['code']
+        if code not in state['countries']:
+            return 404, {'error': 'Unknown country ' + code}
+        if code not in state['country_grids']:
+            return 404, {'error': 'No stations for country ' + code}
+        grid_results = _get_country_results(state, params)
+        result['name'] = state['countries'][code]
+        result['annual'] = \
+            get_global_anomalies(grid_results, start_year, end_year)
+        result['monthly'] = \
+            get_monthly_anomalies(grid_results, start_year, end_year)
+        return 200, result
+    grid_results = _get_grid_results(state, params)
+    if params['type'] == 'cell':
+        if params['index'] < 0 or params['index'] >= len(grid_results):
+            return 404, {'error': 'Unknown grid cell'}
+        cell = grid_results[params['index']]
+        for name in ('latitude', 'longitude', 'stations', 'baseline'):
+            result[name] = cell[name]
+        result['annual'] = cell['anomalies']
+        result['monthly'] = cell['anomalies_monthly']
+        return 200, result
+    if params['type'] in ('global', 'band'):
+        result['annual'] = \
+            get_global_anomalies(grid_results, start_year, end_year)
+    if params['type'] in ('monthly', 'band'):
+        result['monthly'] = \
+            get_monthly_anomalies(grid_results, start_year, end_year)
+    return 200, result
+
+
+def _result_key(params: {}) -> ():
+    """Returns the cache key for the parameters of a query
+    """
+    return tuple(sorted(params.items()))
+
+
+def query_series(state: {}, params: {}) -> (int, str):
+    """Returns the HTTP status and JSON result of a query, using the
+    result cache if possible
+    """
+    key = _result_key(params)
+    cached = _cache_get(state, 'results', key, True)
+    if cached is not None:
+        return cached
+    status, result = _calculate_query(state, params)
+    response = (status, json.dumps(result))
+    if status == 200:
+        _cache_put(state, 'results', key, response, state['cache_size'])
+    return response
+
+
+async def _query_response(state: {}, target: str) -> (int, str):
+    """Returns the HTTP status and JSON body for a request target
+    """
+    url = urlsplit(target)
+    query_type = url.path.strip('/')
+    if query_type in ('', 'status'):
+        with state['lock']:
+            cached, hits, misses = \
+                len(state['results']), state['hits'], state['misses']
+        return 200, json.dumps({
+            'queries': list(QUERY_TYPES),
+            'cells': len(state['grid']),
+            'stations': len(state['station_locations']),
+            'cached': cached,
+            'hits': hits,
+            'misses': misses
+        })
+    try:
+        params = get_query_params(query_type, dict(parse_qsl(url.query)),
+                                  state['defaults'])
+    except ValueError as exc:
+        status = 400
+        if query_type not in QUERY_TYPES:
+            status = 404
+        return status, json.dumps({'error': str(exc)})
+    # answered without waiting for any calculation in progress.
+    # Misses are counted when the query is calculated
+    cached = _cache_get(state, 'results', _result_key(params))
+    if cached is not None:
+        return cached
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(state['executor'],
+                                      query_series, state, params)
+
+
+async def _handle_connection(state: {}, reader, writer) -> None:
+    """Handles an HTTP request
+    """
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed'}
+    try:
+        request_line = (await reader.readline()).decode('latin-1')
+        while True:
+            header = await reader.readline()
+            if not header or header in (b'\r\n', b'\n'):
+                break
+        parts = request_line.split()
+        if len(parts) < 2:
+            status, body = 400, json.dumps({'error': 'Bad request'})
+        elif parts[0] != 'GET':
+            status, body = 405, json.dumps({'error': 'Only GET'})
+        else:
+            status, body = await _query_response(state, parts[1])
+        body_bytes = body.encode('utf-8')
+        writer.write(('HTTP/1.1 ' + str(status) + ' ' + reasons[status] +
+                      '\r\n' +
+                      'Content-Type: application/json\r\n' +
+                      'Content-Length: ' + str(len(body_bytes)) + '\r\n' +
+                      'Connection: close\r\n\r\n').encode('latin-1') +
+                     body_bytes)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_query_server(state: {}, address: str):
+    """Starts serving queries on an address such as 127.0.0.1:8080,
+    or unix:/path/to/socket, returning the asyncio server
+    """
+    def handler(reader, writer):
+        return _handle_connection(state, reader, writer)
+
+    if address.startswith('unix:'):
+        return await asyncio.start_unix_server(handler, path=address[5:])
+    host, port = address.rsplit(':', 1)
+    return await asyncio.start_server(handler, host, int(port))
+
+
+def run_query_server(state: {}, address: str) -> None:
+    """Serves queries until interrupted
+    """
+    async def serve():
+        server = await start_query_server(state, address)
+        print('Serving queries on ' + address)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    state['executor'].shutdown()
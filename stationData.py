@@ -0,0 +1,141 @@
+__filename__ = "stationData.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+from array import array
+from bisect import bisect_left
+
+# quality control flag indicating that a monthly value is in error
+QCFLAG_ERROR = ord('M')
+
+
+def new_station_data() -> {}:
+    """Returns an empty station data store. Each row is a station year,
+    with twelve monthly values and flags, and the rows of a station are
+    contiguous and in ascending year order
+    """
+    return {
+        'stations': {},
+        'years': array('H'),
+        'element': array('B'),
+        'elements': [],
+        'values': array('d'),
+        'dmflag': bytearray(),
+        'qcflag': bytearray(),
+        'dsflag': bytearray()
+    }
+
+
+def no_of_rows(data: {}) -> int:
+    """Returns the number of station years within the store
+    """
+    return len(data['years'])
+
+
+def no_of_stations(data: {}) -> int:
+    """Returns the number of stations within the store
+    """
+    return len(data['stations'])
+
+
+def station_rows(data: {}, sid: str) -> range:
+    """Returns the rows for the given station id
+    """
+    span = data['stations'].get(sid)
+    if not span:
+        return range(0)
+    return range(span[0], span[1])
+
+
+def get_row(data: {}, sid: str, year: int) -> int:
+    """Returns the row for the given station id and year,
+    or None if there is no data
+    """
+    span = data['stations'].get(sid)
+    if not span:
+        return None
+    years = data['years']
+    row = bisect_left(years, year, span[0], span[1])
+    if row < span[1] and years[row] == year:
+        return row
+    return None
+
+
+def get_year_rows(data: {}, sid: str,
+                  start_year: int, end_year: int) -> range:
+    """Returns the rows for the given station id with years
+    within start_year <= year < end_year
+    """
+    span = data['stations'].get(sid)
+    if not span:
+        return range(0)
+    years = data['years']
+    return range(bisect_left(years, start_year, span[0], span[1]),
+                 bisect_left(years, end_year, span[0], span[1]))
+
+
+def get_element_index(data: {}, element: str) -> int:
+    """Returns the index for the given element name,
+    adding it if needed
+    """
+    if element not in data['elements']:
+        data['elements'].append(element)
+    return data['elements'].index(element)
+
+
+def _reorder_rows(data: {}, runs: []) -> {}:
+    """Returns a copy of the store with rows grouped by station and
+    sorted by year. Where a station year appears more than once
+    the last one wins
+    """
+    years = data['years']
+    station_year_rows = {}
+    for sid, start_row, end_row in runs:
+        if sid not in station_year_rows:
+            station_year_rows[sid] = {}
+        year_rows = station_year_rows[sid]
+        for row in range(start_row, end_row):
+            year_rows[years[row]] = row
+
+    result = new_station_data()
+    result['elements'] = data['elements']
+    for sid, year_rows in station_year_rows.items():
+        first_row = len(result['years'])
+        for year in sorted(year_rows):
+            row = year_rows[year]
+            pos = row * 12
+            result['years'].append(year)
+            result['element'].append(data['element'][row])
+            for field in ('values', 'dmflag', 'qcflag', 'dsflag'):
+                result[field].extend(data[field][pos:pos + 12])
+        result['stations'][sid] = (first_row, len(result['years']))
+    return result
+
+
+def index_station_data(data: {}, runs: []) -> {}:
+    """Builds the station index from runs of (sid, first row, last row + 1)
+    in the order in which they were added. If each station has a single
+    run in ascending year order then the rows are indexed in place,
+    otherwise they are reordered
+    """
+    years = data['years']
+    ordered = True
+    for sid, start_row, end_row in runs:
+        if sid in data['stations']:
+            ordered = False
+            break
+        for row in range(start_row + 1, end_row):
+            if years[row] <= years[row - 1]:
+                ordered = False
+                break
+        if not ordered:
+            break
+        data['stations'][sid] = (start_row, end_row)
+    if ordered:
+        return data
+    return _reorder_rows(data, runs)
@@ -8,21 +8,66 @@ __status__ = "Production"
 __module_group__ = "Commandline Interface"
 
 # import os
-import sys
 import argparse
-from parseData import load_data
-from parseStations import load_station_locations
+from parseData import load_elements_data
+from stationData import no_of_rows
+from stationData import no_of_stations
 from parseStations import save_station_locations_as_kml
 from tests import run_all_tests
-from parseCountries import load_countries
-from grid import get_grid
+from parseCache import load_baseline_index_cached
+from parseCache import load_elements_data_cached
 from grid import save_grid_as_kml
-from baseline import update_grid_baselines
-from anomaly import update_grid_anomalies
-from anomaly import get_global_anomalies
 from anomaly import plot_global_anomalies
-from anomaly import get_monthly_anomalies
 from anomaly import plot_monthly_anomalies
+from anomaly import save_series_csv
+from numpyBackend import BACKENDS
+from numpyBackend import numpy_available
+from numpyBackend import update_grid_baselines_numpy
+from numpyBackend import update_grid_anomalies_numpy
+from batch import run_batch
+from pipeline import PIPELINE_DEFAULTS
+from pipeline import new_pipeline
+from pipeline import get_stage
+from pipeline import get_stations_data
+from pipeline import get_anomaly_grid
+from uncertainty import get_anomaly_matrix
+from uncertainty import bootstrap_anomalies
+from homogenize import save_breakpoints
+from anomalyCube import save_anomaly_cube
+from infill import INFILL_WEIGHTINGS
+from uncertainty import save_anomalies_uncertainty
+from uncertainty import save_monthly_uncertainty
+from uncertainty import plot_anomalies_uncertainty
+from queryServer import new_query_state
+from queryServer import run_query_server
+from profiling import new_profile
+from profiling import start_stage
+from profiling import end_stage
+from profiling import save_profile
+from gnuplotRenderer import new_renderer
+from gnuplotRenderer import finish_renderer
+from countrySeries import parse_country_codes
+from countrySeries import get_station_countries
+from countrySeries import get_country_index
+from countrySeries import get_country_grids
+from countrySeries import update_country_anomalies
+from countrySeries import country_series_name
+from gridPyramid import parse_resolutions
+from gridPyramid import resolution_name
+from gridPyramid import get_grid_pyramid
+from gridPyramid import assign_stations_to_pyramid
+from gridPyramid import update_pyramid_anomalies
+from elements import parse_elements
+from elements import get_element_grids
+from elements import update_element_baselines
+from elements import update_element_anomalies
+from bands import parse_bands
+from bands import band_name
+from bands import get_station_bands
+from bands import get_bands_station_ids
+from bands import get_band_grids
+from bands import update_band_baselines
+from bands import update_band_anomalies
 
 
 def str2bool(value) -> bool:
@@ -39,38 +84,150 @@ def str2bool(value) -> bool:
 
 parser = argparse.ArgumentParser(description='tempgraph2')
 parser.add_argument('--filename', '-f', type=str,
-                    default='data/v4.mean',
+                    default=PIPELINE_DEFAULTS['filename'],
                     help='Filename for the series data')
 parser.add_argument('--countries', '-c', type=str,
-                    default='data/v4.country.codes',
+                    default=PIPELINE_DEFAULTS['countries'],
                     help='County codes')
 parser.add_argument('--stations', type=str,
-                    default='data/wmo.txt',
+                    default=PIPELINE_DEFAULTS['stations'],
                     help='Station locations filename')
+parser.add_argument('--archive', type=str,
+                    default=None,
+                    help='GHCN archive, such as ' +
+                    'data/ghcnm.tavg.latest.qcf.tar.gz, from which the ' +
+                    'series data and station locations are read')
 parser.add_argument('--start', '--startYear', dest='startYear', type=int,
-                    default=1900,
+                    default=PIPELINE_DEFAULTS['startYear'],
                     help='Start year')
 parser.add_argument('--end', '--endYear', dest='endYear', type=int,
-                    default=2025,
+                    default=PIPELINE_DEFAULTS['endYear'],
                     help='End year')
 parser.add_argument('--baselineStart', dest='baselineStart', type=int,
-                    default=1961,
+                    default=PIPELINE_DEFAULTS['baselineStart'],
                     help='Reference baseline start year')
 parser.add_argument('--baselineEnd', dest='baselineEnd', type=int,
-                    default=1990,
+                    default=PIPELINE_DEFAULTS['baselineEnd'],
                     help='Reference baseline end year')
 parser.add_argument('--cellsHorizontal', dest='cellsHorizontal', type=int,
-                    default=72,
+                    default=PIPELINE_DEFAULTS['cellsHorizontal'],
                     help='Number of cells across the grid')
 parser.add_argument('--cellsVertical', dest='cellsVertical', type=int,
-                    default=36,
+                    default=PIPELINE_DEFAULTS['cellsVertical'],
                     help='Number of cells down the grid')
 parser.add_argument('--minLatitude', dest='minLatitude', type=float,
-                    default=0,
+                    default=PIPELINE_DEFAULTS['minLatitude'],
                     help='Minimum latitude')
 parser.add_argument('--maxLatitude', dest='maxLatitude', type=float,
-                    default=90,
+                    default=PIPELINE_DEFAULTS['maxLatitude'],
                     help='Maximum latitude')
+parser.add_argument('--bands', dest='bands', type=str,
+                    default=PIPELINE_DEFAULTS['bands'],
+                    help='Latitude bands to calculate in a single pass, ' +
+                    'such as 0:30,30:60,60:90,-90:0')
+parser.add_argument('--resolutions', dest='resolutions', type=str,
+                    default=None,
+                    help='Grid resolutions to compare, such as ' +
+                    '36x18,72x36,144x72')
+parser.add_argument('--elements', dest='elements', type=str,
+                    default=None,
+                    help='Elements to calculate in a single pass, ' +
+                    'such as TAVG,TMAX,TMIN')
+parser.add_argument('--byCountry', dest='byCountry', type=str,
+                    default=PIPELINE_DEFAULTS['byCountry'],
+                    help='Calculate a series for each of the given ' +
+                    'country codes, such as US,UK,FR, or all countries')
+parser.add_argument('--workers', dest='workers', type=int,
+                    default=PIPELINE_DEFAULTS['workers'],
+                    help='Number of processes used to parse the data')
+parser.add_argument('--backend', dest='backend', type=str,
+                    default=PIPELINE_DEFAULTS['backend'], choices=BACKENDS,
+                    help='Backend used to calculate the baselines and ' +
+                    'anomalies')
+parser.add_argument('--bootstrap', dest='bootstrap', type=int,
+                    default=0,
+                    help='Number of bootstrap replicates used to estimate ' +
+                    'confidence intervals for the global anomalies, ' +
+                    'which requires numpy')
+parser.add_argument('--confidence', dest='confidence', type=float,
+                    default=95,
+                    help='Percentage confidence interval of the bootstrap')
+parser.add_argument('--seed', dest='seed', type=int,
+                    default=None,
+                    help='Random seed, so that bootstrap intervals can ' +
+                    'be reproduced')
+parser.add_argument("--homogenize", type=str2bool, nargs='?',
+                    const=True, default=PIPELINE_DEFAULTS['homogenize'],
+                    help="Adjust the station data for breakpoints found " +
+                    "by comparison with neighbouring stations, " +
+                    "which requires numpy")
+parser.add_argument('--neighbours', dest='neighbours', type=int,
+                    default=PIPELINE_DEFAULTS['neighbours'],
+                    help='Number of neighbouring stations used for ' +
+                    'homogenization')
+parser.add_argument("--infill", type=str2bool, nargs='?',
+                    const=True, default=PIPELINE_DEFAULTS['infill'],
+                    help="Estimate the anomalies of grid cells without " +
+                    "stations from the stations within a radius")
+parser.add_argument('--infillRadius', dest='infillRadius', type=float,
+                    default=PIPELINE_DEFAULTS['infillRadius'],
+                    help='Great circle radius in km of the stations ' +
+                    'used to infill a grid cell')
+parser.add_argument('--infillWeighting', dest='infillWeighting', type=str,
+                    default=PIPELINE_DEFAULTS['infillWeighting'],
+                    choices=INFILL_WEIGHTINGS,
+                    help='Weighting of the stations used to infill a ' +
+                    'grid cell by their distance')
+parser.add_argument('--infillMinStations', dest='infillMinStations',
+                    type=int, default=PIPELINE_DEFAULTS['infillMinStations'],
+                    help='Grid cells with fewer stations than this ' +
+                    'are infilled')
+parser.add_argument('--anomalyMap', dest='anomalyMap', type=str,
+                    default=None,
+                    help='KML or KMZ filename for a map of the baseline ' +
+                    'and yearly anomalies of each grid cell')
+parser.add_argument('--cube', dest='cube', type=str,
+                    default=None,
+                    help='Filename to export the baselines and anomalies ' +
+                    'of every grid cell as a memory mappable binary cube')
+parser.add_argument("--kmz", type=str2bool, nargs='?',
+                    const=True, default=False,
+                    help="Save the stations and grid as zipped KMZ files")
+parser.add_argument('--plotWorkers', dest='plotWorkers', type=int,
+                    default=2,
+                    help='Number of gnuplot processes used to render plots')
+parser.add_argument('--batch', dest='batch', type=str,
+                    default=None,
+                    help='JSON or TOML file listing many jobs to run ' +
+                    'after loading the data once')
+parser.add_argument('--serve', dest='serve', type=str,
+                    default=PIPELINE_DEFAULTS['serve'],
+                    help='Keep the data loaded and answer queries for ' +
+                    'anomaly series on an address such as ' +
+                    '127.0.0.1:8080 or unix:/path/to/socket')
+parser.add_argument('--cacheSize', dest='cacheSize', type=int,
+                    default=256,
+                    help='Number of query results cached by the server')
+parser.add_argument('--incremental', dest='incremental', type=str,
+                    default=PIPELINE_DEFAULTS['incremental'],
+                    help='State file used to recalculate only the grid ' +
+                    'cells and years which have changed since the last run')
+parser.add_argument('--profile', dest='profile', type=str,
+                    default=None,
+                    help='Filename for a JSON report of the time and ' +
+                    'memory used by each stage')
+parser.add_argument('--profileDir', dest='profileDir', type=str,
+                    default=None,
+                    help='Directory where cProfile statistics are saved ' +
+                    'for each stage when profiling')
+parser.add_argument("--profileMemory", dest='profileMemory',
+                    type=str2bool, nargs='?',
+                    const=True, default=True,
+                    help="Trace memory allocations when profiling, " +
+                    "which slows down the run")
+parser.add_argument("--cache", type=str2bool, nargs='?',
+                    const=True, default=PIPELINE_DEFAULTS['cache'],
+                    help="Cache parsed input files next to the data")
 parser.add_argument("--debug", type=str2bool, nargs='?',
                     const=True, default=False,
                     help="Show debug")
@@ -78,76 +235,543 @@ parser.add_argument("--tests", type=str2bool, nargs='?',
                     const=True, default=False,
                     help="Run unit tests")
 
-args = parser.parse_args()
 
-DEBUG = False
-if args.debug:
-    DEBUG = True
+def _finish(profile: {}, profile_filename: str) -> None:
+    """Saves any profile at the end of a run
+    """
+    if save_profile(profile, profile_filename):
+        print('Profile saved to ' + profile_filename)
+    print('Done')
 
-if args.tests:
-    run_all_tests()
-    sys.exit()
 
-if args.endYear <= args.startYear:
-    print('End year should be greater than ' + str(args.startYear))
-    sys.exit()
+def _save_kml(pipeline: {}, kmz: bool) -> None:
+    """Saves the stations and the grid in KML or KMZ format
+    """
+    grid = get_stage(pipeline, 'grid')
+    stage = start_stage(pipeline['profile'], 'kml')
+    kml_extension = 'kml'
+    if kmz:
+        kml_extension = 'kmz'
+    save_station_locations_as_kml(grid['station_locations'],
+                                  'stations.' + kml_extension)
+    print('Saved stations as ' + kml_extension.upper())
 
-if __name__ == "__main__":
-    grid_cells = get_grid(args.cellsHorizontal, args.cellsVertical)
-    print(str(len(grid_cells)) + ' grid cells')
-    print('Loading countries')
-    countries = load_countries(args.countries)
-    if not countries:
-        print('No countries')
-        sys.exit()
-    print(str(len(countries.items())) + ' countries loaded')
-    print('Loading station locations')
-    station_locations = load_station_locations(args.stations, grid_cells)
-    if not station_locations:
-        print('No station locations')
-        sys.exit()
-    print(str(len(station_locations.items())) + ' station locations loaded')
-
-    save_station_locations_as_kml(station_locations, 'stations.kml')
-    print('Saved stations as KML')
-
-    save_grid_as_kml(grid_cells, 'grid.kml')
-    print('Saved grid as KML')
+    save_grid_as_kml(grid['cells'], 'grid.' + kml_extension)
+    print('Saved grid as ' + kml_extension.upper())
+    end_stage(pipeline['profile'], stage,
+              len(grid['station_locations']) + len(grid['cells']))
 
-    if args.minLatitude >= args.maxLatitude:
-        args.minLatitude = 0
-        args.maxLatitude = 90
 
-    print('Loading data from ' + args.filename)
-    stations_data, years_data = \
-        load_data(args.filename)
-    if not stations_data:
+def _load_stations_data(pipeline: {}) -> {}:
+    """Returns the station data, saving any breakpoints found by
+    homogenization
+    """
+    stations_data = get_stations_data(pipeline)
+    if stations_data and pipeline['settings']['homogenize']:
+        save_breakpoints('breakpoints.csv',
+                         get_stage(pipeline, 'homogenize')['breakpoints'],
+                         get_stage(pipeline, 'grid')['station_locations'])
+    return stations_data
+
+
+def _run_elements(pipeline: {}, args, element_names: []) -> bool:
+    """Calculates and plots the anomalies of several elements
+    """
+    profile = pipeline['profile']
+    grid = get_stage(pipeline, 'grid')
+    grid_cells = grid['cells']
+    station_locations = grid['station_locations']
+    print('Loading ' + ','.join(element_names) + ' data from ' +
+          args.filename)
+    stage = start_stage(profile, 'data')
+    if args.cache:
+        elements_data = \
+            load_elements_data_cached(args.filename, args.workers,
+                                      element_names)
+    else:
+        elements_data = \
+            load_elements_data(args.filename, args.workers,
+                               min(args.startYear, args.baselineStart),
+                               max(args.endYear, args.baselineEnd),
+                               get_bands_station_ids(
+                                   station_locations,
+                                   [(args.minLatitude,
+                                     args.maxLatitude)]),
+                               element_names)
+    if not elements_data:
         print('No data')
-        sys.exit()
-    print(str(len(stations_data.items())) + ' stations data loaded')
+        return False
+    end_stage(profile, stage,
+              sum(no_of_rows(data) for data in elements_data.values()))
+    baseline_indexes = {}
+    if args.cache:
+        stage = start_stage(profile, 'baseline_index')
+        for element, data in elements_data.items():
+            baseline_indexes[element] = \
+                load_baseline_index_cached(args.filename, data, element)
+        end_stage(profile, stage)
+    element_grids = get_element_grids(grid_cells, elements_data)
+    print('Calculating baselines and anomalies for ' +
+          str(len(element_grids)) + ' elements')
+    stage = start_stage(profile, 'baselines')
+    element_ctr = \
+        update_element_baselines(grid_cells, element_grids,
+                                 elements_data, station_locations,
+                                 args.baselineStart, args.baselineEnd,
+                                 args.minLatitude, args.maxLatitude,
+                                 baseline_indexes)
+    end_stage(profile, stage, sum(element_ctr.values()))
+    stage = start_stage(profile, 'anomalies')
+    element_percent = \
+        update_element_anomalies(grid_cells, element_grids,
+                                 elements_data, station_locations,
+                                 args.startYear, args.endYear,
+                                 args.minLatitude, args.maxLatitude)
+    end_stage(profile, stage, len(element_grids) * len(grid_cells))
+    stage = start_stage(profile, 'plot')
+    renderer = new_renderer(args.plotWorkers)
+    for element in element_names:
+        if element not in element_grids:
+            print(element + ': no data')
+            continue
+        name = element.lower()
+        print(element + ': ' +
+              str(no_of_stations(elements_data[element])) +
+              ' stations, ' + str(element_ctr[element]) +
+              ' grid baselines updated, ' +
+              str(element_percent[element]) +
+              '% grid anomalies updated')
+        save_series_csv('element_anomalies_' + name + '.csv',
+                        element_grids[element],
+                        args.startYear, args.endYear)
+        plot_global_anomalies(element_grids[element],
+                              args.startYear, args.endYear,
+                              args.baselineStart, args.baselineEnd,
+                              args.minLatitude, args.maxLatitude,
+                              'global_anomalies_' + name,
+                              renderer, element)
+        plot_monthly_anomalies(element_grids[element],
+                               args.endYear-100, args.endYear,
+                               args.baselineStart, args.baselineEnd,
+                               args.minLatitude, args.maxLatitude,
+                               'monthly_anomalies_' + name,
+                               renderer, element)
+    print(str(finish_renderer(renderer)) + ' plots rendered')
+    end_stage(profile, stage, len(element_grids) * 2)
+    return True
+
+
+def _run_countries(pipeline: {}, args, countries: {},
+                   country_codes: []) -> bool:
+    """Calculates and plots the anomalies of each country
+    """
+    profile = pipeline['profile']
+    grid = get_stage(pipeline, 'grid')
+    grid_cells = grid['cells']
+    stations_data = get_stations_data(pipeline)
+    station_countries = \
+        get_station_countries(grid['station_locations'], country_codes)
+    country_index = get_country_index(grid_cells, station_countries)
+    country_grids = get_country_grids(grid_cells, country_index,
+                                      station_countries)
+    print('Calculating baselines and anomalies for ' +
+          str(len(country_grids)) + ' countries')
+    stage = start_stage(profile, 'countries_anomalies')
+    country_percent = \
+        update_country_anomalies(grid_cells, country_grids,
+                                 station_countries, stations_data,
+                                 args.startYear, args.endYear,
+                                 args.baselineStart, args.baselineEnd,
+                                 get_stage(pipeline, 'baseline_index'))
+    end_stage(profile, stage, len(country_grids))
+    stage = start_stage(profile, 'plot')
+    renderer = new_renderer(args.plotWorkers)
+    for code in country_codes:
+        if code not in country_grids:
+            print(countries[code] + ': no stations')
+            continue
+        name = country_series_name(code, countries)
+        print(countries[code] + ': ' +
+              str(len(country_index[code]['station_ids'])) +
+              ' stations, ' + str(country_percent[code]) +
+              '% grid anomalies updated')
+        save_series_csv('country_anomalies_' + name + '.csv',
+                        country_grids[code],
+                        args.startYear, args.endYear)
+        plot_global_anomalies(country_grids[code],
+                              args.startYear, args.endYear,
+                              args.baselineStart, args.baselineEnd,
+                              -90, 90, 'global_anomalies_' + name,
+                              renderer, countries[code])
+        plot_monthly_anomalies(country_grids[code],
+                               args.endYear-100, args.endYear,
+                               args.baselineStart, args.baselineEnd,
+                               -90, 90, 'monthly_anomalies_' + name,
+                               renderer, countries[code])
+    print(str(finish_renderer(renderer)) + ' plots rendered')
+    end_stage(profile, stage, len(country_grids) * 2)
+    return True
+
+
+def _run_resolutions(pipeline: {}, args, grid_resolutions: []) -> bool:
+    """Calculates and plots the anomalies at several grid resolutions
+    """
+    profile = pipeline['profile']
+    print('Assigning stations to ' + str(len(grid_resolutions)) +
+          ' grid resolutions')
+    stage = start_stage(profile, 'grid_pyramid')
+    pyramid = get_grid_pyramid(grid_resolutions)
+    assign_stations_to_pyramid(get_stage(pipeline, 'stations'), pyramid)
+    end_stage(profile, stage, len(pyramid['levels']))
+    print('Calculating baselines and anomalies for ' +
+          str(len(pyramid['levels'])) + ' grid resolutions')
+    stage = start_stage(profile, 'anomalies')
+    pyramid_results = \
+        update_pyramid_anomalies(pyramid, get_stations_data(pipeline),
+                                 args.startYear, args.endYear,
+                                 args.baselineStart, args.baselineEnd,
+                                 args.minLatitude, args.maxLatitude,
+                                 get_stage(pipeline, 'baseline_index'))
+    end_stage(profile, stage, len(pyramid['levels']))
+    stage = start_stage(profile, 'plot')
+    renderer = new_renderer(args.plotWorkers)
+    for level in pyramid['levels']:
+        name = resolution_name(level['resolution'])
+        ctr, percent = pyramid_results[level['resolution']]
+        print('Grid ' + name + ': ' + str(ctr) +
+              ' grid baselines updated, ' + str(percent) +
+              '% grid anomalies updated')
+        plot_global_anomalies(level['grid'],
+                              args.startYear, args.endYear,
+                              args.baselineStart, args.baselineEnd,
+                              args.minLatitude, args.maxLatitude,
+                              'global_anomalies_' + name, renderer)
+        plot_monthly_anomalies(level['grid'],
+                               args.endYear-100, args.endYear,
+                               args.baselineStart, args.baselineEnd,
+                               args.minLatitude, args.maxLatitude,
+                               'monthly_anomalies_' + name, renderer)
+    print(str(finish_renderer(renderer)) + ' plots rendered')
+    end_stage(profile, stage, len(pyramid['levels']) * 2)
+    return True
+
+
+def _run_bands(pipeline: {}, args, latitude_bands: []) -> bool:
+    """Calculates and plots the anomalies of each latitude band
+    """
+    profile = pipeline['profile']
+    grid = get_stage(pipeline, 'grid')
+    grid_cells = grid['cells']
+    station_locations = grid['station_locations']
+    stations_data = get_stations_data(pipeline)
+    station_arrays = get_stage(pipeline, 'station_arrays')
+    station_bands = get_station_bands(station_locations, latitude_bands)
+    band_grids = get_band_grids(grid_cells, station_bands, latitude_bands)
     print('Calculating reference baseline between ' +
-          str(args.baselineStart) + ' and ' + str(args.baselineEnd))
-    CTR = update_grid_baselines(grid_cells, stations_data, station_locations,
-                                args.baselineStart, args.baselineEnd,
-                                args.minLatitude, args.maxLatitude)
-    print(str(CTR) + ' grid baselines updated')
+          str(args.baselineStart) + ' and ' + str(args.baselineEnd) +
+          ' for ' + str(len(latitude_bands)) + ' latitude bands')
+    stage = start_stage(profile, 'baselines')
+    if args.backend == 'numpy':
+        band_ctr = {}
+        for band in latitude_bands:
+            band_ctr[band] = \
+                update_grid_baselines_numpy(band_grids[band],
+                                            stations_data,
+                                            station_locations,
+                                            args.baselineStart,
+                                            args.baselineEnd,
+                                            band[0], band[1],
+                                            station_arrays)
+    else:
+        band_ctr = \
+            update_band_baselines(grid_cells, band_grids,
+                                  station_bands, stations_data,
+                                  args.baselineStart, args.baselineEnd,
+                                  get_stage(pipeline, 'baseline_index'))
+    end_stage(profile, stage, sum(band_ctr.values()))
     print('Calculating grid anomalies between ' +
-          str(args.startYear) + ' and ' + str(args.endYear))
-    percent = update_grid_anomalies(grid_cells, stations_data, station_locations,
-                                    args.startYear, args.endYear,
-                                    args.minLatitude, args.maxLatitude)
-    print(str(percent) + '% grid anomalies updated')
-    print('Calculating global anomalies between ' +
-          str(args.startYear) + ' and ' + str(args.endYear))
-    globalAnom = get_global_anomalies(grid_cells, args.startYear, args.endYear)
+          str(args.startYear) + ' and ' + str(args.endYear) +
+          ' for ' + str(len(latitude_bands)) + ' latitude bands')
+    stage = start_stage(profile, 'anomalies')
+    if args.backend == 'numpy':
+        band_percent = {}
+        for band in latitude_bands:
+            band_percent[band] = \
+                update_grid_anomalies_numpy(band_grids[band],
+                                            stations_data,
+                                            station_locations,
+                                            args.startYear, args.endYear,
+                                            band[0], band[1],
+                                            station_arrays)
+    else:
+        band_percent = \
+            update_band_anomalies(grid_cells, band_grids,
+                                  station_bands, stations_data,
+                                  args.startYear, args.endYear)
+    end_stage(profile, stage, len(latitude_bands) * len(grid_cells))
+    stage = start_stage(profile, 'plot')
+    renderer = new_renderer(args.plotWorkers)
+    for band in latitude_bands:
+        name = band_name(band)
+        print('Latitude band ' + name + ': ' +
+              str(band_ctr[band]) + ' grid baselines updated, ' +
+              str(band_percent[band]) + '% grid anomalies updated')
+        plot_global_anomalies(band_grids[band],
+                              args.startYear, args.endYear,
+                              args.baselineStart, args.baselineEnd,
+                              band[0], band[1],
+                              'global_anomalies_' + name, renderer)
+        plot_monthly_anomalies(band_grids[band],
+                               args.endYear-100, args.endYear,
+                               args.baselineStart, args.baselineEnd,
+                               band[0], band[1],
+                               'monthly_anomalies_' + name, renderer)
+    print(str(finish_renderer(renderer)) + ' plots rendered')
+    end_stage(profile, stage, len(latitude_bands) * 2)
+    return True
+
+
+def _run_series(pipeline: {}, args) -> bool:
+    """Calculates, saves and plots the global and monthly anomalies
+    """
+    profile = pipeline['profile']
+    global_anomalies = get_stage(pipeline, 'global_anomalies')
+    if global_anomalies is None:
+        return False
+    grid_cells = get_anomaly_grid(pipeline)
+    if args.anomalyMap:
+        stage = start_stage(profile, 'anomaly_map')
+        save_grid_as_kml(grid_cells, args.anomalyMap, True)
+        end_stage(profile, stage, len(grid_cells))
+        print('Saved anomaly map as ' + args.anomalyMap)
+    if args.cube:
+        stage = start_stage(profile, 'anomaly_cube')
+        cube_settings = {
+            'baseline_start': args.baselineStart,
+            'baseline_end': args.baselineEnd,
+            'min_latitude': args.minLatitude,
+            'max_latitude': args.maxLatitude,
+            'cells_horizontal': args.cellsHorizontal,
+            'cells_vertical': args.cellsVertical,
+            'infill': args.infill
+        }
+        if save_anomaly_cube(args.cube, grid_cells,
+                             args.startYear, args.endYear, cube_settings):
+            print('Saved anomaly cube as ' + args.cube)
+        end_stage(profile, stage, len(grid_cells))
+    monthly_anomalies = get_stage(pipeline, 'monthly_anomalies')
+    intervals = None
+    if args.bootstrap > 0:
+        print('Calculating ' + ('%g' % args.confidence) +
+              '% confidence intervals from ' + str(args.bootstrap) +
+              ' bootstrap replicates')
+        stage = start_stage(profile, 'bootstrap')
+        anomaly_matrix = \
+            get_anomaly_matrix(grid_cells, get_stations_data(pipeline),
+                               get_stage(pipeline,
+                                         'grid')['station_locations'],
+                               args.startYear, args.endYear,
+                               args.minLatitude, args.maxLatitude,
+                               get_stage(pipeline, 'station_arrays'))
+        intervals = bootstrap_anomalies(anomaly_matrix, args.bootstrap,
+                                        args.confidence, args.seed,
+                                        args.workers)
+        end_stage(profile, stage, args.bootstrap)
+        print('Bootstrap seed ' + str(intervals['seed']))
+        if save_anomalies_uncertainty('global_anomalies_uncertainty.csv',
+                                      global_anomalies, intervals):
+            print('Saved confidence intervals to ' +
+                  'global_anomalies_uncertainty.csv')
+        if save_monthly_uncertainty('monthly_anomalies_uncertainty.csv',
+                                    monthly_anomalies, intervals):
+            print('Saved monthly confidence intervals to ' +
+                  'monthly_anomalies_uncertainty.csv')
+    stage = start_stage(profile, 'plot')
+    renderer = new_renderer(args.plotWorkers)
     plot_global_anomalies(grid_cells, args.startYear, args.endYear,
                           args.baselineStart, args.baselineEnd,
-                          args.minLatitude, args.maxLatitude)
-    print('Calculating monthly anomalies between ' +
-          str(args.startYear) + ' and ' + str(args.endYear))
-    monthlyAnom = get_monthly_anomalies(grid_cells, args.startYear, args.endYear)
+                          args.minLatitude, args.maxLatitude,
+                          'global_anomalies', renderer)
+    if intervals:
+        plot_anomalies_uncertainty(global_anomalies, intervals,
+                                   args.startYear, args.endYear,
+                                   args.baselineStart, args.baselineEnd,
+                                   args.minLatitude, args.maxLatitude,
+                                   'global_anomalies_uncertainty', renderer)
     plot_monthly_anomalies(grid_cells, args.endYear-100, args.endYear,
                            args.baselineStart, args.baselineEnd,
-                           args.minLatitude, args.maxLatitude)
-    print('Done')
-    sys.exit()
+                           args.minLatitude, args.maxLatitude,
+                           'monthly_anomalies', renderer)
+    print(str(finish_renderer(renderer)) + ' plots rendered')
+    end_stage(profile, stage, 2)
+    return True
+
+
+def main() -> None:
+    """Runs with the commandline options. The stages of the run
+    come from a pipeline, so they can also be used from Python
+    """
+    args = parser.parse_args()
+
+    if args.tests:
+        run_all_tests()
+        return
+
+    if args.endYear <= args.startYear:
+        print('End year should be greater than ' + str(args.startYear))
+        return
+
+    if args.archive:
+        # the .dat and .inv files are streamed from the archive
+        args.filename = args.archive
+        args.stations = args.archive
+
+    if args.backend == 'numpy' and not numpy_available():
+        print('The numpy backend requires numpy to be installed')
+        return
+
+    if args.bootstrap > 0 and not numpy_available():
+        print('Bootstrap confidence intervals require numpy to be installed')
+        return
+
+    if args.homogenize and not numpy_available():
+        print('Homogenization requires numpy to be installed')
+        return
+
+    if not 0 < args.confidence < 100:
+        print('Confidence should be a percentage between 0 and 100')
+        return
+
+    if args.neighbours < 1:
+        print('The number of neighbours should be at least 1')
+        return
+
+    if not args.infillRadius > 0:
+        print('The infill radius should be greater than zero')
+        return
+
+    if args.infillMinStations < 1:
+        print('The minimum number of stations for infilling ' +
+              'should be at least 1')
+        return
+
+    latitude_bands = None
+    if args.bands:
+        latitude_bands = parse_bands(args.bands)
+        if not latitude_bands:
+            print('Invalid latitude bands ' + args.bands)
+            return
+
+    grid_resolutions = None
+    if args.resolutions:
+        grid_resolutions = parse_resolutions(args.resolutions)
+        if not grid_resolutions:
+            print('Invalid grid resolutions ' + args.resolutions)
+            return
+
+    element_names = None
+    if args.elements:
+        element_names = parse_elements(args.elements)
+        if not element_names:
+            print('Invalid elements ' + args.elements)
+            return
+
+    modes = [option for option, value in (('--batch', args.batch),
+                                          ('--elements', element_names),
+                                          ('--serve', args.serve),
+                                          ('--byCountry', args.byCountry),
+                                          ('--resolutions', grid_resolutions),
+                                          ('--bands', latitude_bands))
+             if value]
+    if len(modes) > 1:
+        print('Only one of ' + ', '.join(modes) + ' can be given')
+        return
+
+    # options which are not used by each mode
+    series_options = ('--cube', '--anomalyMap', '--bootstrap', '--infill',
+                      '--incremental')
+    unused_options = {
+        '--batch': series_options + ('--homogenize', '--backend numpy',
+                                     '--profile'),
+        '--elements': series_options + ('--homogenize', '--backend numpy'),
+        '--serve': series_options + ('--backend numpy', '--profile'),
+        '--byCountry': series_options + ('--backend numpy',),
+        '--resolutions': series_options + ('--backend numpy',),
+        '--bands': series_options
+    }
+    given_options = {
+        '--cube': args.cube,
+        '--anomalyMap': args.anomalyMap,
+        '--bootstrap': args.bootstrap > 0,
+        '--infill': args.infill,
+        '--incremental': args.incremental,
+        '--homogenize': args.homogenize,
+        '--backend numpy': args.backend == 'numpy',
+        '--profile': args.profile
+    }
+    if modes:
+        for option in unused_options[modes[0]]:
+            if given_options[option]:
+                print(option + ' can not be used with ' + modes[0])
+                return
+
+    profile = None
+    if args.profile:
+        profile = new_profile(args.profileMemory, args.profileDir)
+
+    if args.batch:
+        # settings not given within the job file come from the options
+        run_batch(args.batch, vars(args), args.filename, args.stations,
+                  args.workers, args.cache)
+        return
+
+    if args.minLatitude >= args.maxLatitude:
+        args.minLatitude = 0
+        args.maxLatitude = 90
+
+    pipeline = new_pipeline(vars(args), profile)
+    countries = get_stage(pipeline, 'countries')
+    if not countries:
+        return
+    country_codes = None
+    if args.byCountry:
+        country_codes = parse_country_codes(args.byCountry, countries)
+        if not country_codes:
+            print('Invalid country codes ' + args.byCountry)
+            return
+    grid = get_stage(pipeline, 'grid')
+    if not grid:
+        return
+    _save_kml(pipeline, args.kmz)
+
+    if element_names:
+        if _run_elements(pipeline, args, element_names):
+            _finish(profile, args.profile)
+        return
+
+    stations_data = _load_stations_data(pipeline)
+    if not stations_data:
+        return
+    if args.serve:
+        run_query_server(new_query_state(stations_data, grid['cells'],
+                                         grid['station_locations'],
+                                         countries, pipeline['settings'],
+                                         get_stage(pipeline,
+                                                   'baseline_index'),
+                                         args.cacheSize),
+                         args.serve)
+        return
+    if country_codes:
+        completed = _run_countries(pipeline, args, countries, country_codes)
+    elif grid_resolutions:
+        completed = _run_resolutions(pipeline, args, grid_resolutions)
+    elif latitude_bands:
+        completed = _run_bands(pipeline, args, latitude_bands)
+    else:
+        completed = _run_series(pipeline, args)
+    if completed:
+        _finish(profile, args.profile)
+
+
+if __name__ == "__main__":
+    main()
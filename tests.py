@@ -7,8 +7,1212 @@ __email__ = "bob@libreserver.org"
 __status__ = "Production"
 __module_group__ = "Commandline Interface"
 
+import os
+import math
+import json
+import io
+import asyncio
+import random
+import shutil
+import zipfile
+import xml.etree.ElementTree as ET
+import tarfile
+import tempfile
+from array import array
+from parseData import parse_lines
+from parseData import load_data
+from parseData import load_elements_data
+from parseCache import load_elements_data_cached
+from elements import parse_elements
+from elements import get_element_grids
+from elements import update_element_baselines
+from elements import update_element_anomalies
+from parseCountries import load_countries
+from binaryFile import save_binary_file
+from binaryFile import load_binary_file
+from anomalyCube import save_anomaly_cube
+from anomalyCube import open_anomaly_cube
+from anomalyCube import read_cube_cells
+from anomalyCube import read_cube_year
+from parseStations import parse_station_lines
+from parseStations import load_stations
+from parseStations import assign_stations_to_grid
+from parseStations import load_station_locations
+from parseStations import save_station_locations_as_kml
+from grid import get_grid
+from grid import save_grid_as_kml
+from grid import get_grid_spatial_index
+from grid import get_closest_grid_index
+from grid import get_spatial_index
+from grid import get_nearest_point_indexes
+from grid import get_points_within_distance
+from grid import lat_long_to_3d
+from baseline import update_grid_baselines
+from baseline import get_baseline_index
+from baseline import get_grid_baselines
+from baseline import get_stations_baselines
+from anomaly import stations_anomaly
+from anomaly import get_station_anomalies
+from anomaly import update_grid_anomalies
+from anomaly import get_global_anomalies
+from anomaly import get_monthly_anomalies
+from anomaly import plot_global_anomalies
+from anomaly import plot_monthly_anomalies
+from countrySeries import parse_country_codes
+from countrySeries import get_station_countries
+from countrySeries import get_country_index
+from countrySeries import get_country_grids
+from countrySeries import update_country_anomalies
+from countrySeries import country_series_name
+from bands import parse_bands
+from bands import get_station_bands
+from bands import get_band_grids
+from bands import update_band_baselines
+from bands import update_band_anomalies
+from incremental import update_grid_incremental
+from benchmark import generate_dataset
+from batch import run_batch
+from pipeline import new_pipeline
+from pipeline import set_pipeline_settings
+from pipeline import get_stage
+from queryServer import new_query_state
+from queryServer import start_query_server
+from gridPyramid import parse_resolutions
+from gridPyramid import get_grid_pyramid
+from gridPyramid import get_pyramid_level
+from gridPyramid import assign_stations_to_pyramid
+from gridPyramid import update_pyramid_anomalies
+from gnuplotRenderer import new_renderer
+from gnuplotRenderer import queue_plot
+from gnuplotRenderer import finish_renderer
+from gnuplotRenderer import gnuplot_escape
+from profiling import new_profile
+from profiling import start_stage
+from profiling import end_stage
+from profiling import profile_stage
+from profiling import save_profile
+from numpyBackend import numpy_available
+from numpyBackend import update_grid_baselines_numpy
+from numpyBackend import update_grid_anomalies_numpy
+from numpyBackend import get_global_anomalies_numpy
+from numpyBackend import get_monthly_anomalies_numpy
+from uncertainty import get_anomaly_matrix
+from uncertainty import bootstrap_anomalies
+from homogenize import homogenize
+from infill import get_infill_weights
+from infill import infill_grid_anomalies
+from stationData import get_row
+from stationData import get_year_rows
+from stationData import no_of_stations
+from stationData import QCFLAG_ERROR
+
+
+def _test_data_line(sid: str, year: int, values: [],
+                    element: str = 'TAVG') -> bytes:
+    """Returns a fixed width data line
+    """
+    line = sid + '0' + str(year) + element
+    for value in values:
+        line += str(int(value * 100)).rjust(5) + '  ' + ' '
+    return line.encode()
+
+
+def _test_station_data() -> None:
+    """Test the columnar station data store
+    """
+    lines = [
+        _test_data_line('ABC0000001', 1951, [1.5] * 12),
+        _test_data_line('ABC0000002', 1960, [2.5] * 12),
+        _test_data_line('ABC0000001', 1950, [0.5] * 12),
+        _test_data_line('ABC0000001', 1951, [3.5] * 12),
+        b'short line'
+    ]
+    data = parse_lines(lines)
+    assert no_of_stations(data) == 2
+    assert get_row(data, 'ABC0000001', 1949) is None
+    assert get_row(data, 'ABC0000003', 1950) is None
+    row = get_row(data, 'ABC0000001', 1951)
+    assert data['years'][row] == 1951
+    # the last duplicate station year wins
+    assert data['values'][row * 12] == 3.5
+    row = get_row(data, 'ABC0000001', 1950)
+    assert data['values'][row * 12 + 11] == 0.5
+    assert len(get_year_rows(data, 'ABC0000001', 1950, 1951)) == 1
+    assert len(get_year_rows(data, 'ABC0000001', 1900, 2000)) == 2
+
+
+def _test_dataset(no_of_stations: int, seed: int) -> ([], {}, {}):
+    """Returns a grid, station locations and station data
+    for a random set of stations
+    """
+    rand = random.Random(seed)
+    station_lines = []
+    data_lines = []
+    for station_index in range(no_of_stations):
+        sid = 'TST' + str(station_index).zfill(7)
+        station_lines.append(sid + '0 ' +
+                             str(rand.uniform(-90, 90))[:8].rjust(8) + ' ' +
+                             str(rand.uniform(-180, 180))[:9].rjust(9) +
+                             '  100.0 Test Station')
+        first_year = rand.randint(1900, 1980)
+        for year in range(first_year, rand.randint(first_year, 2020)):
+            values = [rand.uniform(-30, 30) for _ in range(12)]
+            # missing values
+            values[rand.randint(0, 11)] = -99.99
+            data_lines.append(_test_data_line(sid, year, values))
+    grid = get_grid(8, 4)
+    station_locations = \
+        assign_stations_to_grid(parse_station_lines(station_lines), grid)
+    return grid, station_locations, parse_lines(data_lines)
+
+
+def _test_cell_anomalies() -> None:
+    """Test that the station first anomalies are the same as
+    calculating each cell year and month separately
+    """
+    grid, station_locations, data = _test_dataset(40, 1)
+    update_grid_baselines(grid, data, station_locations, 1950, 1980, -45, 90)
+    update_grid_anomalies(grid, data, station_locations, 1930, 2020, -45, 90)
+    for grid_cell in grid:
+        if not grid_cell['station_ids']:
+            continue
+        for year in range(1930, 2021):
+            anomaly = \
+                stations_anomaly(year, data, station_locations,
+                                 grid_cell['baseline'],
+                                 grid_cell['station_ids'], -45, 90, -1)
+            assert grid_cell['anomalies'][year] == anomaly
+            if anomaly is None:
+                assert year not in grid_cell['anomalies_monthly']
+                continue
+            for month_index in range(12):
+                anomaly = \
+                    stations_anomaly(year, data, station_locations,
+                                     grid_cell['baseline'],
+                                     grid_cell['station_ids'], -45, 90,
+                                     month_index)
+                assert grid_cell['anomalies_monthly'][year][month_index] == \
+                    anomaly
+
+
+def _test_baseline_index() -> None:
+    """Test that baselines from the baseline index are the same as
+    summing over the years of each window
+    """
+    grid, station_locations, data = _test_dataset(30, 3)
+    baseline_index = get_baseline_index(data)
+    windows = [(1951, 1980), (1961, 1990), (1900, 2020), (1970, 1970),
+               (1990, 1980)]
+    baselines = get_grid_baselines(grid, data, station_locations, windows,
+                                   -90, 90)
+    assert baselines == \
+        get_grid_baselines(grid, data, station_locations, windows,
+                           -90, 90, baseline_index)
+    update_grid_baselines(grid, data, station_locations, 1961, 1990,
+                          -90, 90, baseline_index)
+    for grid_cell in grid:
+        assert grid_cell.get('baseline') == \
+            baselines[(1961, 1990)][grid_cell['index']]
+
+
+def _test_grid_spatial_index() -> None:
+    """Test that the spatial index finds the same closest grid cells
+    as checking every cell
+    """
+    rand = random.Random(2)
+    for cells_horizontal, cells_vertical in ((2, 1), (8, 4), (72, 36)):
+        grid = get_grid(cells_horizontal, cells_vertical)
+        spatial_index = get_grid_spatial_index(grid)
+        locations = [(0, 90), (0, -90), (180, 0), (-180, 0),
+                     (grid[1]['longitude'], grid[1]['latitude'])]
+        for _ in range(500):
+            locations.append((rand.uniform(-180, 180), rand.uniform(-90, 90)))
+        for longitude, latitude in locations:
+            assert get_closest_grid_index(longitude, latitude, grid,
+                                          spatial_index) == \
+                get_closest_grid_index(longitude, latitude, grid)
+    # nearest points compared with sorting every point
+    points = [lat_long_to_3d(rand.uniform(-180, 180),
+                             rand.uniform(-90, 90)) for _ in range(300)]
+    for bucket_size in (0.1, 0.5, 2.0):
+        spatial_index = get_spatial_index(points, bucket_size)
+        for idx, point in enumerate(points[:50]):
+            nearest = sorted((sum((point[axis] - other[axis]) ** 2
+                                  for axis in range(3)), other_index)
+                             for other_index, other in enumerate(points)
+                             if other_index != idx)
+            assert get_nearest_point_indexes(spatial_index, point[0],
+                                             point[1], point[2], 7, idx) == \
+                [other_index for _, other_index in nearest[:7]]
+        assert len(get_nearest_point_indexes(spatial_index, 0, 0, 1,
+                                             500)) == len(points)
+        assert get_nearest_point_indexes(spatial_index, 0, 0, 1, 0) == []
+        for point in points[:20]:
+            assert get_points_within_distance(spatial_index, point[0],
+                                              point[1], point[2], 0.3) == \
+                [other_index for other_index, other in enumerate(points)
+                 if math.dist(point, other) <= 0.3]
+
+
+def _test_latitude_bands() -> None:
+    """Test that calculating many latitude bands together gives the same
+    results as calculating each band separately
+    """
+    assert parse_bands('0:30, 30:60,-90:0') == \
+        [(0.0, 30.0), (30.0, 60.0), (-90.0, 0.0)]
+    assert parse_bands('30:0') is None
+    assert parse_bands('0-30') is None
+    grid, station_locations, data = _test_dataset(40, 4)
+    bands = parse_bands('0:30,30:90,-90:0,-90:90')
+    station_bands = get_station_bands(station_locations, bands)
+    band_grids = get_band_grids(grid, station_bands, bands)
+    update_band_baselines(grid, band_grids, station_bands, data, 1951, 1980)
+    update_band_anomalies(grid, band_grids, station_bands, data, 1940, 2020)
+    for band in bands:
+        update_grid_baselines(grid, data, station_locations, 1951, 1980,
+                              band[0], band[1])
+        update_grid_anomalies(grid, data, station_locations, 1940, 2020,
+                              band[0], band[1])
+        assert get_global_anomalies(grid, 1940, 2020) == \
+            get_global_anomalies(band_grids[band], 1940, 2020)
+        assert get_monthly_anomalies(grid, 1940, 2020) == \
+            get_monthly_anomalies(band_grids[band], 1940, 2020)
+
+
+def _test_parallel_load_data() -> None:
+    """Test that parsing the data in parallel gives the same
+    result as parsing it serially
+    """
+    rand = random.Random(5)
+    lines = []
+    for station_index in range(20):
+        sid = 'PAR' + str(station_index).zfill(7)
+        for year in range(1950, 1950 + rand.randint(1, 30)):
+            lines.append(_test_data_line(sid, year,
+                                         [rand.uniform(-30, 30)
+                                          for _ in range(12)]))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'test.mean')
+        with open(filename, 'wb') as fp_data:
+            fp_data.write(b'\n'.join(lines) + b'\n')
+        data = load_data(filename)
+        for workers in (2, 3, 7):
+            parallel_data = load_data(filename, workers)
+            for field, value in data.items():
+                assert parallel_data[field] == value
+
+        # filtering on years, stations and elements
+        wanted_station_ids = set(['PAR0000001', 'PAR0000004'])
+        data = load_data(filename, 1, 1955, 1960, wanted_station_ids)
+        assert set(data['stations'].keys()) == wanted_station_ids
+        assert min(data['years']) >= 1955 and max(data['years']) <= 1960
+        parallel_data = load_data(filename, 3, 1955, 1960, wanted_station_ids)
+        for field, value in data.items():
+            assert parallel_data[field] == value
+        assert load_data(filename, 1, 1955, 1960,
+                         lambda sid: sid in wanted_station_ids,
+                         ['TAVG']) == data
+        assert load_data(filename, 1, elements_filter=['TMAX']) is None
+
+
+def _test_elements() -> None:
+    """Test that several elements are loaded into separate stores, and
+    that the series of every element calculated together are the same as
+    calculating each element separately
+    """
+    assert parse_elements('tavg, TMAX,TMIN,TMAX') == ['TAVG', 'TMAX', 'TMIN']
+    assert parse_elements('TAVERAGE') is None
+    assert parse_elements('') is None
+    grid, station_locations, _ = _test_dataset(30, 9)
+    rand = random.Random(9)
+    lines = []
+    for sid in sorted(station_locations):
+        for element in ('TAVG', 'TMAX', 'TMIN'):
+            # a station may have the same years for every element
+            for year in range(1940, 1940 + rand.randint(1, 70)):
+                lines.append(_test_data_line(sid, year,
+                                             [rand.uniform(-30, 30)
+                                              for _ in range(12)],
+                                             element))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'test.mean')
+        with open(filename, 'wb') as fp_data:
+            fp_data.write(b'\n'.join(lines) + b'\n')
+        elements_data = load_elements_data(filename)
+        assert sorted(elements_data.keys()) == ['TAVG', 'TMAX', 'TMIN']
+        for element, data in elements_data.items():
+            assert data['elements'] == [element]
+            assert load_data(filename, elements_filter=[element]) == data
+            assert load_elements_data(filename, 3)[element] == data
+        assert load_data(filename) == elements_data['TAVG']
+        assert load_data(filename, 1, elements_filter=['TMIN', 'TAVG']) == \
+            elements_data['TMIN']
+        assert load_data(filename, 1, elements_filter={'TMIN', 'TMAX'}) == \
+            elements_data['TMAX']
+        for _ in range(2):
+            # the second time from the cache
+            cached = load_elements_data_cached(filename, 1, ['TMIN', 'TMAX'])
+            assert sorted(cached.keys()) == ['TMAX', 'TMIN']
+            for element, data in cached.items():
+                assert data['stations'] == elements_data[element]['stations']
+                assert list(data['values']) == \
+                    list(elements_data[element]['values'])
+        assert os.path.isfile(filename + '.tmin.cache')
+
+    element_grids = get_element_grids(grid, elements_data)
+    element_ctr = update_element_baselines(grid, element_grids, elements_data,
+                                           station_locations, 1951, 1980,
+                                           -45, 90)
+    update_element_anomalies(grid, element_grids, elements_data,
+                             station_locations, 1930, 2020, -45, 90)
+    for element, data in elements_data.items():
+        separate_grid = get_grid(8, 4)
+        for grid_cell in grid:
+            separate_grid[grid_cell['index']]['station_ids'] = \
+                grid_cell['station_ids']
+        assert element_ctr[element] == \
+            update_grid_baselines(separate_grid, data, station_locations,
+                                  1951, 1980, -45, 90)
+        update_grid_anomalies(separate_grid, data, station_locations,
+                              1930, 2020, -45, 90)
+        for grid_cell in separate_grid:
+            element_cell = element_grids[element][grid_cell['index']]
+            assert element_cell.get('baseline') == grid_cell.get('baseline')
+            assert element_cell['anomalies'] == grid_cell['anomalies']
+            assert element_cell['anomalies_monthly'] == \
+                grid_cell['anomalies_monthly']
+
+
+def _test_archive() -> None:
+    """Test reading the data and stations from within an archive
+    """
+    data_lines = [_test_data_line('ARC0000001', 1950, [1.5] * 12),
+                  _test_data_line('ARC0000001', 1951, [2.5] * 12)]
+    data_bytes = b'\n'.join(data_lines) + b'\n'
+    station_bytes = b'ARC00000010  51.5000   -0.1200   10.0 TEST STATION\n'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'ghcnm.tavg.latest.qcf.tar.gz')
+        with tarfile.open(filename, 'w:gz') as tar:
+            for name, member_bytes in (('ghcnm/test.qcf.inv', station_bytes),
+                                       ('ghcnm/test.qcf.dat', data_bytes)):
+                member = tarfile.TarInfo(name)
+                member.size = len(member_bytes)
+                tar.addfile(member, io.BytesIO(member_bytes))
+        data = load_data(filename)
+        assert data == parse_lines(data_lines)
+        stations = load_stations(filename)
+        assert len(stations) == 1
+        assert stations[0]['id'] == 'ARC0000001'
+        assert stations[0]['latitude'] == 51.5
+        assert stations[0]['name'] == 'Test Station'
+
+
+def _test_binary_file() -> None:
+    """Test saving and memory mapping a binary file
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'test.bin')
+        arrays = {
+            'values': array('d', [1.5, -2.25, 3.0]),
+            'flags': bytearray(b'MX '),
+            'years': array('H', [1950, 1951])
+        }
+        assert save_binary_file(filename, {'name': 'test'}, arrays)
+        header, loaded = load_binary_file(filename)
+        assert header['name'] == 'test'
+        for name, arr in arrays.items():
+            assert list(loaded[name]) == list(arr)
+            loaded[name].release()
+
+
+def _test_incremental() -> None:
+    """Test that incrementally updating the grid after some station
+    data has changed gives the same result as recalculating everything
+    """
+    grid, station_locations, data = _test_dataset(40, 6)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        state_filename = os.path.join(temp_dir, 'state.bin')
+        assert update_grid_incremental(grid, data, station_locations,
+                                       1930, 2020, 1951, 1980, -45, 90,
+                                       state_filename) == len(grid)
+        assert update_grid_incremental(grid, data, station_locations,
+                                       1930, 2020, 1951, 1980, -45, 90,
+                                       state_filename) == 0
+
+        # change a value outside of the baseline, a value within the
+        # baseline and remove a station
+        changed_data = data.copy()
+        changed_data['values'] = array('d', data['values'])
+        changed_data['stations'] = data['stations'].copy()
+        station_ids = sorted(data['stations'].keys())
+        start_row, end_row = data['stations'][station_ids[0]]
+        changed_data['values'][(end_row - 1) * 12] += 1.5
+        start_row, end_row = data['stations'][station_ids[1]]
+        for row in range(start_row, end_row):
+            if data['years'][row] >= 1951 and data['years'][row] < 1980:
+                changed_data['values'][row * 12 + 3] -= 2.0
+                break
+        del changed_data['stations'][station_ids[2]]
+        assert update_grid_incremental(grid, changed_data, station_locations,
+                                       1930, 2020, 1951, 1980, -45, 90,
+                                       state_filename) > 0
+
+    expected_grid, _, _ = _test_dataset(40, 6)
+    update_grid_baselines(expected_grid, changed_data, station_locations,
+                          1951, 1980, -45, 90)
+    update_grid_anomalies(expected_grid, changed_data, station_locations,
+                          1930, 2020, -45, 90)
+    for grid_cell in grid:
+        expected_cell = expected_grid[grid_cell['index']]
+        if grid_cell['station_ids']:
+            assert grid_cell['baseline'] == expected_cell['baseline']
+        assert grid_cell['anomalies'] == expected_cell['anomalies']
+        assert grid_cell['anomalies_monthly'] == \
+            expected_cell['anomalies_monthly']
+
+
+def _test_values_close(first, second) -> None:
+    """Test that two results are the same to within floating point
+    rounding, where values may be nested within dicts and lists
+    """
+    if isinstance(first, dict):
+        assert first.keys() == second.keys()
+        for key, value in first.items():
+            _test_values_close(value, second[key])
+    elif isinstance(first, list):
+        assert len(first) == len(second)
+        for value, second_value in zip(first, second):
+            _test_values_close(value, second_value)
+    elif first is None or second is None:
+        assert first is None and second is None
+    else:
+        assert abs(first - second) < 1e-9
+
+
+def _test_numpy_backend() -> None:
+    """Test that the numpy backend agrees with the pure python
+    baselines and anomalies
+    """
+    if not numpy_available():
+        print('numpy is not installed, skipping numpy backend test')
+        return
+    grid, station_locations, data = _test_dataset(40, 7)
+    update_grid_baselines(grid, data, station_locations, 1951, 1980, -60, 90)
+    update_grid_anomalies(grid, data, station_locations, 1930, 2020, -60, 90)
+    numpy_grid, _, _ = _test_dataset(40, 7)
+    assert update_grid_baselines_numpy(numpy_grid, data, station_locations,
+                                       1951, 1980, -60, 90) > 0
+    update_grid_anomalies_numpy(numpy_grid, data, station_locations,
+                                1930, 2020, -60, 90)
+    for grid_cell in grid:
+        numpy_cell = numpy_grid[grid_cell['index']]
+        _test_values_close(grid_cell.get('baseline'),
+                           numpy_cell.get('baseline'))
+        _test_values_close(grid_cell['anomalies'], numpy_cell['anomalies'])
+        _test_values_close(grid_cell['anomalies_monthly'],
+                           numpy_cell['anomalies_monthly'])
+    _test_values_close(get_global_anomalies(grid, 1930, 2020),
+                       get_global_anomalies_numpy(numpy_grid, 1930, 2020))
+    _test_values_close(get_monthly_anomalies(grid, 1930, 2020),
+                       get_monthly_anomalies_numpy(numpy_grid, 1930, 2020))
+
+
+def _test_bootstrap() -> None:
+    """Test that bootstrap confidence intervals are reproducible for a
+    seed, with any number of workers, and contain the global anomalies
+    """
+    if not numpy_available():
+        print('numpy is not installed, skipping bootstrap test')
+        return
+    grid, station_locations, data = _test_dataset(60, 11)
+    update_grid_baselines(grid, data, station_locations, 1951, 1980, -90, 90)
+    update_grid_anomalies(grid, data, station_locations, 1900, 2030, -90, 90)
+    global_anomalies = get_global_anomalies(grid, 1900, 2030)
+    monthly_anomalies = get_monthly_anomalies(grid, 1900, 2030)
+    matrix = get_anomaly_matrix(grid, data, station_locations,
+                                1900, 2030, -90, 90)
+    intervals = bootstrap_anomalies(matrix, 200, 95, seed=4)
+    assert intervals['seed'] == 4
+    assert intervals == bootstrap_anomalies(matrix, 200, 95, seed=4,
+                                            workers=2)
+    assert intervals != bootstrap_anomalies(matrix, 200, 95, seed=5)
+    narrow = bootstrap_anomalies(matrix, 200, 50, seed=4)
+    inside = 0
+    for year in range(1900, 2031):
+        interval = intervals['annual'][year]
+        if global_anomalies[year] is None:
+            # no data in any replicate
+            assert interval is None
+            assert intervals['monthly'][year] is None
+            continue
+        assert interval[0] <= interval[1]
+        assert narrow['annual'][year][0] >= interval[0]
+        assert narrow['annual'][year][1] <= interval[1]
+        if interval[0] <= global_anomalies[year] <= interval[1]:
+            inside += 1
+        for month_index in range(12):
+            if monthly_anomalies[year][month_index] is None:
+                assert intervals['monthly'][year][month_index] is None
+    assert inside > 0.9 * sum(1 for value in global_anomalies.values()
+                              if value is not None)
+
+
+def _test_homogenize() -> None:
+    """Test that a step change within one station is found by comparison
+    with its neighbours, and that its earlier values are adjusted
+    """
+    if not numpy_available():
+        print('numpy is not installed, skipping homogenization test')
+        return
+    rand = random.Random(6)
+    regional = {year: [rand.uniform(-1, 1) for _ in range(12)]
+                for year in range(1900, 2001)}
+    station_lines = []
+    data_lines = []
+    for station_index in range(8):
+        sid = 'HOM' + str(station_index).zfill(7)
+        station_lines.append(sid + '0 ' +
+                             str(50 + station_index * 0.1).rjust(8) + ' ' +
+                             str(10 + station_index * 0.1).rjust(9) +
+                             '  100.0 Test Station')
+        for year in range(1900, 2001):
+            values = [10 + month_index + regional[year][month_index] +
+                      rand.gauss(0, 0.2) for month_index in range(12)]
+            if station_index == 3 and year >= 1960:
+                # the station moved
+                values = [value + 2 for value in values]
+            data_lines.append(_test_data_line(sid, year, values))
+    station_locations = \
+        assign_stations_to_grid(parse_station_lines(station_lines),
+                                get_grid(8, 4))
+    data = parse_lines(data_lines)
+    homogenized, breakpoints = \
+        homogenize(data, station_locations, 1900, 2000, 10)
+    assert len(breakpoints) == 1
+    assert breakpoints[0]['station'] == 'HOM0000003'
+    assert 1959 <= breakpoints[0]['year'] <= 1961
+    assert abs(breakpoints[0]['step'] - 2) < 0.2
+    assert breakpoints[0]['neighbours'] == 7
+    row = get_row(data, 'HOM0000003', 1950)
+    assert abs(homogenized['values'][row * 12] -
+               (data['values'][row * 12] + breakpoints[0]['step'])) < 0.01
+    row = get_row(data, 'HOM0000003', 1990)
+    assert homogenized['values'][row * 12] == data['values'][row * 12]
+    row = get_row(data, 'HOM0000004', 1950)
+    assert homogenized['values'][row * 12] == data['values'][row * 12]
+
+
+def _test_infill() -> None:
+    """Test that only grid cells without stations are infilled, with the
+    weighted mean of the stations within the radius, and that the numpy
+    backend gives the same anomalies
+    """
+    grid, station_locations, data = _test_dataset(30, 8)
+    update_grid_baselines(grid, data, station_locations, 1951, 1980, -45, 90)
+    update_grid_anomalies(grid, data, station_locations, 1930, 2020, -45, 90)
+    station_baselines = get_stations_baselines(data, 1951, 1980)
+    weights = get_infill_weights(grid, station_locations, data['stations'],
+                                 4000, 'inverse', -45, 90)
+    assert weights['cells']
+    station_ids = weights['station_ids']
+    for row, cell_index in enumerate(weights['cells']):
+        grid_cell = grid[cell_index]
+        assert -45 <= grid_cell['latitude'] <= 90
+        assert not any(station_locations[sid]['latitude'] >= -45
+                       for sid in grid_cell['station_ids'])
+        columns = weights['columns'][weights['row_starts'][row]:
+                                     weights['row_starts'][row + 1]]
+        # 4000km is a chord of about 0.62 on the unit sphere
+        for column, sid in enumerate(station_ids):
+            dist = math.dist((grid_cell['x'], grid_cell['y'],
+                              grid_cell['z']),
+                             lat_long_to_3d(
+                                 station_locations[sid]['longitude'],
+                                 station_locations[sid]['latitude']))
+            if abs(dist - 0.62) > 0.01:
+                assert (column in columns) == (dist < 0.62)
+    observed = {grid_cell['index']: dict(grid_cell['anomalies'])
+                for grid_cell in grid}
+    assert infill_grid_anomalies(grid, weights, data, station_baselines,
+                                 1930, 2020) > 0
+    # the first infilled cell calculated directly
+    row_start = weights['row_starts'][0]
+    row_end = weights['row_starts'][1]
+    for year in range(1930, 2021):
+        total = 0.0
+        hits = 0.0
+        for entry in range(row_start, row_end):
+            sid = station_ids[weights['columns'][entry]]
+            for _, anomalies in get_station_anomalies(data, sid,
+                                                      station_baselines[sid],
+                                                      year, year):
+                valid = [value for value in anomalies if value is not None]
+                if valid:
+                    total += weights['weights'][entry] * \
+                        sum(valid) / len(valid)
+                    hits += weights['weights'][entry]
+        anomaly = grid[weights['cells'][0]]['anomalies'][year]
+        if hits == 0:
+            assert anomaly is None
+        else:
+            assert abs(anomaly - total / hits) < 0.000001
+    python_anomalies = [(grid_cell['anomalies'],
+                         grid_cell['anomalies_monthly'])
+                        for grid_cell in grid]
+    for grid_cell in grid:
+        if grid_cell['index'] not in weights['cells']:
+            assert grid_cell['anomalies'] == observed[grid_cell['index']]
+    if not numpy_available():
+        return
+    infill_grid_anomalies(grid, weights, data, station_baselines,
+                          1930, 2020, 'numpy')
+    for grid_cell in grid:
+        _test_values_close(
+            python_anomalies[grid_cell['index']][0],
+            grid_cell['anomalies'])
+        _test_values_close(
+            python_anomalies[grid_cell['index']][1],
+            grid_cell['anomalies_monthly'])
+
+
+def _test_anomaly_cube() -> None:
+    """Test that the anomalies of grid cells read back from an anomaly
+    cube are the same to within float32 rounding
+    """
+    grid, station_locations, data = _test_dataset(30, 10)
+    update_grid_baselines(grid, data, station_locations, 1951, 1980, -90, 90)
+    update_grid_anomalies(grid, data, station_locations, 1930, 2020, -90, 90)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'anomalies.cube')
+        assert save_anomaly_cube(filename, grid, 1930, 2020,
+                                 {'baseline_start': 1951})
+        cube = open_anomaly_cube(filename)
+        assert cube['header']['metadata'] == {'baseline_start': 1951}
+        assert cube['header']['shapes']['monthly'] == [len(grid), 91, 12]
+        cells = read_cube_cells(cube)
+        assert len(cells) == len(grid)
+        for grid_cell, cube_cell in zip(grid, cells):
+            assert abs(cube_cell['latitude'] - grid_cell['latitude']) < 0.001
+            if not grid_cell['station_ids']:
+                assert not cube_cell['anomalies_monthly']
+                continue
+            for value, cube_value in zip(grid_cell['baseline'],
+                                         cube_cell['baseline']):
+                assert (value is None) == (cube_value is None)
+                if value is not None:
+                    assert abs(value - cube_value) < 0.001
+            for year, anomaly in grid_cell['anomalies'].items():
+                cube_anomaly = cube_cell['anomalies'][year]
+                if anomaly is None:
+                    assert cube_anomaly is None
+                    continue
+                assert abs(anomaly - cube_anomaly) < 0.001
+                for value, cube_value in \
+                        zip(grid_cell['anomalies_monthly'][year],
+                            cube_cell['anomalies_monthly'][year]):
+                    assert (value is None) == (cube_value is None)
+                    if value is not None:
+                        assert abs(value - cube_value) < 0.001
+        # slices of cells and years
+        cells = read_cube_cells(cube, [3, 5], 1960, 2050)
+        assert [cube_cell['index'] for cube_cell in cells] == [3, 5]
+        assert sorted(cells[1]['anomalies'].keys()) == \
+            list(range(1960, 2021))
+        for cube_cell in cells:
+            assert cube_cell['anomalies'] == \
+                {year: anomaly for year, anomaly in
+                 read_cube_cells(cube, [cube_cell['index']])[0][
+                     'anomalies'].items() if year >= 1960}
+        annual, monthly = read_cube_year(cube, 1975)
+        for cell_index, anomaly in enumerate(annual):
+            cube_cell = read_cube_cells(cube, [cell_index], 1975, 1975)[0]
+            assert anomaly == cube_cell['anomalies'][1975]
+            if anomaly is not None:
+                assert monthly[cell_index] == \
+                    cube_cell['anomalies_monthly'][1975]
+        assert read_cube_year(cube, 2021) is None
+        other_filename = os.path.join(temp_dir, 'other.bin')
+        with open(other_filename, 'wb') as fp_other:
+            fp_other.write(b'not a cube')
+        assert open_anomaly_cube(other_filename) is None
+
+
+def _test_benchmark_dataset() -> None:
+    """Test that the synthetic benchmark dataset is the same for the same
+    seed and can be loaded
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        first_dir = os.path.join(temp_dir, 'first')
+        second_dir = os.path.join(temp_dir, 'second')
+        os.mkdir(first_dir)
+        os.mkdir(second_dir)
+        first = generate_dataset(first_dir, 20, 1950, 2000, seed=3)
+        second = generate_dataset(second_dir, 20, 1950, 2000, seed=3)
+        for name, filename in first.items():
+            with open(filename, 'rb') as fp_first, \
+                 open(second[name], 'rb') as fp_second:
+                assert fp_first.read() == fp_second.read()
+        assert len(load_stations(first['stations'])) == 20
+        data = load_data(first['data'])
+        assert no_of_stations(data) <= 20
+        assert min(data['years']) >= 1950 and max(data['years']) <= 2000
+        # about the given proportion of months are flagged as errors
+        flagged_dir = os.path.join(temp_dir, 'flagged')
+        os.mkdir(flagged_dir)
+        flagged = generate_dataset(flagged_dir, 20, 1950, 2000,
+                                   flag_ratio=0.5, seed=3)
+        data = load_data(flagged['data'])
+        flags = data['qcflag']
+        ratio = flags.count(QCFLAG_ERROR) / float(len(flags))
+        assert 0.45 < ratio < 0.55
+        assert data['dmflag'].count(QCFLAG_ERROR) == 0
+
+
+def _test_profiling() -> None:
+    """Test recording the stages of a run
+    """
+    # without a profile the hooks do nothing
+    stage = start_stage(None, 'nothing')
+    end_stage(None, stage, 1)
+    with profile_stage(None, 'nothing') as stage:
+        stage['items'] = 1
+    assert not save_profile(None, 'nothing.json')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        profile = new_profile(False, os.path.join(temp_dir, 'stats'))
+        stage = start_stage(profile, 'grid')
+        grid = get_grid(8, 4)
+        end_stage(profile, stage, len(grid))
+        with profile_stage(profile, 'stations') as stage:
+            stage['items'] = \
+                len(assign_stations_to_grid(parse_station_lines([]), grid))
+        profile_filename = os.path.join(temp_dir, 'profile.json')
+        assert save_profile(profile, profile_filename)
+        with open(profile_filename, 'r', encoding='utf-8') as fp_profile:
+            report = json.loads(fp_profile.read())
+        assert [stage['name'] for stage in report['stages']] == \
+            ['grid', 'stations']
+        assert report['stages'][0]['items'] == 32
+        assert report['stages'][1]['items'] == 0
+        for stage in report['stages']:
+            assert stage['wall_time'] >= 0 and stage['cpu_time'] >= 0
+            assert os.path.isfile(stage['cprofile'])
+
+
+def _test_batch() -> None:
+    """Test that running jobs in a batch gives the same results as
+    running each of them separately
+    """
+    defaults = {
+        'startYear': 1930, 'endYear': 2000,
+        'baselineStart': 1951, 'baselineEnd': 1980,
+        'cellsHorizontal': 8, 'cellsVertical': 4,
+        'minLatitude': 0, 'maxLatitude': 90
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filenames = generate_dataset(temp_dir, 30, 1900, 2000, seed=4)
+        job_filename = os.path.join(temp_dir, 'jobs.json')
+        for workers in (1, 2):
+            job_file = {
+                'output': os.path.join(temp_dir, 'batch' + str(workers)),
+                'defaults': {'plot': False},
+                'jobs': [
+                    {'name': 'northern'},
+                    {'name': 'southern', 'minLatitude': -90,
+                     'maxLatitude': 0},
+                    {'name': 'coarse', 'cellsHorizontal': 4,
+                     'cellsVertical': 2, 'baselineStart': 1961,
+                     'baselineEnd': 1990}
+                ]
+            }
+            with open(job_filename, 'w+', encoding='utf-8') as fp_jobs:
+                fp_jobs.write(json.dumps(job_file))
+            results = run_batch(job_filename, defaults, filenames['data'],
+                                filenames['stations'], workers, False)
+            assert [result['name'] for result in results] == \
+                ['northern', 'southern', 'coarse']
+            data = load_data(filenames['data'])
+            for result in results:
+                job = result['settings']
+                assert os.path.isdir(result['directory'])
+                grid = get_grid(job['cellsHorizontal'], job['cellsVertical'])
+                station_locations = \
+                    assign_stations_to_grid(load_stations(
+                        filenames['stations']), grid)
+                update_grid_baselines(grid, data, station_locations,
+                                      job['baselineStart'],
+                                      job['baselineEnd'],
+                                      job['minLatitude'], job['maxLatitude'])
+                update_grid_anomalies(grid, data, station_locations,
+                                      job['startYear'], job['endYear'],
+                                      job['minLatitude'], job['maxLatitude'])
+                assert result['global_anomalies'] == \
+                    get_global_anomalies(grid, job['startYear'],
+                                         job['endYear'])
+
+
+def _test_pipeline() -> None:
+    """Test that the stages of a pipeline give the same results as
+    calculating them directly, and that only the stages which use a
+    changed setting are recalculated
+    """
+    settings = {
+        'startYear': 1930, 'endYear': 2000,
+        'baselineStart': 1951, 'baselineEnd': 1980,
+        'cellsHorizontal': 8, 'cellsVertical': 4,
+        'minLatitude': -90, 'maxLatitude': 90
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filenames = generate_dataset(temp_dir, 30, 1900, 2000, seed=6)
+        settings['filename'] = filenames['data']
+        settings['stations'] = filenames['stations']
+        settings['countries'] = filenames['countries']
+        pipeline = new_pipeline(settings)
+        data = load_data(filenames['data'])
+        grid = get_grid(8, 4)
+        station_locations = \
+            load_station_locations(filenames['stations'], grid)
+        update_grid_baselines(grid, data, station_locations,
+                              1951, 1980, -90, 90)
+        for end_year in (2000, 1990):
+            set_pipeline_settings(pipeline, {'endYear': end_year})
+            update_grid_anomalies(grid, data, station_locations,
+                                  1930, end_year, -90, 90)
+            assert get_stage(pipeline, 'global_anomalies') == \
+                get_global_anomalies(grid, 1930, end_year)
+            assert get_stage(pipeline, 'monthly_anomalies') == \
+                get_monthly_anomalies(grid, 1930, end_year)
+        # the data and baselines were kept when the end year changed
+        runs = pipeline['runs']
+        assert runs['data'] == 1 and runs['baselines'] == 1
+        assert runs['anomalies'] == 2 and runs['global_anomalies'] == 2
+        get_stage(pipeline, 'global_anomalies')
+        assert runs['global_anomalies'] == 2
+        # the series were calculated from the grid of the old baselines
+        set_pipeline_settings(pipeline, {'baselineStart': 1961,
+                                         'baselineEnd': 1990})
+        get_stage(pipeline, 'anomalies')
+        assert 'global_anomalies' not in pipeline['stages']
+        update_grid_baselines(grid, data, station_locations,
+                              1961, 1990, -90, 90)
+        update_grid_anomalies(grid, data, station_locations,
+                              1930, 1990, -90, 90)
+        assert get_stage(pipeline, 'global_anomalies') == \
+            get_global_anomalies(grid, 1930, 1990)
+        assert runs['data'] == 1 and runs['baselines'] == 2
+        assert len(get_stage(pipeline, 'countries')) == \
+            len(load_countries(filenames['countries']))
+
+
+def _test_gnuplot_renderer() -> None:
+    """Test rendering a queue of plots with persistent gnuplot processes
+    """
+    renderer = new_renderer(2, os.path.join('nonexistent', 'gnuplot'))
+    queue_plot(renderer, 'reset')
+    queue_plot(renderer, 'reset')
+    assert finish_renderer(renderer) == 0
+    assert renderer['failed'] == 2
+    assert gnuplot_escape('Say "hi" \\') == 'Say \\"hi\\" \\\\'
+    if not shutil.which('gnuplot'):
+        print('gnuplot is not installed, skipping rendering test')
+        return
+    grid, station_locations, data = _test_dataset(40, 8)
+    update_grid_baselines(grid, data, station_locations, 1951, 1980, -90, 90)
+    update_grid_anomalies(grid, data, station_locations, 1930, 2020, -90, 90)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        renderer = new_renderer(2)
+        for plot_index in range(3):
+            plot_name = os.path.join(temp_dir, str(plot_index))
+            # quotes within a region name do not break the script
+            plot_global_anomalies(grid, 1930, 2020, 1951, 1980, -90, 90,
+                                  plot_name + '_global', renderer,
+                                  'Region "' + str(plot_index) + '" \\')
+            plot_monthly_anomalies(grid, 1930, 2020, 1951, 1980, -90, 90,
+                                   plot_name + '_monthly', renderer)
+        assert finish_renderer(renderer) == 6
+        for plot_index in range(3):
+            for suffix in ('_global.jpg', '_monthly.jpg'):
+                filename = os.path.join(temp_dir, str(plot_index) + suffix)
+                assert os.path.getsize(filename) > 0
+
+
+def _test_kml() -> None:
+    """Test saving stations and grid anomalies as KML and KMZ
+    """
+    namespace = '{http://www.opengis.net/kml/2.2}'
+    grid, station_locations, data = _test_dataset(30, 9)
+    update_grid_baselines(grid, data, station_locations, 1951, 1980, -90, 90)
+    update_grid_anomalies(grid, data, station_locations, 1930, 2020, -90, 90)
+    no_of_anomalies = 0
+    for grid_cell in grid:
+        for anomaly in grid_cell['anomalies'].values():
+            if anomaly is not None:
+                no_of_anomalies += 1
+    sid = sorted(station_locations.keys())[0]
+    station_locations[sid]['name'] = 'Smith & Sons <Field>'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'stations.kml')
+        save_station_locations_as_kml(station_locations, filename)
+        names = [placemark.find(namespace + 'name').text
+                 for placemark in
+                 ET.parse(filename).getroot().iter(namespace + 'Placemark')]
+        assert len(names) == len(station_locations)
+        assert 'Smith & Sons <Field>' in names
+
+        filename = os.path.join(temp_dir, 'grid.kmz')
+        save_grid_as_kml(grid, filename, True)
+        with zipfile.ZipFile(filename) as kmz:
+            root = ET.fromstring(kmz.read('doc.kml'))
+        placemarks = list(root.iter(namespace + 'Placemark'))
+        assert len(placemarks) == len(grid) + no_of_anomalies
+        time_spans = 0
+        for placemark in placemarks:
+            time_span = placemark.find(namespace + 'TimeSpan')
+            if time_span is None:
+                continue
+            time_spans += 1
+            index_str, year_str = \
+                placemark.find(namespace + 'name').text.split()
+            assert time_span.find(namespace + 'begin').text == year_str
+            values = {}
+            for item in placemark.iter(namespace + 'Data'):
+                values[item.get('name')] = \
+                    float(item.find(namespace + 'value').text)
+            assert values['anomaly'] == \
+                grid[int(index_str)]['anomalies'][int(year_str)]
+        assert time_spans == no_of_anomalies
+
+
+def _test_country_series() -> None:
+    """Test that calculating all countries in a single pass gives the
+    same results as calculating each country separately
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filenames = generate_dataset(temp_dir, 60, 1900, 2000, seed=5)
+        countries = load_countries(filenames['countries'])
+        data = load_data(filenames['data'])
+        grid = get_grid(8, 4)
+        station_locations = \
+            load_station_locations(filenames['stations'], grid)
+        assert parse_country_codes('us, uk,US', countries) == ['US', 'UK']
+        assert parse_country_codes('US,XX', countries) is None
+        country_codes = parse_country_codes('all', countries)
+        assert country_codes == sorted(countries.keys())
+        assert country_series_name('UK', countries) == 'UK_united_kingdom'
+        station_countries = \
+            get_station_countries(station_locations, country_codes)
+        country_index = get_country_index(grid, station_countries)
+        country_grids = get_country_grids(grid, country_index,
+                                          station_countries)
+        update_country_anomalies(grid, country_grids, station_countries,
+                                 data, 1930, 2000, 1951, 1980)
+        for code in country_codes:
+            stations = [station
+                        for station in load_stations(filenames['stations'])
+                        if station['id'].startswith(code)]
+            if not stations:
+                assert code not in country_grids
+                continue
+            assert country_index[code]['station_ids'] == \
+                set(station['id'] for station in stations)
+            country_grid = get_grid(8, 4)
+            country_locations = \
+                assign_stations_to_grid(stations, country_grid)
+            update_grid_baselines(country_grid, data, country_locations,
+                                  1951, 1980, -90, 90)
+            update_grid_anomalies(country_grid, data, country_locations,
+                                  1930, 2000, -90, 90)
+            _test_values_close(get_global_anomalies(country_grid,
+                                                    1930, 2000),
+                               get_global_anomalies(country_grids[code],
+                                                    1930, 2000))
+            _test_values_close(get_monthly_anomalies(country_grid,
+                                                     1930, 2000),
+                               get_monthly_anomalies(country_grids[code],
+                                                     1930, 2000))
+
+
+def _test_grid_pyramid() -> None:
+    """Test that assigning stations to every level of a grid pyramid gives
+    the same cells and anomalies as assigning them to each grid separately
+    """
+    assert parse_resolutions('72x36, 36X18') == [(72, 36), (36, 18)]
+    assert parse_resolutions('72') is None
+    rng = random.Random(3)
+    stations = []
+    for idx in range(2000):
+        stations.append({
+            'id': 'TS' + str(idx).zfill(8),
+            'latitude': rng.uniform(-90, 90),
+            'longitude': rng.uniform(-180, 180),
+            'altitude': 0,
+            'name': 'Test'
+        })
+    # the poles and the date line
+    for idx, (latitude, longitude) in enumerate(((90, 0), (-90, 0),
+                                                 (0, 180), (0, -180))):
+        stations.append({'id': 'TP' + str(idx).zfill(8),
+                         'latitude': latitude, 'longitude': longitude,
+                         'altitude': 0, 'name': 'Test'})
+    resolutions = [(72, 36), (4, 2), (36, 18), (37, 19)]
+    pyramid = get_grid_pyramid(resolutions)
+    assert [level['resolution'] for level in pyramid['levels']] == \
+        [(4, 2), (36, 18), (37, 19), (72, 36)]
+    assign_stations_to_pyramid(stations, pyramid)
+    for resolution in resolutions:
+        grid = get_grid(resolution[0], resolution[1])
+        level = get_pyramid_level(pyramid, resolution)
+        assert level['station_locations'] == \
+            assign_stations_to_grid(stations, grid)
+        assert [grid_cell['station_ids'] for grid_cell in level['grid']] == \
+            [grid_cell['station_ids'] for grid_cell in grid]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filenames = generate_dataset(temp_dir, 60, 1900, 2000, seed=9)
+        data = load_data(filenames['data'])
+        stations = load_stations(filenames['stations'])
+        pyramid = get_grid_pyramid([(16, 8), (8, 4)])
+        assign_stations_to_pyramid(stations, pyramid)
+        results = update_pyramid_anomalies(pyramid, data, 1930, 2000,
+                                           1951, 1980, -90, 90)
+        assert set(results.keys()) == {(16, 8), (8, 4)}
+        for level in pyramid['levels']:
+            grid = get_grid(level['resolution'][0], level['resolution'][1])
+            station_locations = assign_stations_to_grid(stations, grid)
+            update_grid_baselines(grid, data, station_locations,
+                                  1951, 1980, -90, 90)
+            update_grid_anomalies(grid, data, station_locations,
+                                  1930, 2000, -90, 90)
+            _test_values_close(get_global_anomalies(grid, 1930, 2000),
+                               get_global_anomalies(level['grid'],
+                                                    1930, 2000))
+
+
+async def _test_query(address: str, target: str) -> (int, {}):
+    """Sends a query to a server over a loopback socket
+    """
+    host, port = address.rsplit(':', 1)
+    reader, writer = await asyncio.open_connection(host, int(port))
+    writer.write(('GET ' + target + ' HTTP/1.1\r\n' +
+                  'Host: ' + address + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    header, body = response.split(b'\r\n\r\n', 1)
+    return int(header.split()[1]), json.loads(body)
+
+
+def _test_years(series: {}) -> {}:
+    """Returns a series returned by the query server with integer years
+    """
+    return {int(year): value for year, value in series.items()}
+
+
+def _test_query_server() -> None:
+    """Test that the query server answers from memory with the same
+    results as a direct calculation, and caches them
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filenames = generate_dataset(temp_dir, 40, 1900, 2000, seed=7)
+        countries = load_countries(filenames['countries'])
+        data = load_data(filenames['data'])
+        grid = get_grid(8, 4)
+        station_locations = \
+            load_station_locations(filenames['stations'], grid)
+        defaults = {
+            'startYear': 1930, 'endYear': 2000,
+            'baselineStart': 1951, 'baselineEnd': 1980,
+            'minLatitude': -90, 'maxLatitude': 90
+        }
+        state = new_query_state(data, grid, station_locations, countries,
+                                defaults, cache_size=4)
+
+        expected_grid = get_grid(8, 4)
+        expected_locations = \
+            load_station_locations(filenames['stations'], expected_grid)
+        update_grid_baselines(expected_grid, data, expected_locations,
+                              1951, 1980, -90, 90)
+        update_grid_anomalies(expected_grid, data, expected_locations,
+                              1930, 2000, -90, 90)
+        code = sorted(state['country_grids'].keys())[0]
+
+        async def run_queries() -> None:
+            server = await start_query_server(state, '127.0.0.1:0')
+            address = '127.0.0.1:' + \
+                str(server.sockets[0].getsockname()[1])
+            status, result = await _test_query(address, '/global')
+            assert status == 200
+            _test_values_close(_test_years(result['annual']),
+                               get_global_anomalies(expected_grid,
+                                                    1930, 2000))
+            assert state['misses'] == 1
+            status, result = await _test_query(address, '/global')
+            assert status == 200
+            assert state['hits'] == 1
+            status, result = await _test_query(address, '/status')
+            assert result['hits'] == 1 and result['misses'] == 1
+            status, result = await _test_query(address, '/monthly')
+            _test_values_close(_test_years(result['monthly']),
+                               get_monthly_anomalies(expected_grid,
+                                                     1930, 2000))
+            index = next(grid_cell['index'] for grid_cell in expected_grid
+                         if grid_cell.get('anomalies'))
+            status, result = \
+                await _test_query(address, '/cell?index=' + str(index))
+            _test_values_close(_test_years(result['annual']),
+                               expected_grid[index]['anomalies'])
+            status, result = await _test_query(address, '/band?band=0:90')
+            assert status == 200
+            assert result['query']['minLatitude'] == 0
+            status, result = \
+                await _test_query(address, '/country?code=' + code.lower())
+            assert status == 200
+            assert result['name'] == countries[code]
+            status, result = await _test_query(address, '/country?code=XX')
+            assert status == 404
+            status, result = await _test_query(address, '/cell?index=x')
+            assert status == 400
+            status, result = \
+                await _test_query(address, '/global?endYear=100000000')
+            assert status == 400
+            status, result = \
+                await _test_query(address, '/global?minLatitude=nan')
+            assert status == 400
+            status, result = await _test_query(address, '/unknown')
+            assert status == 404
+            assert len(state['results']) <= 4
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run_queries())
+        state['executor'].shutdown()
+
 
 def run_all_tests() -> None:
     """Run all unit tests
     """
+    _test_station_data()
+    _test_binary_file()
+    _test_cell_anomalies()
+    _test_grid_spatial_index()
+    _test_baseline_index()
+    _test_latitude_bands()
+    _test_parallel_load_data()
+    _test_elements()
+    _test_archive()
+    _test_incremental()
+    _test_numpy_backend()
+    _test_bootstrap()
+    _test_homogenize()
+    _test_infill()
+    _test_anomaly_cube()
+    _test_benchmark_dataset()
+    _test_profiling()
+    _test_batch()
+    _test_pipeline()
+    _test_gnuplot_renderer()
+    _test_kml()
+    _test_country_series()
+    _test_query_server()
+    _test_grid_pyramid()
     print('All tests passed')
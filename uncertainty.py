@@ -0,0 +1,392 @@
+__filename__ = "uncertainty.py"
+__author__ = "Bob Mottram"
+__license__ = "GPL3+"
+__version__ = "2.0.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Commandline Interface"
+
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from numpyBackend import np
+from numpyBackend import get_station_arrays
+from numpyBackend import get_pair_rows
+from numpyBackend import get_cell_station_pairs
+from numpyBackend import get_grid_baselines_array
+from gnuplotRenderer import render_plot
+
+# cells are divided into this many chunks, which are summed in order
+BOOTSTRAP_CHUNKS = 8
+
+# number of distinct cell draws held before adding them to the sums
+PENDING_DRAWS = 4096
+
+# anomaly matrix and resampling shared with the forked worker processes
+_BOOTSTRAP = {}
+
+
+def get_anomaly_matrix(grid: [], stations_data: {}, station_locations: {},
+                       start_year: int, end_year: int,
+                       min_latitude: float, max_latitude: float,
+                       station_arrays: {} = None) -> {}:
+    """Returns the monthly anomalies of every station within a grid cell
+    and the latitude range, relative to the baseline of its cell, as rows
+    of station years grouped by grid cell. Grid baselines should already
+    have been calculated
+    """
+    if station_arrays is None:
+        station_arrays = get_station_arrays(stations_data)
+    cells, stations = \
+        get_cell_station_pairs(grid, station_locations, station_arrays,
+                               min_latitude, max_latitude)
+    pair_of_row, rows, years = \
+        get_pair_rows(stations, station_arrays, start_year, end_year)
+    anomalies = station_arrays['values'][rows] - \
+        get_grid_baselines_array(grid)[cells[pair_of_row]]
+
+    # stations and rows are in the order of the grid cells, so the
+    # stations and rows of each cell are contiguous
+    row_cells = cells[pair_of_row]
+    cell_indexes, pair_starts = np.unique(cells, return_index=True)
+    pair_ends = np.append(pair_starts[1:], len(cells))
+    row_starts = np.searchsorted(pair_of_row, pair_starts)
+    row_ends = np.searchsorted(pair_of_row, pair_ends)
+    # only cells with data in the range of years can be drawn
+    with_rows = row_ends > row_starts
+    return {
+        'start_year': start_year,
+        'end_year': end_year,
+        'cells': cell_indexes[with_rows],
+        'pair_starts': pair_starts[with_rows],
+        'pair_ends': pair_ends[with_rows],
+        'row_starts': row_starts[with_rows],
+        'row_ends': row_ends[with_rows],
+        'pair_of_row': pair_of_row,
+        'year_index': years - start_year,
+        'anomalies': anomalies.filled(0),
+        'valid': ~np.ma.getmaskarray(anomalies),
+        'rows': len(row_cells)
+    }
+
+
+def _ratio(totals, hits):
+    """Returns totals divided by hits, or NaN where there are no hits
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(hits > 0, totals / np.where(hits > 0, hits, 1),
+                        np.nan)
+
+
+def _station_totals(matrix: {}, cell_numbers) -> ():
+    """Returns (stations x years * 12) totals and hits of the monthly
+    anomalies of the stations within the given cells, in order
+    """
+    row_starts = matrix['row_starts'][cell_numbers]
+    lengths = matrix['row_ends'][cell_numbers] - row_starts
+    rows = np.arange(lengths.sum()) - \
+        np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+        np.repeat(row_starts, lengths)
+    pair_starts = matrix['pair_starts'][cell_numbers]
+    no_of_stations = matrix['pair_ends'][cell_numbers] - pair_starts
+    first_station = np.cumsum(no_of_stations) - no_of_stations
+    stations = matrix['pair_of_row'][rows] - \
+        np.repeat(pair_starts - first_station, lengths)
+    no_of_years = matrix['end_year'] + 1 - matrix['start_year']
+    keys = stations * no_of_years + matrix['year_index'][rows]
+    month_keys = (keys[:, None] * 12 + np.arange(12)).ravel()
+    size = no_of_stations.sum() * no_of_years * 12
+    totals = np.bincount(month_keys,
+                         weights=matrix['anomalies'][rows].ravel(),
+                         minlength=size)
+    hits = np.bincount(month_keys, weights=matrix['valid'][rows].ravel(),
+                       minlength=size)
+    return (totals.reshape(no_of_stations.sum(), -1),
+            hits.reshape(no_of_stations.sum(), -1))
+
+
+def _cell_means(totals, hits, no_of_years: int) -> ():
+    """Returns the annual and monthly anomalies from (n x years * 12)
+    totals and hits, which are zero where they are not counted, together
+    with whether each is counted
+    """
+    shape = totals.shape[:-1] + (no_of_years, 12)
+    totals = totals.reshape(shape)
+    hits = hits.reshape(shape)
+    annual_hits = hits.sum(axis=-1)
+    annual = np.divide(totals.sum(axis=-1), annual_hits,
+                       out=np.zeros(annual_hits.shape),
+                       where=annual_hits > 0)
+    # as the global anomalies, cells with an annual anomaly of
+    # zero are not counted
+    annual_valid = annual != 0
+    monthly_valid = hits > 0
+    monthly = np.divide(totals, hits, out=np.zeros(shape),
+                        where=monthly_valid)
+    return annual, annual_valid, monthly, monthly_valid
+
+
+def _add_pending(sums, pending: {}) -> None:
+    """Adds the pending cell anomalies of every replicate to the sums
+    """
+    if pending['rows']:
+        sums += np.hstack(pending['counts']) @ np.vstack(pending['means'])
+    pending['counts'] = []
+    pending['means'] = []
+    pending['rows'] = 0
+
+
+def _bootstrap_chunk(chunk_index: int):
+    """Returns the sums of the resampled cell anomalies of every
+    replicate, for one chunk of the cells.
+    Most cells have only a few stations, so there are only a few
+    distinct ways of drawing their stations, and the anomalies of a cell
+    are only calculated once for each. The sums are then the product of
+    a (replicates x draws) matrix of the number of times that each cell
+    is drawn with a (draws x years) matrix of the cell anomalies
+    """
+    matrix = _BOOTSTRAP['matrix']
+    cell_counts = _BOOTSTRAP['cell_counts']
+    replicates = len(cell_counts)
+    replicate_indexes = np.arange(replicates)
+    no_of_years = matrix['end_year'] + 1 - matrix['start_year']
+    sums = np.zeros((replicates, no_of_years * 26))
+    pending = {'counts': [], 'means': [], 'rows': 0}
+    for cell_number in range(chunk_index, len(matrix['cells']),
+                             BOOTSTRAP_CHUNKS):
+        totals, hits = _station_totals(matrix, [cell_number])
+        no_of_stations = len(totals)
+        if no_of_stations == 1:
+            draws = np.ones((1, 1))
+            draw_of_replicate = np.zeros(replicates, dtype=np.int64)
+        else:
+            # number of times that each station is drawn in each replicate
+            rng = np.random.default_rng(_BOOTSTRAP['seeds'][cell_number])
+            stations = rng.integers(0, no_of_stations,
+                                    size=(replicates, no_of_stations))
+            weights = np.bincount((stations + replicate_indexes[:, None] *
+                                   no_of_stations).ravel(),
+                                  minlength=replicates * no_of_stations)
+            draws, draw_of_replicate = \
+                np.unique(weights.reshape(replicates, no_of_stations),
+                          axis=0, return_inverse=True)
+            draws = draws.astype(float)
+            draw_of_replicate = draw_of_replicate.reshape(-1)
+        annual, annual_valid, monthly, monthly_valid = \
+            _cell_means(draws @ totals, draws @ hits, no_of_years)
+        pending['means'].append(
+            np.hstack((annual, annual_valid,
+                       monthly.reshape(len(draws), -1),
+                       monthly_valid.reshape(len(draws), -1))))
+        counts = np.zeros((replicates, len(draws)))
+        counts[replicate_indexes, draw_of_replicate] = \
+            cell_counts[:, cell_number]
+        pending['counts'].append(counts)
+        pending['rows'] += len(draws)
+        if pending['rows'] >= PENDING_DRAWS:
+            _add_pending(sums, pending)
+    _add_pending(sums, pending)
+    return sums
+
+
+def _percentile_intervals(samples, confidence: float):
+    """Returns the lower and upper bounds of the confidence interval of
+    samples over the first axis, which are NaN where there are no samples
+    """
+    tail = (100.0 - confidence) / 2.0
+    with warnings.catch_warnings():
+        # years with no data in any replicate
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanpercentile(samples, [tail, 100.0 - tail], axis=0)
+
+
+def _interval(lower: float, upper: float) -> ():
+    """Returns an interval, or None if it is undefined
+    """
+    if lower != lower or upper != upper:
+        return None
+    return (lower, upper)
+
+
+def bootstrap_anomalies(matrix: {}, replicates: int = 1000,
+                        confidence: float = 95.0, seed: int = None,
+                        workers: int = 1) -> {}:
+    """Returns confidence intervals for the global and monthly anomalies
+    of each year, as (lower, upper) tuples, from bootstrap replicates
+    of an anomaly matrix. If no seed is given then a random one is used,
+    and it is returned so that the results can be reproduced
+    """
+    seed_sequence = np.random.SeedSequence(seed)
+    no_of_cells = len(matrix['cells'])
+    cell_seed = seed_sequence.spawn(1)[0]
+    _BOOTSTRAP.clear()
+    _BOOTSTRAP['matrix'] = matrix
+    _BOOTSTRAP['seeds'] = seed_sequence.spawn(no_of_cells)
+    # number of times that each cell is drawn in each replicate
+    _BOOTSTRAP['cell_counts'] = np.zeros((replicates, 0))
+    if no_of_cells > 0:
+        _BOOTSTRAP['cell_counts'] = \
+            np.random.default_rng(cell_seed).multinomial(
+                no_of_cells, np.full(no_of_cells, 1.0 / no_of_cells),
+                size=replicates).astype(float)
+
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context(
+                                     'fork')) as executor:
+            chunks = list(executor.map(_bootstrap_chunk,
+                                       range(BOOTSTRAP_CHUNKS)))
+    else:
+        chunks = [_bootstrap_chunk(chunk_index)
+                  for chunk_index in range(BOOTSTRAP_CHUNKS)]
+    _BOOTSTRAP.clear()
+
+    # chunks are summed in order, so that the result is the same for
+    # any number of workers
+    sums = chunks[0]
+    for chunk in chunks[1:]:
+        sums += chunk
+    no_of_years = matrix['end_year'] + 1 - matrix['start_year']
+    sums = np.split(sums, [no_of_years, no_of_years * 2,
+                           no_of_years * 14], axis=1)
+    sums[2] = sums[2].reshape(replicates, no_of_years, 12)
+    sums[3] = sums[3].reshape(replicates, no_of_years, 12)
+    annual = _percentile_intervals(_ratio(sums[0], sums[1]),
+                                   confidence).tolist()
+    monthly = _percentile_intervals(_ratio(sums[2], sums[3]),
+                                    confidence).tolist()
+
+    result = {
+        'replicates': replicates,
+        'confidence': confidence,
+        'seed': seed_sequence.entropy,
+        'annual': {},
+        'monthly': {}
+    }
+    start_year = matrix['start_year']
+    for year_index in range(matrix['end_year'] + 1 - start_year):
+        year = start_year + year_index
+        result['annual'][year] = _interval(annual[0][year_index],
+                                           annual[1][year_index])
+        months = [_interval(monthly[0][year_index][month_index],
+                            monthly[1][year_index][month_index])
+                  for month_index in range(12)]
+        result['monthly'][year] = None
+        if any(months):
+            result['monthly'][year] = months
+    return result
+
+
+def save_anomalies_uncertainty(filename: str, global_anomalies: {},
+                               intervals: {}) -> bool:
+    """Saves the global anomalies and their confidence intervals as CSV
+    """
+    try:
+        with open(filename, 'w+', encoding='utf-8') as fp_csv:
+            fp_csv.write('year,anomaly,lower,upper\n')
+            for year in sorted(global_anomalies.keys()):
+                if global_anomalies[year] is None:
+                    continue
+                interval = intervals['annual'].get(year)
+                if interval is None:
+                    interval = ('', '')
+                fp_csv.write(str(year) + ',' +
+                             str(global_anomalies[year]) + ',' +
+                             str(interval[0]) + ',' +
+                             str(interval[1]) + '\n')
+    except OSError:
+        print('Unable to save ' + filename)
+        return False
+    return True
+
+
+def save_monthly_uncertainty(filename: str, monthly_anomalies: {},
+                             intervals: {}) -> bool:
+    """Saves the monthly anomalies and their confidence intervals as CSV
+    """
+    try:
+        with open(filename, 'w+', encoding='utf-8') as fp_csv:
+            fp_csv.write('year,month,anomaly,lower,upper\n')
+            for year in sorted(monthly_anomalies.keys()):
+                if not monthly_anomalies[year]:
+                    continue
+                months = intervals['monthly'].get(year) or [None] * 12
+                for month_index in range(12):
+                    anomaly = monthly_anomalies[year][month_index]
+                    if anomaly is None:
+                        continue
+                    interval = months[month_index] or ('', '')
+                    fp_csv.write(str(year) + ',' + str(month_index + 1) +
+                                 ',' + str(anomaly) + ',' +
+                                 str(interval[0]) + ',' +
+                                 str(interval[1]) + '\n')
+    except OSError:
+        print('Unable to save ' + filename)
+        return False
+    return True
+
+
+def plot_anomalies_uncertainty(global_anomalies: {}, intervals: {},
+                               start_year: int, end_year: int,
+                               baseline_start: int, baseline_end: int,
+                               min_latitude: float, max_latitude: float,
+                               plot_name: str = 'global_anomalies_uncertainty',
+                               renderer: {} = None) -> None:
+    """Plot yearly anomalies with a shaded confidence interval.
+    If a renderer is given then the plot is added to its queue
+    """
+    data = ''
+    minimum_temp = 99999999
+    maximum_temp = -99999999
+    for year in range(start_year, end_year + 1, 1):
+        interval = intervals['annual'].get(year)
+        if not global_anomalies.get(year) or interval is None:
+            continue
+        data += str(year) + "    " + str(global_anomalies[year]) + "    " + \
+            str(interval[0]) + "    " + str(interval[1]) + '\n'
+        minimum_temp = min(minimum_temp, interval[0])
+        maximum_temp = max(maximum_temp, interval[1])
+    if not data:
+        print('No anomalies')
+        return
+
+    title = \
+        "Global Temperature Anomalies " + \
+        str(start_year) + ' - ' + str(end_year) + \
+        ' for latitude range ' + str(min_latitude) + ' - ' + \
+        str(max_latitude) + ' with ' + \
+        ('%g' % intervals['confidence']) + '% confidence interval'
+    subtitle = "Source https://www.ncei.noaa.gov/pub/data/ghcn/v4"
+    x_label = 'Year'
+    y_label = 'Average Temperature Anomaly (Celcius) ' + \
+        'relative to ' + str(baseline_start) + '-' + str(baseline_end)
+    indent = 0.34
+    vpos = 0.94
+    image_width = 1000
+    image_height = 1000
+    image_format = 'jpg'
+    image_format2 = 'jpeg'
+    filename = plot_name + '.' + image_format
+    script = \
+        "reset\n" + \
+        "$data << EOD\n" + data + "EOD\n" + \
+        "set title \"" + title + "\"\n" + \
+        "set label \"" + subtitle + "\" at screen " + \
+        str(indent) + ", screen " + str(vpos) + "\n" + \
+        "set yrange [" + str(minimum_temp) + ":" + \
+        str(maximum_temp) + "]\n" + \
+        "set xrange [" + str(start_year) + ":" + str(end_year) + "]\n" + \
+        "set lmargin 9\n" + \
+        "set rmargin 2\n" + \
+        "set xlabel \"" + x_label + "\"\n" + \
+        "set ylabel \"" + y_label + "\"\n" + \
+        "set grid\n" + \
+        "set key right bottom\n" + \
+        "set style fill transparent solid 0.3 noborder\n" + \
+        "set terminal " + image_format2 + \
+        " size " + str(image_width) + "," + str(image_height) + "\n" + \
+        "set output \"" + filename + "\"\n" + \
+        "plot $data using 1:3:4 notitle with filledcurves, " + \
+        "$data using 1:2 notitle with lines\n"
+    render_plot(script, renderer)